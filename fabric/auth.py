@@ -3,9 +3,11 @@ Common authentication subroutines. Primarily for internal use.
 """
 
 
-def get_password():
+def get_password(host_string=None):
     from fabric.state import env
-    return env.passwords.get(env.host_string, env.password)
+    if host_string is None:
+        host_string = env.host_string
+    return env.passwords.get(host_string, env.password)
 
 
 def set_password(password):
@@ -39,8 +39,9 @@ import socket
 import select
 
 from fabric.thread_handling import ThreadHandler
-from fabric.state import output, win32, connections, env
+from fabric.state import output, win32, connections, sessions, env
 from fabric import state
+from fabric.utils import _in_parallel_thread
 
 if not win32:
     import termios
@@ -427,9 +428,11 @@ def char_buffered(pipe):
     """
     Force local terminal ``pipe`` be character, not line, buffered.
 
-    Only applies on Unix-based systems; on Windows this is a no-op.
+    Only applies on Unix-based systems; on Windows this is a no-op. Also a
+    no-op in the task threads of the ``thread`` parallel backend, which would
+    otherwise fight over the one terminal they share.
     """
-    if win32 or not pipe.isatty():
+    if win32 or _in_parallel_thread() or not pipe.isatty():
         yield
     else:
         old_settings = termios.tcgetattr(pipe)
@@ -465,6 +468,47 @@ def shell_env(**kw):
     return _setenv({'shell_env': kw})
 
 
+@documented_contextmanager
+def session():
+    """
+    Run `~fabric.operations.run`/`~fabric.operations.sudo` commands in one
+    persistent shell per host, for the duration of the block.
+
+    Normally every command gets a fresh SSH channel and a fresh shell (e.g. a
+    login ``bash``, per :ref:`env.shell <shell>`.) Within ``session``, the
+    first command on each host instead starts one long-lived shell, and it and
+    all later commands are simply written to that shell's input, which is
+    dramatically faster for tasks running many small commands::
+
+        with session():
+            for package in packages:
+                if not contains('/etc/installed', package):
+                    sudo("install %s" % package)
+
+    Each command still runs in its own subshell, so
+    `~fabric.context_managers.cd`, `~fabric.context_managers.prefix`,
+    `~fabric.context_managers.shell_env` and friends (and any ``cd`` or
+    ``export`` within the commands themselves) apply to each command exactly
+    as they would otherwise. Sudo password prompts are answered as usual.
+    However, commands never get a pseudo-terminal, as if ``pty=False`` had
+    been given, and can't read interactive input: their stdin is the shell's
+    own, so what you type isn't passed on to them.
+
+    Shells started within the block are closed when it exits. Setting
+    :ref:`env.persistent_shell <persistent-shell>` to ``True`` enables the
+    same behavior globally, with shells kept open until disconnection.
+
+    .. versionadded:: 1.7
+    """
+    existing = set(sessions)
+    try:
+        with settings(persistent_shell=True):
+            yield
+    finally:
+        for key in set(sessions) - existing:
+            sessions.pop(key).close()
+
+
 def _forwarder(chan, sock):
     # Bidirectionally forward data between a socket and a Paramiko channel.
     while True:
@@ -558,7 +602,7 @@ def remote_tunnel(remote_port, local_port=None, local_host="localhost",
         for sock, chan, th in zip(sockets, channels, threads):
             sock.close()
             chan.close()
-            th.thread.join()
+            th.join()
             th.raise_if_needed()
         transport.cancel_port_forward(remote_bind_address, remote_port)
 
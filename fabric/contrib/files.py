@@ -33,7 +33,7 @@ def exists(path, use_sudo=False, verbose=False):
             return not func(cmd).failed
     # Otherwise, be quiet
     with settings(hide('everything'), warn_only=True):
-        return not func(cmd).failed
+        return not func(cmd, discard=True).failed
 
 
 def first(*args, **kwargs):
@@ -82,7 +82,8 @@ def upload_template(filename, destination, context=None, use_jinja=False,
     func = use_sudo and sudo or run
     # Normalize destination to be an actual filename, due to using StringIO
     with settings(hide('everything'), warn_only=True):
-        if func('test -d %s' % _expand_path(destination)).succeeded:
+        if func('test -d %s' % _expand_path(destination),
+            discard=True).succeeded:
             sep = "" if destination.endswith('/') else "/"
             destination += sep + os.path.basename(filename)
 
@@ -323,7 +324,7 @@ def contains(filename, text, exact=False, use_sudo=False, escape=True,
             text = "^%s$" % text
     with settings(hide('everything'), warn_only=True):
         egrep_cmd = 'egrep "%s" %s' % (text, _expand_path(filename))
-        return func(egrep_cmd, shell=shell).succeeded
+        return func(egrep_cmd, shell=shell, discard=True).succeeded
 
 
 def append(filename, text, use_sudo=False, partial=False, escape=True,
@@ -191,6 +191,44 @@ def parallel(pool_size=None):
     return real_decorator
 
 
+def rolling(batch, max_fail=None, pause=None):
+    """
+    Run the wrapped function in parallel, but only on ``batch`` hosts at a time.
+
+    Hosts are split into successive batches, each of which runs through the
+    job queue like any other parallel task; a batch has to finish completely
+    before the next one starts, after waiting ``pause`` seconds if given.
+
+    ``batch`` and ``max_fail`` may be plain host counts, or percentages of the
+    host list given as strings. Up to ``max_fail`` failed hosts (default: none)
+    are reported as warnings and the rollout goes on; once more hosts than that
+    have failed, the remaining batches are skipped and Fabric aborts (or warns,
+    if :ref:`warn_only <warn_only>` is set.) For example, to update a tenth of
+    the fleet at a time, stopping as soon as more than 2% of it breaks::
+
+        @rolling(batch="10%", max_fail="2%", pause=30)
+        def upgrade():
+            ...
+
+    As with `~fabric.decorators.parallel`, the pool size (which applies within
+    each batch) may be set with ``--pool-size``/:ref:`env.pool_size
+    <pool-size>` or by stacking ``@parallel(pool_size=N)`` beneath this
+    decorator. This decorator takes precedence over the global
+    :ref:`env.rolling_batch <rolling-batch>` and friends.
+
+    .. versionadded:: 1.7
+    """
+    def real_decorator(func):
+        decorated = parallel(func)
+        # Keep any pool size from an inner @parallel(pool_size=N)
+        decorated.pool_size = getattr(func, 'pool_size', None)
+        decorated.rolling_batch = batch
+        decorated.rolling_max_fail = max_fail
+        decorated.rolling_pause = pause
+        return decorated
+    return real_decorator
+
+
 def with_settings(*arg_settings, **kw_settings):
     """
     Decorator equivalent of ``fabric.context_managers.settings``.
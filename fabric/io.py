@@ -4,34 +4,323 @@ import sys
 import time
 import re
 import socket
+import tempfile
 from select import select
 
 from fabric.state import env, output, win32
 from fabric.auth import get_password, set_password
 import fabric.network
 from fabric.network import ssh
-from fabric.utils import RingBuffer
+from fabric.utils import RingBuffer, _in_parallel_thread
 from fabric.exceptions import CommandTimeout
 
 if win32:
     import msvcrt
 
 
-def _endswith(char_list, substring):
-    tail = char_list[-1 * len(substring):]
-    substring = list(substring)
-    return tail == substring
-
-
 def _has_newline(bytelist):
     return '\r' in bytelist or '\n' in bytelist
 
 
+class CaptureBuffer(object):
+    """
+    Append-only store for captured output, kept compact and cheap to inspect.
+
+    Text is stored as a list of chunks of up to roughly ``chunk_size``
+    characters (small appends are coalesced), so memory use stays close to the
+    size of the captured text itself. `endswith` and `drop_tail` only ever look
+    at as many trailing chunks as they need to, regardless of total size.
+
+    If ``limit`` is given, at most the first and last ``limit`` characters are
+    kept in memory: once the capture grows past ``limit``, the complete text
+    is written to a local file instead -- ``spill_to`` if that path is given,
+    otherwise an anonymous temporary file. Giving ``spill_to`` without
+    ``limit`` writes everything to that path while still keeping it all in
+    memory.
+
+    Use `read` (or ``str()``) to obtain the captured text as a single string,
+    `iterlines` to walk it line by line without loading it all at once, and
+    `excerpt` for just the parts held in memory.
+    """
+    chunk_size = 4096
+    read_size = 65536
+
+    def __init__(self, limit=None, spill_to=None):
+        self.limit = limit
+        self.spill_to = spill_to
+        # In-memory text: everything, or only the last `limit`-ish characters
+        # once spilled.
+        self.chunks = []
+        self.kept = 0
+        # First `limit` characters, saved when we start spilling.
+        self.head = ''
+        self.file = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.read()
+
+    @property
+    def spilled(self):
+        """
+        Whether some of the captured text is only available from disk.
+        """
+        return self.kept < self.size
+
+    def append(self, text):
+        if not text:
+            return
+        if self.file is None and (self.spill_to is not None or (
+            self.limit is not None and self.size + len(text) > self.limit
+        )):
+            self._spill(text)
+        if self.file is not None:
+            self.file.write(text)
+        if self.chunks and len(self.chunks[-1]) < self.chunk_size:
+            self.chunks[-1] += text
+        else:
+            self.chunks.append(text)
+        self.size += len(text)
+        self.kept += len(text)
+        if self.file is not None and self.limit is not None:
+            self._trim()
+
+    def _trim(self):
+        # Forget all but the last `limit` characters held in memory.
+        while self.kept > self.limit:
+            excess = self.kept - self.limit
+            if len(self.chunks[0]) > excess:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.kept -= excess
+            else:
+                self.kept -= len(self.chunks.pop(0))
+
+    def _spill(self, text):
+        existing = ''.join(self.chunks)
+        if self.spill_to is not None:
+            self.file = open(self.spill_to, 'w+b')
+        else:
+            self.file = tempfile.TemporaryFile()
+        self.file.write(existing)
+        if self.limit is not None:
+            self.head = (existing + text)[:self.limit]
+
+    def finish(self):
+        """
+        Flush any spilled text out to disk.
+        """
+        if self.file is not None:
+            self.file.flush()
+
+    def tail(self, count):
+        """
+        Return (up to) the last ``count`` characters captured.
+        """
+        if count > self.kept and self.spilled:
+            self.file.seek(max(0, self.size - count))
+            text = self.file.read(count)
+            self.file.seek(0, 2)
+            return text
+        parts = []
+        needed = count
+        for chunk in reversed(self.chunks):
+            if needed <= 0:
+                break
+            parts.append(chunk[-needed:])
+            needed -= len(chunk)
+        parts.reverse()
+        return ''.join(parts)
+
+    def endswith(self, suffix):
+        return len(suffix) <= self.size and self.tail(len(suffix)) == suffix
+
+    def drop_tail(self, count):
+        """
+        Remove the last ``count`` characters captured.
+        """
+        count = min(count, self.size)
+        self.size -= count
+        self.head = self.head[:self.size]
+        if self.file is not None:
+            self.file.seek(self.size)
+            self.file.truncate()
+        while count > 0 and self.chunks:
+            chunk = self.chunks.pop()
+            if len(chunk) > count:
+                self.chunks.append(chunk[:-count])
+                self.kept -= count
+            else:
+                self.kept -= len(chunk)
+            count -= len(chunk)
+
+    def excerpt(self):
+        """
+        Return the captured text held in memory.
+
+        This is all of it unless `spilled`, in which case the first and last
+        ``limit`` characters are returned, run together.
+        """
+        kept = ''.join(self.chunks)
+        if not self.spilled:
+            return kept
+        # Don't repeat anything the head and the in-memory tail overlap on.
+        overlap = len(self.head) - (self.size - self.kept)
+        return self.head + kept[max(0, overlap):]
+
+    def iterchunks(self):
+        """
+        Yield the complete captured text in pieces, reading from disk if
+        necessary.
+        """
+        if not self.spilled:
+            for chunk in self.chunks:
+                yield chunk
+            return
+        offset = 0
+        while True:
+            self.file.seek(offset)
+            chunk = self.file.read(self.read_size)
+            self.file.seek(0, 2)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def read(self):
+        return ''.join(self.iterchunks())
+
+    def iterlines(self):
+        """
+        Yield each line of the captured text, without line endings.
+        """
+        partial = ''
+        for chunk in self.iterchunks():
+            lines = (partial + chunk).splitlines(True)
+            # Hold back a trailing partial line (or a lone CR, which may be
+            # the first half of a CRLF) until the next chunk arrives.
+            partial = ''
+            if lines and not lines[-1].endswith('\n'):
+                partial = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r\n')
+        if partial:
+            yield partial.rstrip('\r\n')
+
+
+class LineBuffer(object):
+    """
+    Capture target which hands on complete lines as soon as they arrive.
+
+    Has the ``append``/``drop_tail`` interface of `CaptureBuffer`, but only
+    holds on to text until it is collected with `pop_lines`, so memory use is
+    bounded by the length of a line rather than of the whole output.
+    """
+    def __init__(self):
+        self.text = ''
+
+    def append(self, text):
+        self.text += text
+
+    def drop_tail(self, count):
+        self.text = self.text[:max(0, len(self.text) - count)]
+
+    def pop_lines(self, final=False):
+        """
+        Remove and return any complete lines, without line endings.
+
+        A trailing partial line is only returned if ``final`` is True.
+        """
+        if final:
+            end = len(self.text)
+        else:
+            end = self.text.rfind('\n') + 1
+        if not end:
+            return []
+        text, self.text = self.text[:end], self.text[end:]
+        return text.splitlines()
+
+
+class PromptMatcher(object):
+    """
+    Incrementally scan a stream of output for any of a fixed set of prompts.
+
+    All prompts are compiled into a single regular expression (compiled once
+    per distinct set of prompts and shared between matchers), so each chunk
+    handed to `feed` is scanned in one pass no matter how many prompts are
+    registered. Only the last few characters of the stream -- enough to
+    complete a prompt split across two reads -- are carried between calls.
+
+    As with line-oriented matching, a prompt only counts when it ends at a
+    line boundary: just before a ``\\r`` or ``\\n``, at the end of the data
+    read so far, or (for prompts which themselves end in a newline) anywhere.
+    """
+    _compiled = {}
+
+    def __init__(self, prompts):
+        prompts = tuple(sorted(set(filter(None, prompts)), key=len,
+            reverse=True))
+        self.prompts = prompts
+        self.regex = self._compile(prompts)
+        self.keep = max([len(p) for p in prompts] or [1]) - 1
+        self.tail = ''
+
+    @classmethod
+    def _compile(cls, prompts):
+        if not prompts:
+            return None
+        if prompts not in cls._compiled:
+            inline, terminated = [], []
+            for prompt in prompts:
+                if prompt[-1] in '\r\n':
+                    terminated.append(re.escape(prompt))
+                else:
+                    inline.append(re.escape(prompt))
+            alternatives = []
+            if inline:
+                alternatives.append(r"(?:%s)(?=[\r\n]|\Z)" % "|".join(inline))
+            if terminated:
+                alternatives.append("|".join(terminated))
+            cls._compiled[prompts] = re.compile("|".join(alternatives))
+        return cls._compiled[prompts]
+
+    def feed(self, text):
+        """
+        Consume ``text`` and return a list of ``(end, prompt)`` tuples.
+
+        ``end`` is the offset within ``text`` just past the matched prompt;
+        prompts which began in a previous chunk are reported too.
+        """
+        if self.regex is None:
+            return []
+        window = self.tail + text
+        offset = len(self.tail)
+        self.tail = window[-self.keep:] if self.keep else ''
+        # Substring tests are far cheaper than the regex, and most output
+        # contains no prompts at all.
+        for prompt in self.prompts:
+            if prompt in window:
+                break
+        else:
+            return []
+        matches = [
+            (match.end() - offset, match.group())
+            for match in self.regex.finditer(window)
+            if match.end() > offset
+        ]
+        return matches
+
+
 def output_loop(*args, **kwargs):
     OutputLooper(*args, **kwargs).loop()
 
 
 class OutputLooper(object):
+    # Only EOF ends a channel's output, as far as we're concerned.
+    complete = False
+
     def __init__(self, chan, attr, stream, capture, timeout):
         self.chan = chan
         self.stream = stream
@@ -47,6 +336,20 @@ class OutputLooper(object):
         self.reprompt = False
         self.read_size = 4096
         self.write_buffer = RingBuffer([], maxlen=len(self.prefix))
+        # Allow prefix to be turned off.
+        if not env.output_prefix:
+            self.prefix = ""
+        # State carried between feed() calls
+        self.initial_prefix_printed = False
+        self.seen_cr = False
+        self.line = []
+        # Prompts we know how to respond to, including user-registered ones
+        self.responses = dict(env.prompts)
+        self.matcher = PromptMatcher([
+            env.sudo_prompt,
+            env.again_prompt + '\n',
+            env.again_prompt + '\r\n',
+        ] + self.responses.keys())
 
     def _flush(self, text):
         self.stream.write(text)
@@ -57,24 +360,17 @@ class OutputLooper(object):
         """
         Loop, reading from <chan>.<attr>(), writing to <stream> and buffering to <capture>.
 
+        ``capture`` should be a `CaptureBuffer`, or ``None`` to skip capturing
+        and prompt handling entirely (as `~fabric.operations.open_shell` does.)
+
         Will raise `~fabric.exceptions.CommandTimeout` if network timeouts
         continue to be seen past the defined ``self.timeout`` threshold.
         (Timeouts before then are considered part of normal short-timeout fast
         network reading; see Fabric issue #733 for background.)
-        """
-        # Internal capture-buffer-like buffer, used solely for state keeping.
-        # Unlike 'capture', nothing is ever purged from this.
-        _buffer = []
-
-        # Initialize loop variables
-        initial_prefix_printed = False
-        seen_cr = False
-        line = []
-
-        # Allow prefix to be turned off.
-        if not env.output_prefix:
-            self.prefix = ""
 
+        Within Fabric itself, channels are instead serviced by a `Multiplexer`,
+        which calls `feed` and `finish` directly.
+        """
         start = time.time()
         while True:
             # Handle actual read
@@ -87,75 +383,88 @@ class OutputLooper(object):
                 continue
             # Empty byte == EOS
             if bytelist == '':
-                # If linewise, ensure we flush any leftovers in the buffer.
-                if self.linewise and line:
-                    self._flush(self.prefix)
-                    self._flush("".join(line))
                 break
-            # A None capture variable implies that we're in open_shell()
-            if self.capture is None:
-                # Just print directly -- no prefixes, no capturing, nada
-                # And since we know we're using a pty in this mode, just go
-                # straight to stdout.
-                self._flush(bytelist)
-            # Otherwise, we're in run/sudo and need to handle capturing and
-            # prompts.
+            self.feed(bytelist)
+        self.finish()
+
+    def feed(self, bytelist):
+        """
+        Handle one (non-empty) chunk of output: print it, capture it and answer
+        any prompts it ends with.
+        """
+        # A None capture variable implies that we're in open_shell()
+        if self.capture is None:
+            # Just print directly -- no prefixes, no capturing, nada
+            # And since we know we're using a pty in this mode, just go
+            # straight to stdout.
+            self._flush(bytelist)
+            return
+        # Otherwise, we're in run/sudo and need to handle capturing and
+        # prompts.
+        # Print to user
+        if self.printing:
+            printable_bytes = bytelist
+            # Small state machine to eat \n after \r
+            if printable_bytes[-1] == "\r":
+                self.seen_cr = True
+            if printable_bytes[0] == "\n" and self.seen_cr:
+                printable_bytes = printable_bytes[1:]
+                self.seen_cr = False
+
+            while _has_newline(printable_bytes) and printable_bytes != "":
+                # at most 1 split !
+                cr = re.search("(\r\n|\r|\n)", printable_bytes)
+                if cr is None:
+                    break
+                end_of_line = printable_bytes[:cr.start(0)]
+                printable_bytes = printable_bytes[cr.end(0):]
+
+                if not self.initial_prefix_printed:
+                    self._flush(self.prefix)
+
+                if _has_newline(end_of_line):
+                    end_of_line = ''
+
+                if self.linewise:
+                    self._flush("".join(self.line) + end_of_line + "\n")
+                    self.line = []
+                else:
+                    self._flush(end_of_line + "\n")
+                self.initial_prefix_printed = False
+
+            if self.linewise:
+                self.line += [printable_bytes]
             else:
-                # Print to user
-                if self.printing:
-                    printable_bytes = bytelist
-                    # Small state machine to eat \n after \r
-                    if printable_bytes[-1] == "\r":
-                        seen_cr = True
-                    if printable_bytes[0] == "\n" and seen_cr:
-                        printable_bytes = printable_bytes[1:]
-                        seen_cr = False
-
-                    while _has_newline(printable_bytes) and printable_bytes != "":
-                        # at most 1 split !
-                        cr = re.search("(\r\n|\r|\n)", printable_bytes)
-                        if cr is None:
-                            break
-                        end_of_line = printable_bytes[:cr.start(0)]
-                        printable_bytes = printable_bytes[cr.end(0):]
-
-                        if not initial_prefix_printed:
-                            self._flush(self.prefix)
-
-                        if _has_newline(end_of_line):
-                            end_of_line = ''
-
-                        if self.linewise:
-                            self._flush("".join(line) + end_of_line + "\n")
-                            line = []
-                        else:
-                            self._flush(end_of_line + "\n")
-                        initial_prefix_printed = False
-
-                    if self.linewise:
-                        line += [printable_bytes]
-                    else:
-                        if not initial_prefix_printed:
-                            self._flush(self.prefix)
-                            initial_prefix_printed = True
-                        self._flush(printable_bytes)
-
-                # Now we have handled printing, handle interactivity
-                read_lines = re.split(r"(\r|\n|\r\n)", bytelist)
-                for fragment in read_lines:
-                    # Store in capture buffer
-                    self.capture += fragment
-                    # Store in internal buffer
-                    _buffer += fragment
-                    # Handle prompts
-                    prompt = _endswith(self.capture, env.sudo_prompt)
-                    try_again = (_endswith(self.capture, env.again_prompt + '\n')
-                        or _endswith(self.capture, env.again_prompt + '\r\n'))
-                    if prompt:
-                        self.prompt()
-                    elif try_again:
-                        self.try_again()
+                if not self.initial_prefix_printed:
+                    self._flush(self.prefix)
+                    self.initial_prefix_printed = True
+                self._flush(printable_bytes)
+
+        # Now we have handled printing, handle interactivity: capture
+        # everything, stopping at each prompt to deal with it.
+        start = 0
+        for end, prompt in self.matcher.feed(bytelist):
+            self.capture.append(bytelist[start:end])
+            start = end
+            self.handle_prompt(prompt)
+        self.capture.append(bytelist[start:])
+
+    def handle_prompt(self, prompt):
+        if prompt == env.sudo_prompt:
+            self.prompt()
+        elif prompt in self.responses:
+            self.chan.sendall(self.responses[prompt] + '\n')
+        else:
+            self.try_again(len(prompt))
 
+    def finish(self):
+        """
+        Tie off output once the stream has hit EOF.
+        """
+        # If linewise, ensure we flush any leftovers in the buffer.
+        if self.linewise and self.line:
+            self._flush(self.prefix)
+            self._flush("".join(self.line))
         # Print trailing new line if the last thing we printed was our line
         # prefix.
         if self.prefix and "".join(self.write_buffer) == self.prefix:
@@ -168,7 +477,7 @@ class OutputLooper(object):
         # backwards compatible with Fabric 0.9.x behavior; the user
         # will still see the prompt on their screen (no way to avoid
         # this) but at least it won't clutter up the captured text.
-        del self.capture[-1 * len(env.sudo_prompt):]
+        self.capture.drop_tail(len(env.sudo_prompt))
         # If the password we just tried was bad, prompt the user again.
         if (not password) or self.reprompt:
             # Print the prompt and/or the "try again" notice if
@@ -195,28 +504,242 @@ class OutputLooper(object):
         # Send current password down the pipe
         self.chan.sendall(password + '\n')
  
-    def try_again(self):
-        # Remove text from capture buffer
-        self.capture = self.capture[:len(env.again_prompt)]
+    def try_again(self, length):
+        # Remove the (``length`` characters long) "try again" line from the
+        # capture buffer, as with the prompt itself.
+        self.capture.drop_tail(length)
         # Set state so we re-prompt the user at the next prompt.
         self.reprompt = True
 
 
-def input_loop(chan, using_pty):
-    while not chan.exit_status_ready():
-        if win32:
-            have_char = msvcrt.kbhit()
+class Drain(OutputLooper):
+    """
+    `OutputLooper` which throws output away instead of printing or capturing it.
+
+    Reads are much larger, and the only thing done with the data is to scan it
+    for prompts, so that e.g. sudo password prompts are still answered.
+    """
+    def __init__(self, *args, **kwargs):
+        super(Drain, self).__init__(*args, **kwargs)
+        self.read_size = 65536
+
+    def feed(self, bytelist):
+        for end, prompt in self.matcher.feed(bytelist):
+            self.handle_prompt(prompt)
+
+
+class FrameReader(object):
+    """
+    Pass output on to ``looper`` until ``marker`` shows up in it.
+
+    Used when several commands' output arrives on one channel, each followed
+    by a marker line: ``<marker> <value>``. Once that has been read,
+    `complete` is True and ``value`` holds whatever followed the marker on its
+    line (e.g. an exit status), and ``rest`` whatever was read after that
+    line. Anything which might be the beginning of a marker split across two
+    reads is held back until the next read.
+    """
+    def __init__(self, looper, marker):
+        self.looper = looper
+        self.marker = marker
+        self.read_size = looper.read_size
+        self.held = ''
+        self.value = None
+        self.rest = ''
+        self.complete = False
+
+    def feed(self, bytelist):
+        if self.complete:
+            return
+        text = self.held + bytelist
+        index = text.find(self.marker)
+        if index == -1:
+            keep = self._partial_marker(text)
+            self.held = text[len(text) - keep:]
+            text = text[:len(text) - keep]
         else:
-            r, w, x = select([sys.stdin], [], [], 0.0)
-            have_char = (r and r[0] == sys.stdin)
-        if have_char and chan.input_enabled:
-            # Send all local stdin to remote end's stdin
-            byte = msvcrt.getch() if win32 else sys.stdin.read(1)
-            chan.sendall(byte)
-            # Optionally echo locally, if needed.
-            if not using_pty and env.echo_stdin:
-                # Not using fastprint() here -- it prints as 'user'
-                # output level, don't want it to be accidentally hidden
-                sys.stdout.write(byte)
-                sys.stdout.flush()
-        time.sleep(ssh.io_sleep)
+            self.held = text[index:]
+            text = text[:index]
+            end = self.held.find('\n')
+            if end != -1:
+                self.value = self.held[len(self.marker):end].strip()
+                self.rest = self.held[end + 1:]
+                self.complete = True
+                self.held = ''
+        if text:
+            self.looper.feed(text)
+
+    def _partial_marker(self, text):
+        # Length of the longest tail of text which begins the marker
+        for length in xrange(min(len(self.marker) - 1, len(text)), 0, -1):
+            if self.marker.startswith(text[-length:]):
+                return length
+        return 0
+
+    def finish(self):
+        # Hit EOF without seeing a marker, so whatever was held back was just
+        # output after all.
+        if self.held and not self.complete:
+            self.looper.feed(self.held)
+            self.held = ''
+        self.looper.finish()
+
+
+class FrameSequence(object):
+    """
+    Feed output to each of a list of `FrameReader` objects in turn.
+
+    Each reader is finished as soon as it has seen its marker, and whatever
+    followed is handed to the next one. ``started``, if given, is called with
+    the index of each reader as it becomes current.
+    """
+    def __init__(self, readers, started=None):
+        self.readers = readers
+        self.started = started
+        self.index = 0
+        self.read_size = readers[0].read_size
+        if started is not None:
+            started(0)
+
+    @property
+    def complete(self):
+        return self.index == len(self.readers)
+
+    def feed(self, bytelist):
+        while not self.complete:
+            reader = self.readers[self.index]
+            reader.feed(bytelist)
+            if not reader.complete:
+                break
+            reader.finish()
+            bytelist, reader.rest = reader.rest, ''
+            self.index += 1
+            if self.started is not None and not self.complete:
+                self.started(self.index)
+
+    def finish(self):
+        for reader in self.readers[self.index:]:
+            reader.finish()
+
+
+class _MuxedChannel(object):
+    """
+    A `Multiplexer`'s bookkeeping for a single channel.
+    """
+    def __init__(self, chan, out, err, deadline):
+        self.chan = chan
+        self.out = out
+        self.err = err
+        self.deadline = deadline
+
+    def fileno(self):
+        return self.chan.fileno()
+
+
+class Multiplexer(object):
+    """
+    Services the stdout, stderr and stdin of any number of channels from a
+    single thread.
+
+    Each channel is `add`-ed along with the two `OutputLooper` objects handling
+    its stdout and stderr, which are then fed whatever gets read. `run` sleeps
+    in ``select()`` on the channels (and on local stdin) until all of them
+    have hit EOF, so there's no per-channel thread startup cost and no polling.
+
+    Local stdin is forwarded to at most one channel, the one added with
+    ``input=True`` (and to none when running in a parallel task thread.) If ``run`` is interrupted (e.g. by ``KeyboardInterrupt``)
+    it may simply be called again to pick up where it left off.
+
+    Each consumer's ``read_size`` attribute sets how much is read at a time.
+    A channel is also considered done once both its consumers are
+    ``complete``, for channels (such as persistent shells) whose output
+    doesn't end in EOF.
+    """
+    def __init__(self):
+        self.channels = []
+        self.input = None
+        self.using_pty = True
+        self.stdin_open = True
+
+    def add(self, chan, out, err, timeout=None, input=False, using_pty=True):
+        """
+        Start servicing ``chan``, feeding its output to ``out``/``err``.
+
+        ``timeout`` is the number of seconds after which to give up on the
+        channel and raise `~fabric.exceptions.CommandTimeout`.
+        """
+        deadline = None if timeout is None else (time.time() + timeout)
+        muxed = _MuxedChannel(chan, out, err, deadline)
+        self.channels.append(muxed)
+        # Parallel threads leave local stdin alone, as the other backends'
+        # processes (whose stdin is /dev/null) do, since they all share it.
+        if input and not _in_parallel_thread():
+            self.input = muxed
+            self.using_pty = using_pty
+
+    def run(self):
+        """
+        Service all added channels until they have all hit EOF.
+        """
+        while self.channels:
+            self.step()
+
+    def step(self):
+        """
+        Sleep until something happens on our channels or stdin, and handle it.
+        """
+        timeout = None
+        now = time.time()
+        for muxed in self.channels:
+            if muxed.deadline is not None:
+                if now > muxed.deadline:
+                    raise CommandTimeout
+                timeout = min(timeout or muxed.deadline, muxed.deadline)
+        if timeout is not None:
+            timeout -= now
+        watched = list(self.channels)
+        if self.input in self.channels and self.stdin_open:
+            # While a local prompt (e.g. for a sudo password) has turned input
+            # off, leave stdin alone and just check back in periodically.
+            # Ditto for Windows, where we can't select() on the console.
+            if win32 or not self.input.chan.input_enabled:
+                timeout = min(timeout or ssh.io_sleep, ssh.io_sleep)
+            else:
+                watched.append(sys.stdin)
+        r, w, x = select(watched, [], [], timeout)
+        for muxed in r:
+            if muxed is sys.stdin:
+                self._forward_input(sys.stdin.read(1))
+            else:
+                self._service(muxed)
+        if win32 and self.input is not None and self.input.chan.input_enabled:
+            if msvcrt.kbhit():
+                self._forward_input(msvcrt.getch())
+
+    def _service(self, muxed):
+        chan = muxed.chan
+        if chan.recv_ready():
+            muxed.out.feed(chan.recv(muxed.out.read_size))
+        if chan.recv_stderr_ready():
+            muxed.err.feed(chan.recv_stderr(muxed.err.read_size))
+        done = (muxed.out.complete and muxed.err.complete) or (
+            (chan.eof_received or chan.closed)
+            and not (chan.recv_ready() or chan.recv_stderr_ready()))
+        if done:
+            self.channels.remove(muxed)
+            muxed.out.finish()
+            muxed.err.finish()
+
+    def _forward_input(self, byte):
+        # Stop watching stdin once it hits EOF, or we'd spin on it.
+        if not byte:
+            self.stdin_open = False
+            return
+        # Send local stdin to remote end's stdin
+        self.input.chan.sendall(byte)
+        # Optionally echo locally, if needed.
+        if not self.using_pty and env.echo_stdin:
+            # Not using fastprint() here -- it prints as 'user'
+            # output level, don't want it to be accidentally hidden
+            sys.stdout.write(byte)
+            sys.stdout.flush()
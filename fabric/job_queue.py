@@ -1,11 +1,20 @@
 """
 Sliding-window-based job/task queue class (& example of use.)
 
-May use ``multiprocessing.Process`` or ``threading.Thread`` objects as queue
-items, though within Fabric itself only ``Process`` objects are used/supported.
+May use ``multiprocessing.Process``, `ThreadJob` or `PoolJob` objects as queue
+items.
 """
 
 from __future__ import with_statement
+import bisect
+import errno
+import hashlib
+import os
+import cPickle as pickle
+import select
+import stat
+import sys
+import threading
 import time
 import Queue
 
@@ -14,6 +23,54 @@ from fabric.network import ssh
 from fabric.context_managers import settings
 
 
+class ThreadJob(threading.Thread):
+    """
+    ``threading.Thread`` with a ``multiprocessing.Process``-style ``exitcode``.
+
+    ``exitcode`` is ``None`` while running, then ``0`` if ``target`` returned,
+    or the exit status it would have given a process if it raised instead --
+    e.g. ``1`` for `~fabric.utils.abort`. ``sentinel`` becomes readable once
+    that is known.
+    """
+    def __init__(self, target, kwargs):
+        threading.Thread.__init__(self, target=target, kwargs=kwargs)
+        self.setDaemon(True)
+        self.exitcode = None
+        self.sentinel = None
+
+    def start(self):
+        # Only now, so that queued jobs don't hold on to file descriptors.
+        self.sentinel, self._done = os.pipe()
+        threading.Thread.start(self)
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if not self.isAlive() and self.sentinel is not None:
+            os.close(self.sentinel)
+            self.sentinel = None
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            os.close(self._done)
+
+    def _run(self):
+        try:
+            threading.Thread.run(self)
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                self.exitcode = e.code or 0
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                self.exitcode = 1
+        except BaseException:
+            self.exitcode = 1
+            raise
+        else:
+            self.exitcode = 0
+
+
 class JobQueue(object):
     """
     The goal of this class is to make a queue of processes to run, and go
@@ -45,16 +102,15 @@ class JobQueue(object):
         self._finished = False
         self._closed = False
         self._debug = False
-
-    def _all_alive(self):
-        """
-        Simply states if all procs are alive or not. Needed to determine when
-        to stop looping, and pop dead procs off and add live ones.
-        """
-        if self._running:
-            return all([x.is_alive() for x in self._running])
-        else:
-            return False
+        # Per job: what to wait on, and whether we opened it ourselves
+        self._sentinels = {}
+        self._own_sentinels = set()
+        # For stats()
+        self._appended = {}
+        self._started = {}
+        self._ended = {}
+        self._wakeups = 0
+        self._peak_running = 0
 
     def __len__(self):
         """
@@ -86,41 +142,137 @@ class JobQueue(object):
         if not self._closed:
             self._queued.append(process)
             self._num_of_jobs += 1
+            self._appended[process.name] = time.time()
             if self._debug:
                 print("job queue appended %s." % process.name)
 
+    def stats(self):
+        """
+        Return a dict describing the queue's progress and latencies so far.
+
+        ``queued``, ``running`` and ``completed`` count jobs; ``wakeups``
+        counts how often `run` woke up to check on them. ``wait`` is how long
+        jobs spent queued before being started, and ``runtime`` how long they
+        then took to be noticed as finished, as ``(average, maximum)`` tuples
+        of seconds.
+        """
+        def summary(durations):
+            if not durations:
+                return (0.0, 0.0)
+            return (sum(durations) / len(durations), max(durations))
+        return {
+            'queued': len(self._queued),
+            'running': len(self._running),
+            'completed': len(self._completed),
+            'peak_running': self._peak_running,
+            'wakeups': self._wakeups,
+            'wait': summary([
+                self._started[name] - self._appended[name]
+                for name in self._started
+            ]),
+            'runtime': summary([
+                self._ended[name] - self._started[name]
+                for name in self._ended
+            ]),
+        }
+
+    def _start(self, job):
+        """
+        Start ``job``, noting what to wait on to hear of its completion.
+
+        Jobs which don't offer a ``sentinel`` (Python 2's ``Process`` doesn't)
+        get the read end of a pipe whose write end only they hold: it reads as
+        EOF once they exit.
+        """
+        sentinel = write_end = None
+        if getattr(job, 'sentinel', None) is None and hasattr(job, 'pid'):
+            sentinel, write_end = os.pipe()
+        with settings(clean_revert=True, host_string=job.name, host=job.name):
+            job.start()
+        if write_end is not None:
+            os.close(write_end)
+            self._own_sentinels.add(sentinel)
+        else:
+            sentinel = getattr(job, 'sentinel', None)
+        self._sentinels[job] = sentinel
+        self._started[job.name] = time.time()
+        self._running.append(job)
+        self._peak_running = max(self._peak_running, len(self._running))
+
+    def _reap(self, job):
+        self._running.remove(job)
+        self._completed.append(job)
+        self._ended[job.name] = time.time()
+        sentinel = self._sentinels.pop(job)
+        if sentinel in self._own_sentinels:
+            self._own_sentinels.remove(sentinel)
+            os.close(sentinel)
+        if self._debug:
+            print("Job queue found finished proc: %s." % job.name)
+
+    def _wait(self):
+        """
+        Block until running jobs may have finished or sent results.
+
+        Returns the jobs worth checking on: those whose sentinels are ready,
+        or all of them when some lack one or nothing happened for a while
+        (as can happen if e.g. a job's own children hold its pipe open.)
+        """
+        waiting = {}
+        for job in self._running:
+            waiting.setdefault(self._sentinels[job], []).append(job)
+        if None in waiting:
+            time.sleep(ssh.io_sleep)
+            return list(self._running)
+        handles = list(waiting)
+        # Results need draining as they come in, lest a child block on a full
+        # pipe trying to send them.
+        reader = getattr(self._comms_queue, '_reader', None)
+        if reader is not None:
+            handles.append(reader)
+        try:
+            ready = select.select(handles, [], [], self._max_wait)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        self._wakeups += 1
+        if not ready:
+            return list(self._running)
+        jobs = [job for handle in ready for job in waiting.get(handle, [])]
+        for job in jobs:
+            # Unlike a pool worker's pipe, these only turn ready as their job
+            # ends; wait for it to, rather than spin until it is reapable.
+            if not isinstance(job, PoolJob):
+                job.join()
+        return jobs
+
+    # Upper bound on how long to trust sentinels to tell us about jobs
+    _max_wait = 1
+
     def run(self):
         """
         This is the workhorse. It will take the intial jobs from the _queue,
         start them, add them to _running, and then go into the main running
         loop.
 
-        This loop will check for done procs, if found, move them out of
-        _running into _completed. It also checks for a _running queue with open
-        spots, which it will then fill as discovered.
+        This loop waits for running jobs to finish (or send results), moving
+        finished ones out of _running into _completed and immediately starting
+        queued jobs in their place.
 
         To end the loop, there have to be no running procs, and no more procs
         to be run in the queue.
 
         This function returns an iterable of all its children's exit codes.
         """
-        def _advance_the_queue():
-            """
-            Helper function to do the job of poping a new proc off the queue
-            start it, then add it to the running queue. This will eventually
-            depleate the _queue, which is a condition of stopping the running
-            while loop.
-
-            It also sets the env.host_string from the job.name, so that fabric
-            knows that this is the host to be making connections on.
-            """
-            job = self._queued.pop()
-            if self._debug:
-                print("Popping '%s' off the queue and starting it" % job.name)
-            with settings(clean_revert=True, host_string=job.name, host=job.name):
-                job.start()
-            self._running.append(job)
+        return dict(self.run_iter())
 
+    def run_iter(self):
+        """
+        Like `run`, but yield each job's ``(name, result)`` as it finishes.
+
+        ``result`` is a dict as found in `run`'s return value.
+        """
         # Prep return value so we can start filling it during main loop
         results = {}
         for job in self._queued:
@@ -132,52 +284,46 @@ class JobQueue(object):
         if self._debug:
             print("Job queue starting.")
 
-        while len(self._running) < self._max:
-            _advance_the_queue()
-
         # Main loop!
-        while not self._finished:
+        while self._queued or self._running:
             while len(self._running) < self._max and self._queued:
-                _advance_the_queue()
-
-            if not self._all_alive():
-                for id, job in enumerate(self._running):
-                    if not job.is_alive():
-                        if self._debug:
-                            print("Job queue found finished proc: %s." %
-                                    job.name)
-                        done = self._running.pop(id)
-                        self._completed.append(done)
-
+                job = self._queued.pop()
                 if self._debug:
-                    print("Job queue has %d running." % len(self._running))
+                    print("Popping '%s' off the queue and starting it" %
+                        job.name)
+                self._start(job)
 
-            if not (self._queued or self._running):
-                if self._debug:
-                    print("Job queue finished.")
-
-                for job in self._completed:
-                    job.join()
+            finished = [job for job in self._wait() if not job.is_alive()]
+            for job in finished:
+                self._reap(job)
 
-                self._finished = True
+            if self._debug:
+                print("Job queue has %d running." % len(self._running))
 
-            # Each loop pass, try pulling results off the queue to keep its
-            # size down. At this point, we don't actually care if any results
-            # have arrived yet; they will be picked up after the main loop.
+            # Pull results off the queue as they arrive, to keep its size down.
+            # Children send theirs before exiting, so this includes those of
+            # the jobs just finished.
             self._fill_results(results)
+            for job in finished:
+                yield job.name, self._result(job, results)
 
-            time.sleep(ssh.io_sleep)
-
-        # Consume anything left in the results queue. Note that there is no
-        # need to block here, as the main loop ensures that all workers will
-        # already have finished.
-        self._fill_results(results)
+        if self._debug:
+            print("Job queue finished: %r" % (self.stats(),))
 
-        # Attach exit codes now that we're all done & have joined all jobs
         for job in self._completed:
-            results[job.name]['exit_code'] = job.exitcode
+            job.join()
 
-        return results
+        self._finished = True
+
+    def _result(self, job, results):
+        """
+        Return finished ``job``'s entry in ``results``, with its exit code.
+        """
+        results[job.name]['exit_code'] = job.exitcode
+        # Pool jobs hand back their results themselves
+        if getattr(job, 'results', None):
+            results[job.name]['results'] = job.results[0]
+        return results[job.name]
 
     def _fill_results(self, results):
         """
@@ -192,6 +338,249 @@ class JobQueue(object):
                 break
 
 
+class _HashRing(object):
+    """
+    Consistent hash ring, mapping names onto members.
+
+    Each member owns ``replicas`` points on the ring, and a name belongs to the
+    member owning the first point at or after the name's own hash. Adding a
+    member thus only takes names over from its neighbours, leaving all others
+    where they were.
+    """
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self._points = []
+
+    def _hash(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def add(self, member):
+        for i in range(self.replicas):
+            point = (self._hash("%s-%s" % (member, i)), member)
+            bisect.insort(self._points, point)
+
+    def get(self, name):
+        if not self._points:
+            return None
+        i = bisect.bisect_left(self._points, (self._hash(name),))
+        return self._points[i % len(self._points)][1]
+
+
+def _release_sockets(keep):
+    """
+    Point every inherited socket, other than fd ``keep``, at ``/dev/null``.
+
+    Workers outlive whatever forked them, and would otherwise keep the parent's
+    connections and listening sockets open as long as they run. The file
+    descriptors stay taken, so that closing the parent's now stale socket
+    objects later on can't close something else opened since.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, min(os.sysconf('SC_OPEN_MAX'), 4096))
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in fds:
+            if fd < 3 or fd in (keep, devnull):
+                continue
+            try:
+                if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.dup2(devnull, fd)
+            except OSError:
+                pass
+    finally:
+        os.close(devnull)
+
+
+def _work(pool, conn, parent_conn):
+    """
+    Body of a `ProcessPool` worker: run jobs until told (or left) to stop.
+    """
+    # Other workers' pipes are none of our business, and holding on to them
+    # would keep those workers from noticing when we all should stop.
+    parent_conn.close()
+    for worker in pool._workers.values():
+        if worker is not None:
+            worker.conn.close()
+    _release_sockets(conn.fileno())
+    if pool._initializer:
+        pool._initializer()
+    while True:
+        try:
+            while not conn.poll(1):
+                if os.getppid() != pool.pid:
+                    return
+            job = pickle.loads(conn.recv_bytes())
+        except (EOFError, IOError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        exitcode, results = pool._target(*job)
+        try:
+            conn.send((exitcode, results))
+        except (pickle.PicklingError, TypeError), e:
+            sys.stderr.write("Could not send back results: %s\n" % e)
+            conn.send((exitcode or 1, []))
+
+
+class _Worker(object):
+    """
+    A `ProcessPool` worker process, and the jobs sent its way so far.
+    """
+    def __init__(self, pool, slot):
+        import multiprocessing
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_work,
+            args=(pool, child_conn, self.conn))
+        self.process.name = "fabric-worker-%d" % slot
+        self.process.start()
+        child_conn.close()
+        # Sent, but not yet finished; workers run jobs in the order received.
+        self.pending = []
+
+    def send(self, job):
+        self.conn.send_bytes(job.payload)
+        self.pending.append(job)
+
+    def collect(self):
+        """
+        Finish off any of our jobs which the worker is done with.
+        """
+        try:
+            while self.pending and self.conn.poll():
+                exitcode, results = self.conn.recv()
+                self.pending.pop(0)._finish(exitcode, results)
+        except (EOFError, IOError):
+            # The worker is gone, or about to be.
+            self.process.join()
+        if self.pending and not self.process.is_alive():
+            for job in self.pending:
+                job._finish(self.process.exitcode or 1, [])
+            self.pending = []
+
+    def stop(self):
+        try:
+            self.conn.send_bytes(pickle.dumps(None))
+        except IOError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+class ProcessPool(object):
+    """
+    Long-lived worker processes, each of which runs one job at a time.
+
+    Workers are forked as first needed and then kept until `close` is called,
+    calling ``initializer()`` once on startup and ``target(*job)`` for each job
+    sent their way, which must return an ``(exitcode, results)`` tuple.
+
+    Jobs go to workers according to their name, using a `_HashRing`, so that a
+    given host always ends up on the same worker -- and finds there whatever
+    state (e.g. connections) its earlier jobs left behind. Growing the pool
+    moves only those hosts which the new workers take over.
+    """
+    def __init__(self, target, initializer=None):
+        self._target = target
+        self._initializer = initializer
+        self._workers = {}
+        self._ring = _HashRing()
+        self.pid = os.getpid()
+
+    def __len__(self):
+        return len(self._workers)
+
+    def grow(self, size):
+        """
+        Make room for (at least) ``size`` workers.
+        """
+        for slot in range(len(self._workers), size):
+            self._workers[slot] = None
+            self._ring.add(slot)
+
+    def job(self, name, payload):
+        """
+        Return a `PoolJob` running pickled ``payload`` on ``name``'s worker.
+        """
+        return PoolJob(self, name, payload)
+
+    def _worker(self, name):
+        if not self._workers:
+            self.grow(1)
+        slot = self._ring.get(name)
+        worker = self._workers[slot]
+        if worker is None or not worker.process.is_alive():
+            if worker is not None:
+                worker.collect()
+            worker = self._workers[slot] = _Worker(self, slot)
+        return worker
+
+    def close(self):
+        """
+        Stop all workers, waiting for them to finish their current jobs.
+        """
+        if self.pid != os.getpid():
+            return
+        for worker in self._workers.values():
+            if worker is not None:
+                worker.stop()
+        self._workers = {}
+        self._ring = _HashRing()
+
+
+class PoolJob(object):
+    """
+    `JobQueue` item run by a `ProcessPool` worker, rather than its own process.
+
+    Looks enough like a ``multiprocessing.Process`` for `JobQueue`'s purposes,
+    but keeps the job's results in ``results`` instead of sending them down a
+    queue. Its ``sentinel``, the worker's pipe, becomes readable whenever the
+    worker finishes a job (not necessarily this one) or dies.
+    """
+    def __init__(self, pool, name, payload):
+        self.name = name
+        self.payload = payload
+        self.exitcode = None
+        self.results = []
+        self._pool = pool
+        self._worker = None
+
+    def start(self):
+        self._worker = self._pool._worker(self.name)
+        try:
+            self._worker.send(self)
+        except IOError, e:
+            sys.stderr.write("Could not hand %r to a worker: %s\n" % (
+                self.name, e))
+            self._finish(1, [])
+
+    @property
+    def sentinel(self):
+        if self._worker is not None:
+            return self._worker.conn
+
+    def is_alive(self):
+        if self.exitcode is None:
+            self._worker.collect()
+        return self.exitcode is None
+
+    def join(self):
+        while self.is_alive():
+            # Wakes up whenever the worker finishes a job, or dies.
+            try:
+                select.select([self.sentinel], [], [])
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def _finish(self, exitcode, results):
+        self.results = results
+        self.exitcode = exitcode
+
+
 #### Sample
 
 def try_using(parallel_type):
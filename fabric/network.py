@@ -4,22 +4,30 @@ Classes and subroutines dealing with network connections and related topics.
 
 from __future__ import with_statement
 
+from contextlib import contextmanager
 from functools import wraps
+import errno
 import getpass
 import os
+import random
 import re
+import select
+import shlex
 import time
 import socket
 import sys
+import threading
 
 from fabric.auth import get_password, set_password
 from fabric.utils import abort, handle_prompt_abort, warn
 from fabric.exceptions import NetworkError
+from fabric.thread_handling import run_concurrently
 
 try:
     import warnings
     warnings.simplefilter('ignore', DeprecationWarning)
     import paramiko as ssh
+    from paramiko.hostkeys import HostKeyEntry
 except ImportError, e:
     import traceback
     traceback.print_exc()
@@ -34,6 +42,13 @@ Please make sure all dependencies are installed and importable.
 ipv6_regex = re.compile('^\[?(?P<host>[0-9A-Fa-f:]+)\]?(:(?P<port>\d+))?$')
 
 
+class _PromptRequired(Exception):
+    """
+    Raised by `connect` when told not to prompt but a password is needed.
+    """
+    pass
+
+
 def direct_tcpip(client, host, port):
     return client.get_transport().open_channel(
         'direct-tcpip',
@@ -42,6 +57,408 @@ def direct_tcpip(client, host, port):
     )
 
 
+class _IndexedHostKeys(ssh.HostKeys):
+    """
+    `ssh.HostKeys` which finds a host's entries through an index.
+
+    The stock class checks every entry (hashing the hostname anew for each
+    hashed one) on every lookup, and every entry against all those before it
+    while loading, which adds up for known_hosts files with many thousands of
+    entries. Here plain hostnames are indexed at load time, and the matches
+    among hashed entries are remembered per hostname.
+    """
+    def __init__(self):
+        ssh.HostKeys.__init__(self)
+        self._plain = {}
+        self._hashed = []
+        self._found = {}
+        self._lock = threading.Lock()
+
+    def _index(self, entry):
+        for name in entry.hostnames:
+            if name.startswith('|1|'):
+                self._hashed.append((name, entry))
+            else:
+                self._plain.setdefault(name, []).append(entry)
+
+    def load(self, filename):
+        f = open(filename, 'r')
+        try:
+            for lineno, line in enumerate(f):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                # Skip unusable lines, as the stock class does.
+                try:
+                    entry = HostKeyEntry.from_line(line, lineno + 1)
+                except ssh.SSHException:
+                    continue
+                if entry is not None:
+                    self._entries.append(entry)
+                    self._index(entry)
+        finally:
+            f.close()
+        self._found.clear()
+
+    def add(self, hostname, keytype, key):
+        ssh.HostKeys.add(self, hostname, keytype, key)
+        self._plain[hostname] = [
+            e for e in self._entries if hostname in e.hostnames
+        ]
+        self._found.clear()
+
+    def lookup(self, hostname):
+        self._lock.acquire()
+        try:
+            entries = self._found.get(hostname)
+            if entries is None:
+                entries = list(self._plain.get(hostname, []))
+                for name, entry in self._hashed:
+                    if self.hash_host(hostname, name) == name:
+                        entries.append(entry)
+                self._found[hostname] = entries
+        finally:
+            self._lock.release()
+        if not entries:
+            return None
+        # Let the stock lookup build its usual result from just these.
+        subset = ssh.HostKeys()
+        subset._entries = list(entries)
+        return subset.lookup(hostname)
+
+
+class _HostKeyStore(object):
+    """
+    Parsed known_hosts files, shared by every connection in this process.
+
+    A set of files is parsed again only once one of them changes (going by
+    its mtime and size.)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _stamp(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def get(self, filenames):
+        """
+        Return an `_IndexedHostKeys` holding the keys in ``filenames``.
+        """
+        filenames = tuple(filenames)
+        stamps = tuple(map(self._stamp, filenames))
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(filenames)
+            if cached is None or cached[0] != stamps:
+                keys = _IndexedHostKeys()
+                for filename in filenames:
+                    keys.load(filename)
+                cached = self._cache[filenames] = (stamps, keys)
+            return cached[1]
+        finally:
+            self._lock.release()
+
+
+_host_keys = _HostKeyStore()
+
+
+class _KeyStore(object):
+    """
+    Private keys loaded from disk, shared by every connection in this process.
+
+    A key file is read (and decrypted, if need be) again only once it changes,
+    going by its mtime and size.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _load(self, filename, password):
+        classes = [ssh.RSAKey, ssh.DSSKey]
+        # Only newer Paramikos know about ECDSA keys
+        if hasattr(ssh, 'ECDSAKey'):
+            classes.append(ssh.ECDSAKey)
+        for cls in classes:
+            try:
+                return cls.from_private_key_file(filename, password)
+            except ssh.PasswordRequiredException:
+                return None
+            except (ssh.SSHException, IOError):
+                continue
+        return None
+
+    def get(self, filename, password=None):
+        """
+        Return the `ssh.PKey` in ``filename``, or None if it can't be loaded.
+
+        ``password`` is used to decrypt the key if needed.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        stamp = (st.st_mtime, st.st_size)
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(filename)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        finally:
+            self._lock.release()
+        # Failures aren't remembered: a later password may decrypt the key.
+        key = self._load(filename, password)
+        if key is not None:
+            self._lock.acquire()
+            try:
+                self._cache[filename] = (stamp, key)
+            finally:
+                self._lock.release()
+        return key
+
+    def split(self, filenames, password=None):
+        """
+        Return ``(pkey, filenames)`` to hand to ``SSHClient.connect()``.
+
+        Paramiko takes just one ready-made key, which is tried before any key
+        files, so that's the first of ``filenames`` we can load; the rest are
+        left for Paramiko to load as usual.
+        """
+        for i, filename in enumerate(filenames):
+            key = self.get(filename, password)
+            if key is not None:
+                return key, filenames[:i] + filenames[i + 1:]
+        return None, filenames
+
+
+_keys = _KeyStore()
+
+
+def _gateway_hops(gateway):
+    """
+    Return ``env.gateway`` as a tuple of normalized host strings, outermost
+    first.
+    """
+    if isinstance(gateway, basestring):
+        gateway = gateway.split(',')
+    return tuple(normalize_to_string(h.strip()) for h in gateway)
+
+
+def _native_jump(conf, user, host, port):
+    """
+    Return ``(hops, host, port)`` if ssh_config ``conf`` merely bounces off
+    other hosts on the way to ``user@host:port``, else None.
+
+    Understands ``ProxyJump`` as well as the usual ``ProxyCommand`` spellings
+    of it, ``ssh -W %h:%p jumphost`` and ``ssh jumphost nc %h %p``, so that
+    these may go through a shared gateway connection rather than a new ``ssh``
+    process (and login) per host. Anything else is left to `ssh.ProxyCommand`.
+    """
+    jump = conf.get('proxyjump')
+    if jump:
+        if jump.lower() == 'none':
+            return None
+        return jump.split(','), host, port
+    command = conf.get('proxycommand')
+    if not command:
+        return None
+    tokens = (('%h', host), ('%p', str(port)), ('%r', user), ('%%', '%'))
+    for token, value in tokens:
+        command = command.replace(token, value)
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if not argv or os.path.basename(argv[0]) != 'ssh':
+        return None
+    jump_user = jump_port = target = jump = None
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in ('-q', '-T'):
+            continue
+        elif arg == '-W':
+            target = next(args, None)
+        elif arg == '-l':
+            jump_user = next(args, None)
+        elif arg == '-p':
+            jump_port = next(args, None)
+        elif arg.startswith('-'):
+            return None
+        else:
+            jump = arg
+            rest = list(args)
+            if rest and rest[0] in ('nc', 'netcat') and len(rest) == 3:
+                target = '%s:%s' % (rest[1], rest[2])
+            elif rest:
+                return None
+    if not (jump and target) or ':' not in target:
+        return None
+    target_host, target_port = target.rsplit(':', 1)
+    target_host = target_host.strip('[]')
+    if jump_user and '@' not in jump:
+        jump = '%s@%s' % (jump_user, jump)
+    if jump_port:
+        jump = '%s:%s' % (jump, jump_port)
+    return [jump], target_host, target_port
+
+
+def _outer_hops(hops):
+    """
+    Return gateway ``hops`` preceded by whichever hosts ssh_config has the
+    first of them reached through (see `_native_jump`), recursively.
+    """
+    from fabric.state import env
+    while env.native_proxy_jump:
+        user, host, port = normalize(hops[0])
+        jump = _native_jump(ssh_config(hops[0]), user, host, port)
+        # Bouncing elsewhere than the hop itself is left to its ProxyCommand.
+        if jump is None or (jump[1], str(jump[2])) != (host, str(port)):
+            break
+        outer = _gateway_hops(jump[0])
+        if set(outer) & set(hops):
+            break
+        hops = outer + hops
+    return hops
+
+
+class _GatewayPool(object):
+    """
+    Connections to one gateway host, over which target connections are made.
+
+    Up to ``env.gateway_pool_size`` connections are opened to the gateway, each
+    carrying at most ``env.gateway_channel_limit`` channels (if set), and each
+    new channel goes over whichever connection has the fewest open. The
+    gateway is itself reached through ``via``, another `_GatewayPool`, when
+    gateways are chained.
+    """
+    def __init__(self, host_string, via=None):
+        self.host_string = host_string
+        self.via = via
+        self.clients = []
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def _load(self, client):
+        channels = self._channels[client]
+        channels[:] = [c for c in channels if c is None or not c.closed]
+        return len(channels)
+
+    def _connect(self):
+        from fabric.state import output
+        if output.debug:
+            print "Creating new gateway connection to %r" % self.host_string
+        user, host, port = normalize(self.host_string)
+        sock = None
+        if self.via is not None:
+            sock = self.via.open_channel(host, port)
+        else:
+            # Proxies which _outer_hops() couldn't turn into more gateways
+            command = ssh_config(self.host_string).get('proxycommand')
+            if command:
+                sock = ssh.ProxyCommand(command)
+        return connect(user, host, port, sock, host_string=self.host_string)
+
+    def _pick(self):
+        """
+        Return the client the next channel should go over, connecting if need be.
+        """
+        from fabric.state import env
+        size = env.gateway_pool_size or 1
+        limit = env.gateway_channel_limit
+        # Forget connections which have gone away
+        for client in self.clients[:]:
+            transport = client.get_transport()
+            if transport is None or not transport.is_active():
+                self.clients.remove(client)
+                del self._channels[client]
+        loads = sorted((self._load(c), i) for i, c in enumerate(self.clients))
+        least = loads[0][0] if loads else None
+        if least is None or (least and len(self.clients) < size):
+            client = self._connect()
+            self.clients.append(client)
+            self._channels[client] = []
+            return client
+        if limit and least >= limit:
+            raise NetworkError(
+                "Gateway %s has no room for more channels (%d connections,"
+                " env.gateway_channel_limit is %d)"
+                % (self.host_string, len(self.clients), limit)
+            )
+        return self.clients[loads[0][1]]
+
+    def warm(self):
+        """
+        Ensure at least one connection to the gateway is open.
+        """
+        self._lock.acquire()
+        try:
+            if not self.clients:
+                self._pick()
+        finally:
+            self._lock.release()
+
+    def open_channel(self, host, port):
+        """
+        Return a direct-tcpip channel to ``host``/``port`` via the gateway.
+        """
+        self._lock.acquire()
+        try:
+            client = self._pick()
+            # Counts towards the load while being opened
+            self._channels[client].append(None)
+        finally:
+            self._lock.release()
+        channel = None
+        try:
+            channel = direct_tcpip(client, host, port)
+            return channel
+        finally:
+            self._lock.acquire()
+            try:
+                channels = self._channels.get(client)
+                if channels is not None:
+                    channels.remove(None)
+                    if channel is not None:
+                        channels.append(channel)
+            finally:
+                self._lock.release()
+
+    def stats(self):
+        """
+        Return the number of open channels on each connection to the gateway.
+        """
+        self._lock.acquire()
+        try:
+            return [self._load(c) for c in self.clients]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+            self._channels = {}
+        finally:
+            self._lock.release()
+
+
+def _is_active(client):
+    """
+    Return whether ``client``'s transport is still up.
+
+    With :ref:`env.keepalive <keepalive>` set, a transport notices a dead link
+    on its own, at the latest one keepalive interval later.
+    """
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
 class HostConnectionCache(dict):
     """
     Dict subclass allowing for caching of host connections/clients.
@@ -75,59 +492,378 @@ class HostConnectionCache(dict):
     The same applies to ports: specifying two different ports will result in
     two different connections to the same host being made. If no port is given,
     22 is assumed, so ``example.com`` is equivalent to ``example.com:22``.
+
+    By default connections are kept until `disconnect_all` is called. Setting
+    :ref:`env.connection_cache_size <connection-cache-size>` caps how many are
+    kept open, closing the least recently used ones to make room for new ones;
+    setting :ref:`env.connection_idle_timeout <connection-idle-timeout>` has a
+    background thread close those left unused for that many seconds. Neither
+    ever closes the connection for the current ``env.host_string``, nor those
+    marked with `in_use` (as `~fabric.tasks.execute` does for each host while
+    running a task on it, in whichever thread.)
+    `stats` reports how well the cache is doing.
+
+    Connections to :ref:`gateways <gateway>` are kept apart from the above, by
+    `gateway`.
     """
-    def connect(self, key):
+    def __init__(self, *args, **kwargs):
+        super(HostConnectionCache, self).__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        self._used = {}
+        self._in_use = {}
+        self._reaper = None
+        self._reaper_pid = None
+        self._gateways = {}
+        self._gateways_pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.reconnects = 0
+
+    def connect(self, key, prompt=True):
         """
         Force a new connection to ``key`` host string.
+
+        With ``prompt=False`` the connection is made without asking the user
+        for anything; see `connect`.
         """
-        from fabric.state import env, output
+        self[key] = self._open(key, prompt)
+
+    def _open(self, key, prompt=True):
+        """
+        Return a new connection to ``key``, without caching it.
+        """
+        from fabric.state import env
+        host_string = None if prompt else key
         user, host, port = normalize(key)
-        key = normalize_to_string(key)
         sock = None
-        proxy_command = ssh_config().get('proxycommand', None)
+        # Go by the host being connected to, which when prewarming isn't the
+        # current one.
+        conf = ssh_config(host_string)
+        proxy_command = conf.get('proxycommand', None)
+        jump = None
+        if env.native_proxy_jump:
+            jump = _native_jump(conf, user, host, port)
         if env.gateway:
-            gateway = normalize_to_string(env.gateway)
-            # Ensure initial gateway connection
-            if gateway not in self:
-                if output.debug:
-                    print "Creating new gateway connection to %r" % gateway
-                self[gateway] = connect(*normalize(gateway))
-            # Now we should have an open gw connection and can ask it for a
-            # direct-tcpip channel to the real target. (Bypass our own
-            # __getitem__ override to avoid hilarity.)
-            sock = direct_tcpip(dict.__getitem__(self, gateway), host, port)
+            # Ask the gateway for a direct-tcpip channel to the real target.
+            sock = self.gateway().open_channel(host, port)
+        elif jump is not None:
+            hops, jump_host, jump_port = jump
+            sock = self.gateway(hops).open_channel(jump_host, jump_port)
         elif proxy_command:
             sock = ssh.ProxyCommand(proxy_command)
-        self[key] = connect(user, host, port, sock)
+        return connect(user, host, port, sock, host_string=host_string,
+            prompt=prompt)
+
+    def _keep(self, key, client):
+        """
+        Cache new connection ``client`` to ``key``, and return it.
+
+        Connections are made without holding the lock, so another thread may
+        have connected to the same host meanwhile; if so, that connection wins
+        and ``client`` is closed.
+        """
+        key = normalize_to_string(key)
+        self._lock.acquire()
+        try:
+            if dict.__contains__(self, key):
+                client.close()
+            else:
+                self[key] = client
+            self._used[key] = time.time()
+            return dict.__getitem__(self, key)
+        finally:
+            self._lock.release()
+
+    def prewarm(self, hosts, size=16):
+        """
+        Concurrently connect to each of ``hosts`` not already connected.
+
+        Up to ``size`` connections are attempted at once. Hosts needing a
+        password which isn't known yet are left alone, to be connected (and
+        prompted for) later on as usual.
+
+        Returns a dict mapping the normalized host string (see
+        `normalize_to_string`) of each host which could not be connected to
+        the `~fabric.exceptions.NetworkError` describing why.
+        """
+        from fabric.state import env, output
+        # The gateway is shared by every connection, so set it up first (and
+        # here, where it may prompt for a password.)
+        if env.gateway:
+            self.gateway().warm()
+        # Don't open more connections than the cache would keep.
+        limit = env.connection_cache_size or len(hosts)
+        pending = []
+        seen = set()
+        for host, normalized in zip(hosts, normalize_many(hosts)):
+            key = join_host_strings(*normalized)
+            if key not in self and key not in seen and len(seen) < limit:
+                seen.add(key)
+                pending.append(host)
+        failures = {}
+
+        def attempt(host):
+            try:
+                self._keep(host, self._open(host, prompt=False))
+            except _PromptRequired:
+                if output.debug:
+                    print "Deferring connection to %r" % host
+            except NetworkError, e:
+                failures[normalize_to_string(host)] = e
+
+        run_concurrently('prewarm', attempt, pending, size)
+        return failures
+
+    def gateway(self, hops=None):
+        """
+        Return the `_GatewayPool` for ``hops``, or the current ``env.gateway``.
+
+        Either may name several gateways, each reached through the one before
+        it, as a list or comma-separated string. The first of them is itself
+        reached through whatever proxy ssh_config gives for it.
+        """
+        from fabric.state import env
+        hops = _outer_hops(_gateway_hops(hops or env.gateway))
+        self._lock.acquire()
+        try:
+            self._forget_inherited_gateways()
+            pool = None
+            for i in range(len(hops)):
+                key = hops[:i + 1]
+                if key not in self._gateways:
+                    self._gateways[key] = _GatewayPool(hops[i], pool)
+                pool = self._gateways[key]
+            return pool
+        finally:
+            self._lock.release()
+
+    def _forget_inherited_gateways(self):
+        # Connections don't survive fork(), so a new process starts over
+        # (leaving the parent's connections alone.)
+        if self._gateways_pid != os.getpid():
+            self._gateways_pid = os.getpid()
+            self._gateways = {}
+
+    def pop_gateways(self):
+        """
+        Remove and return every `_GatewayPool`, innermost gateways first.
+        """
+        self._lock.acquire()
+        try:
+            self._forget_inherited_gateways()
+            keys = sorted(self._gateways, key=len, reverse=True)
+            pools = [self._gateways.pop(key) for key in keys]
+        finally:
+            self._lock.release()
+        return pools
+
+    def stats(self):
+        """
+        Return a dict of counters describing the cache's use so far.
+        """
+        from fabric.state import env
+        self._lock.acquire()
+        try:
+            return {
+                'size': env.connection_cache_size,
+                'open': len(self),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'reconnects': self.reconnects,
+            }
+        finally:
+            self._lock.release()
+
+    def reap(self):
+        """
+        Close connections unused for longer than ``env.connection_idle_timeout``.
+        """
+        from fabric.state import env
+        timeout = env.connection_idle_timeout
+        if not timeout:
+            return
+        cutoff = time.time() - timeout
+        self._lock.acquire()
+        try:
+            pinned = self._pinned()
+            for key, used in self._used.items():
+                if used < cutoff and key not in pinned:
+                    self._evict(key)
+                    self.expirations += 1
+        finally:
+            self._lock.release()
+
+    def _reap_loop(self):
+        from fabric.state import env
+        while env.connection_idle_timeout:
+            time.sleep(max(1, env.connection_idle_timeout / 2.0))
+            self.reap()
+
+    def _start_reaper(self):
+        from fabric.state import env
+        if not env.connection_idle_timeout:
+            return
+        # Threads don't survive fork(), so check we started this one.
+        if (self._reaper is None or not self._reaper.is_alive()
+            or self._reaper_pid != os.getpid()):
+            self._reaper_pid = os.getpid()
+            # A thread of its own, rather than one of the shared I/O pool's
+            # for good. Being new, it goes by the shared env rather than that
+            # of whichever (e.g. parallel task) thread happened to start it.
+            self._reaper = threading.Thread(None, self._reap_loop,
+                "fabric-reaper")
+            self._reaper.setDaemon(True)
+            self._reaper.start()
+
+    @contextmanager
+    def in_use(self, host_string):
+        """
+        Keep the connection to ``host_string`` open for the duration.
+
+        Unlike going by ``env.host_string``, this holds for every thread, so
+        e.g. a parallel task thread's connection isn't closed mid-command to
+        make room for another thread's.
+        """
+        key = normalize_to_string(host_string)
+        self._lock.acquire()
+        try:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        finally:
+            self._lock.release()
+        try:
+            yield
+        finally:
+            self._lock.acquire()
+            try:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+            finally:
+                self._lock.release()
+
+    def _pinned(self):
+        """
+        Return the keys of connections which must not be closed behind our back.
+        """
+        from fabric.state import env
+        keys = set(self._in_use)
+        if env.host_string:
+            keys.add(normalize_to_string(env.host_string))
+        return keys
+
+    def _make_room(self):
+        from fabric.state import env
+        limit = env.connection_cache_size
+        if not limit or len(self) < limit:
+            return
+        pinned = self._pinned()
+        candidates = sorted(
+            (used, key) for key, used in self._used.items()
+            if key not in pinned
+        )
+        while len(self) >= limit and candidates:
+            self._evict(candidates.pop(0)[1])
+            self.evictions += 1
+
+    def _evict(self, key):
+        from fabric.state import sessions, output
+        if output.debug:
+            print "Closing cached connection to %r" % key
+        client = dict.pop(self, key)
+        self._used.pop(key, None)
+        # A persistent shell goes away along with its connection
+        session = sessions.pop(key, None)
+        if session is not None:
+            session.close()
+        client.close()
 
     def __getitem__(self, key):
         """
         Autoconnect + return connection object
+
+        Cached connections whose transport has died are replaced by new ones.
         """
+        from fabric.state import output
         key = normalize_to_string(key)
-        if key not in self:
-            self.connect(key)
-        return dict.__getitem__(self, key)
+        self._lock.acquire()
+        try:
+            hit = key in self
+            if hit and not _is_active(dict.__getitem__(self, key)):
+                # Dropped by e.g. a NAT timeout or an sshd restart, so replace
+                # it rather than failing whatever was about to use it.
+                if output.debug:
+                    print "Connection to %r went away, reconnecting" % key
+                self._evict(key)
+                self.reconnects += 1
+                hit = False
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+        # Connect without holding the lock, so that others (e.g. prewarm())
+        # may do so at the same time.
+        if not hit:
+            return self._keep(key, self._open(key))
+        self._lock.acquire()
+        try:
+            self._used[key] = time.time()
+            return dict.__getitem__(self, key)
+        finally:
+            self._lock.release()
 
     #
     # Dict overrides that normalize input keys
     #
 
     def __setitem__(self, key, value):
-        return dict.__setitem__(self, normalize_to_string(key), value)
+        key = normalize_to_string(key)
+        self._lock.acquire()
+        try:
+            if key not in self:
+                self._make_room()
+            dict.__setitem__(self, key, value)
+            self._used[key] = time.time()
+        finally:
+            self._lock.release()
+        self._start_reaper()
 
     def __delitem__(self, key):
-        return dict.__delitem__(self, normalize_to_string(key))
+        key = normalize_to_string(key)
+        self._lock.acquire()
+        try:
+            self._used.pop(key, None)
+            return dict.__delitem__(self, key)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, *args):
+        key = normalize_to_string(key)
+        self._lock.acquire()
+        try:
+            self._used.pop(key, None)
+            return dict.pop(self, key, *args)
+        finally:
+            self._lock.release()
 
     def __contains__(self, key):
         return dict.__contains__(self, normalize_to_string(key))
 
 
+# Per-host ssh_config() results, for the SSH config stored under 'conf'
+_ssh_config_lookups = {}
+
+
 def ssh_config(host_string=None):
     """
     Return ssh configuration dict for current env.host_string host value.
 
-    Memoizes the loaded SSH config file, but not the specific per-host results.
+    Memoizes the loaded SSH config file, and the per-host results from it.
 
     This function performs the necessary "is SSH config enabled?" checks and
     will simply return an empty dict if not. If SSH config *is* enabled and the
@@ -150,16 +886,25 @@ def ssh_config(host_string=None):
             warn("Unable to load SSH config file '%s'" % path)
             return dummy
     host = parse_host_string(host_string or env.host_string)['host']
-    return env._ssh_config.lookup(host)
+    conf = env._ssh_config
+    if conf is not _ssh_config_lookups.get('conf'):
+        _ssh_config_lookups.clear()
+        _ssh_config_lookups['conf'] = conf
+    key = ('host', host)
+    if key not in _ssh_config_lookups:
+        _ssh_config_lookups[key] = conf.lookup(host)
+    return _ssh_config_lookups[key]
 
 
-def key_filenames():
+def key_filenames(host_string=None):
     """
     Returns list of SSH key filenames for the current env.host_string.
 
     Takes into account ssh_config and env.key_filename, including normalization
     to a list. Also performs ``os.path.expanduser`` expansion on any key
     filenames.
+
+    May give an explicit host string as ``host_string``.
     """
     from fabric.state import env
     keys = env.key_filename
@@ -169,7 +914,7 @@ def key_filenames():
     # Strip out any empty strings (such as the default value...meh)
     keys = filter(bool, keys)
     # Honor SSH config
-    conf = ssh_config()
+    conf = ssh_config(host_string)
     if 'identityfile' in conf:
         # Assume a list here as we require Paramiko 1.10+
         keys.extend(conf['identityfile'])
@@ -198,6 +943,23 @@ def parse_host_string(host_string):
     return {'user': user, 'host': host, 'port': port}
 
 
+# normalize() results, keyed on the host string plus the env values they
+# depend on (see _normalize_env), and cleared when it gets this big.
+_normalized = {}
+_NORMALIZED_MAX = 10000
+
+
+def _normalize_env():
+    """
+    Return the env values which `normalize` results depend upon.
+    """
+    from fabric.state import env
+    conf = None
+    if env.use_ssh_config:
+        conf = (env.ssh_config_path, env.get('_ssh_config'))
+    return (env.user, env.local_user, env.port, env.default_port, conf)
+
+
 def normalize(host_string, omit_port=False):
     """
     Normalizes a given host string, returning explicit host, user, port.
@@ -207,11 +969,41 @@ def normalize(host_string, omit_port=False):
     This function will process SSH config files if Fabric is configured to do
     so, and will use them to fill in some default values or swap in hostname
     aliases.
+
+    Results are memoized for as long as the env values they came from (user,
+    port, SSH config) stay the same.
     """
-    from fabric.state import env
+    return _normalize(host_string, omit_port, _normalize_env())
+
+
+def normalize_many(host_strings, omit_port=False):
+    """
+    Return a list of `normalize` results, one for each of ``host_strings``.
+
+    Cheaper than calling `normalize` on each of a long list of hosts.
+    """
+    key = _normalize_env()
+    return [_normalize(h, omit_port, key) for h in host_strings]
+
+
+def _normalize(host_string, omit_port, key):
     # Gracefully handle "empty" input by returning empty output
     if not host_string:
         return ('', '') if omit_port else ('', '', '')
+    result = _normalized.get((host_string, key))
+    if result is None:
+        result = _normalize_uncached(host_string)
+        if len(_normalized) >= _NORMALIZED_MAX:
+            _normalized.clear()
+        # Key on the env as it is now, since loading SSH config changes it
+        _normalized[(host_string, _normalize_env())] = result
+    if omit_port:
+        return result[:2]
+    return result
+
+
+def _normalize_uncached(host_string):
+    from fabric.state import env
     # Parse host string (need this early on to look up host-specific ssh_config
     # values)
     r = parse_host_string(host_string)
@@ -236,8 +1028,6 @@ def normalize(host_string, omit_port=False):
     # (Host is already done at this point.)
     user = r['user'] or user
     port = r['port'] or port
-    if omit_port:
-        return user, host
     return user, host, port
 
 
@@ -300,12 +1090,212 @@ def normalize_to_string(host_string):
     return join_host_strings(*normalize(host_string))
 
 
-def connect(user, host, port, sock=None):
+class RetryPolicy(object):
+    """
+    Decides whether, and when, `connect` tries again after a socket error.
+
+    The default policy, used unless :ref:`env.connection_retry_policy
+    <connection-retry-policy>` is set, gives up after
+    :ref:`env.connection_attempts <connection-attempts>` attempts or once
+    :ref:`env.connection_deadline <connection-deadline>` seconds have passed.
+    Timed-out attempts, having already waited :ref:`env.timeout <timeout>`, are
+    retried straight away; after other errors (e.g. connection refused) it
+    waits a random time of up to :ref:`env.connection_backoff
+    <connection-backoff>` seconds, doubling that limit after each attempt up to
+    ``env.timeout``, so that many clients don't all retry at once.
+
+    Other policies need only provide `delay`.
+    """
+    def delay(self, tries, elapsed, error):
+        """
+        Return how long to wait before retrying, or None to give up.
+
+        ``tries`` is the number of attempts made so far, ``elapsed`` the
+        seconds since the first one started, and ``error`` the
+        ``socket.error`` the latest one failed with.
+        """
+        from fabric.state import env
+        if tries >= env.connection_attempts:
+            return None
+        if type(error) is socket.timeout:
+            wait = 0
+        else:
+            limit = env.connection_backoff * 2 ** (tries - 1)
+            wait = random.uniform(0, min(limit, env.timeout))
+        if env.connection_deadline is not None:
+            remaining = env.connection_deadline - elapsed
+            if remaining <= 0:
+                return None
+            wait = min(wait, remaining)
+        return wait
+
+
+class _Resolver(object):
+    """
+    Host name lookups, remembered for ``env.dns_cache_ttl`` seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def resolve(self, host, port):
+        """
+        Return ``socket.getaddrinfo`` results for connecting to ``host``/``port``.
+        """
+        from fabric.state import env
+        key = (host, int(port))
+        now = time.time()
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(key)
+        finally:
+            self._lock.release()
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        addresses = socket.getaddrinfo(host, int(port), socket.AF_UNSPEC,
+            socket.SOCK_STREAM)
+        if env.dns_cache_ttl:
+            self._lock.acquire()
+            try:
+                self._cache[key] = (now + env.dns_cache_ttl, addresses)
+            finally:
+                self._lock.release()
+        return addresses
+
+    def resolve_many(self, hosts, size=16):
+        """
+        Concurrently look up each of ``hosts`` (host strings), so that later
+        connections to them needn't wait on DNS. Failures are ignored here;
+        they'll come up again when connecting.
+        """
+        def attempt(host_string):
+            user, host, port = normalize(host_string)
+            try:
+                self.resolve(host, port)
+            except socket.error:
+                pass
+        run_concurrently('resolve', attempt, hosts, size)
+
+
+_resolver = _Resolver()
+
+_IN_PROGRESS = set(
+    getattr(errno, name) for name in
+    ('EINPROGRESS', 'EWOULDBLOCK', 'EALREADY', 'WSAEWOULDBLOCK')
+    if hasattr(errno, name)
+)
+
+# How long one connection attempt gets before the next address is also tried
+_ATTEMPT_DELAY = 0.25
+
+
+def _interleave(addresses):
+    """
+    Order ``getaddrinfo`` results so that address families alternate, starting
+    with the first one given (RFC 8305 section 4.)
+    """
+    families = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+        by_family[address[0]].append(address)
+    ordered = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+
+def _open_socket(host, port, timeout):
+    """
+    Return a socket connected to ``host``/``port``, within ``timeout`` seconds.
+
+    Finding out whether anything is listening this way is much quicker than
+    starting an SSH handshake, and the socket can then be used for one.
+
+    The host's addresses are tried "happy eyeballs" style (RFC 8305): if the
+    first (e.g. IPv6) hasn't connected within a quarter second, the next (e.g.
+    IPv4) is tried alongside it, and so on, and whichever connects first wins.
+    So an unreachable address family doesn't cost a whole ``timeout``.
+
+    A ``timeout`` of ``None`` waits for as long as connecting takes.
+    """
+    addresses = _interleave(_resolver.resolve(host, port))
+    error = socket.error("No addresses found for %s" % host)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    pending = {}
+    winner = None
+    next_attempt = 0
+    try:
+        while addresses or pending:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            if addresses and now >= next_attempt:
+                family, socktype, proto, _, address = addresses.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                code = sock.connect_ex(address)
+                if code == 0:
+                    winner = sock
+                    break
+                elif code in _IN_PROGRESS:
+                    pending[sock] = address
+                    next_attempt = now + _ATTEMPT_DELAY
+                else:
+                    sock.close()
+                    error = socket.error(code, os.strerror(code))
+                    next_attempt = 0
+                continue
+            wait = None
+            if deadline is not None:
+                wait = deadline - now
+            if addresses:
+                delay = next_attempt - now
+                wait = delay if wait is None else min(wait, delay)
+            writable = select.select([], pending.keys(), [], wait)[1]
+            for sock in writable:
+                del pending[sock]
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    winner = sock
+                    break
+                sock.close()
+                error = socket.error(code, os.strerror(code))
+                # No need to wait before trying the next address
+                next_attempt = 0
+            if winner is not None:
+                break
+    finally:
+        for sock in pending:
+            sock.close()
+    if winner is not None:
+        winner.setblocking(1)
+        winner.settimeout(timeout)
+        return winner
+    if deadline is not None and time.time() >= deadline:
+        raise socket.timeout("timed out")
+    raise error
+
+
+def connect(user, host, port, sock=None, host_string=None, prompt=True):
     """
     Create and return a new SSHClient instance connected to given host.
 
     If ``sock`` is given, it's passed into ``SSHClient.connect()`` directly.
     Used for gateway connections by e.g. ``HostConnectionCache``.
+
+    ``host_string`` is the key under which to look up a password in
+    ``env.passwords`` and identity files in ssh_config, defaulting to
+    ``env.host_string``. With
+    ``prompt=False``, an authentication failure raises `_PromptRequired`
+    instead of prompting for a new password; this lets connections be made
+    from background threads.
     """
     from state import env, output
 
@@ -317,13 +1307,21 @@ def connect(user, host, port, sock=None):
     client = ssh.SSHClient()
 
     # Load system hosts file (e.g. /etc/ssh/ssh_known_hosts)
+    filenames = []
     known_hosts = env.get('system_known_hosts')
     if known_hosts:
-        client.load_system_host_keys(known_hosts)
+        filenames.append(known_hosts)
 
     # Load known host keys (e.g. ~/.ssh/known_hosts) unless user says not to.
     if not env.disable_known_hosts:
-        client.load_system_host_keys()
+        user_known_hosts = os.path.expanduser('~/.ssh/known_hosts')
+        if os.path.exists(user_known_hosts):
+            filenames.append(user_known_hosts)
+
+    # These are parsed once and shared with every other connection, rather
+    # than via client.load_system_host_keys() for each one.
+    if filenames:
+        client._system_host_keys = _host_keys.get(filenames)
     # Unless user specified not to, accept/add new, unknown host keys
     if not env.reject_unknown_hosts:
         client.set_missing_host_key_policy(ssh.AutoAddPolicy())
@@ -334,24 +1332,31 @@ def connect(user, host, port, sock=None):
 
     # Initialize loop variables
     connected = False
-    password = get_password()
+    password = get_password(host_string)
     tries = 0
+    started = time.time()
+    policy = env.connection_retry_policy or RetryPolicy()
 
     # Loop until successful connect (keep prompting for new password)
     while not connected:
+        attempt_sock = sock
         # Attempt connection
         try:
             tries += 1
+            if sock is None:
+                attempt_sock = _open_socket(host, port, env.timeout)
+            pkey, key_files = _keys.split(key_filenames(host_string), password)
             client.connect(
                 hostname=host,
                 port=int(port),
                 username=user,
                 password=password,
-                key_filename=key_filenames(),
+                pkey=pkey,
+                key_filename=key_files,
                 timeout=env.timeout,
                 allow_agent=not env.no_agent,
                 look_for_keys=not env.no_keys,
-                sock=sock
+                sock=attempt_sock
             )
             connected = True
 
@@ -388,6 +1393,8 @@ def connect(user, host, port, sock=None):
 
             # Otherwise, assume an auth exception, and prompt for new/better
             # password.
+            if not prompt:
+                raise _PromptRequired(msg)
 
             # Paramiko doesn't handle prompting for locked private
             # keys (i.e.  keys with a passphrase and not loaded into an agent)
@@ -431,7 +1438,8 @@ def connect(user, host, port, sock=None):
         # NOTE: In 2.6, socket.error subclasses IOError
         except socket.error, e:
             not_timeout = type(e) is not socket.timeout
-            giving_up = tries >= env.connection_attempts
+            wait = policy.delay(tries, time.time() - started, e)
+            giving_up = wait is None
             # Baseline error msg for when debug is off
             msg = "Timed out trying to connect to %s" % host
             # Expanded for debug on
@@ -444,10 +1452,7 @@ def connect(user, host, port, sock=None):
                 sys.stderr.write(err + '\n')
             # Having said our piece, try again
             if not giving_up:
-                # Sleep if it wasn't a timeout, so we still get timeout-like
-                # behavior
-                if not_timeout:
-                    time.sleep(env.timeout)
+                time.sleep(wait)
                 continue
             # Override eror msg if we were retrying other errors
             if not_timeout:
@@ -456,12 +1461,14 @@ def connect(user, host, port, sock=None):
                 )
             # Here, all attempts failed. Tweak error msg to show # tries.
             # TODO: find good humanization module, jeez
-            s = "s" if env.connection_attempts > 1 else ""
-            msg += " (tried %s time%s)" % (env.connection_attempts, s)
+            s = "s" if tries > 1 else ""
+            msg += " (tried %s time%s)" % (tries, s)
             raise NetworkError(msg, e)
         # Ensure that if we terminated without connecting and we were given an
-        # explicit socket, close it out.
+        # explicit socket, close it out. (As well as any we opened ourselves.)
         finally:
+            if not connected and attempt_sock is not None:
+                attempt_sock.close()
             if not connected and sock is not None:
                 sock.close()
 
@@ -537,6 +1544,25 @@ def needs_host(func):
     return host_prompting_wrapper
 
 
+def resolve_hosts(hosts):
+    """
+    Look up the addresses of all of ``hosts`` at once, ahead of connecting.
+
+    Used by `~fabric.tasks.execute` on each task's host list; lookups are
+    remembered for :ref:`env.dns_cache_ttl <dns-cache-ttl>` seconds. Hosts
+    with a ``ProxyCommand`` or ``ProxyJump`` in ssh_config are skipped, as
+    their names may well only resolve on the far side of the proxy.
+    """
+    from fabric.state import connections
+    def proxied(host):
+        conf = ssh_config(host)
+        return ('proxycommand' in conf
+            or conf.get('proxyjump', 'none').lower() != 'none')
+    _resolver.resolve_many([
+        h for h in hosts if h not in connections and not proxied(h)
+    ])
+
+
 def disconnect_all():
     """
     Disconnect from all currently connected servers.
@@ -544,14 +1570,26 @@ def disconnect_all():
     Used at the end of ``fab``'s main loop, and also intended for use by
     library users.
     """
-    from fabric.state import connections, output
+    from fabric.state import connections, sessions, output
+    # Persistent shells go away along with their connections
+    sessions.clear()
     # Explicitly disconnect from all servers
     for key in connections.keys():
         if output.status:
             # Here we can't use the py3k print(x, end=" ")
             # because 2.5 backwards compatibility
             sys.stdout.write("Disconnecting from %s... " % denormalize(key))
-        connections[key].close()
-        del connections[key]
+        # The idle connection reaper may have beaten us to it
+        client = connections.pop(key, None)
+        if client is not None:
+            client.close()
+        if output.status:
+            sys.stdout.write("done.\n")
+    for pool in connections.pop_gateways():
+        if output.status:
+            sys.stdout.write("Disconnecting from gateway %s... " % (
+                denormalize(pool.host_string)
+            ))
+        pool.close()
         if output.status:
             sys.stdout.write("done.\n")
@@ -17,11 +17,12 @@ from contextlib import closing, contextmanager
 
 from fabric.context_managers import (settings, char_buffered, hide,
     quiet as quiet_manager, warn_only as warn_only_manager)
-from fabric.io import output_loop, input_loop
-from fabric.network import needs_host, ssh, ssh_config
+from fabric.io import (CaptureBuffer, Drain, FrameReader, FrameSequence,
+    LineBuffer, OutputLooper, Multiplexer)
+from fabric.network import needs_host, normalize_to_string, ssh, ssh_config
 from fabric.sftp import SFTP
-from fabric.state import env, connections, output, win32, default_channel
-from fabric.thread_handling import ThreadHandler
+from fabric.state import (env, connections, sessions, output, win32,
+    default_channel)
 from fabric.utils import (
     abort,
     error,
@@ -49,6 +50,18 @@ def _shell_escape(string):
     return string
 
 
+def _single_quote(string):
+    """
+    Quote ``string`` for the shell, whatever it contains.
+
+    For example::
+
+        >>> _single_quote("it's")
+        "'it'\\\\''s'"
+    """
+    return "'%s'" % string.replace("'", "'\\''")
+
+
 class _AttributeString(str):
     """
     Simple string subclass to allow arbitrary attribute access.
@@ -58,6 +71,35 @@ class _AttributeString(str):
         return str(self)
 
 
+class _CapturedString(_AttributeString):
+    """
+    _AttributeString holding output captured by `run`/`sudo`.
+
+    If the capture was limited and spilled to disk, the string itself only
+    holds the first and last part of the output (and ``truncated`` is True);
+    `read` and `iterlines` always give access to all of it.
+    """
+    def __new__(cls, buf):
+        obj = super(_CapturedString, cls).__new__(cls, buf.excerpt().strip())
+        obj.truncated = buf.spilled
+        obj._buffer = buf
+        return obj
+
+    def read(self):
+        """
+        Return the complete captured output as a string.
+        """
+        if not self.truncated:
+            return str(self)
+        return self._buffer.read().strip()
+
+    def iterlines(self):
+        """
+        Iterate over the lines of the complete captured output.
+        """
+        return self._buffer.iterlines()
+
+
 class _AttributeList(list):
     """
     Like _AttributeString, but for lists.
@@ -702,7 +744,8 @@ def _prefix_env_vars(command, local=False):
 
 
 def _execute(channel, command, pty=True, combine_stderr=None,
-    invoke_shell=False, stdout=None, stderr=None, timeout=None):
+    invoke_shell=False, stdout=None, stderr=None, timeout=None,
+    capture_limit=None, capture_to=None, discard=False):
     """
     Execute ``command`` over ``channel``.
 
@@ -717,10 +760,79 @@ def _execute(channel, command, pty=True, combine_stderr=None,
     ``invoke_shell`` (plus a handful of other things, such as always forcing a
     pty.)
 
+    ``capture_limit`` and ``capture_to`` bound the memory used for captured
+    output; see `run`. ``capture_to`` only applies to stdout, stderr is
+    spilled to an anonymous temporary file.
+
+    ``discard`` throws output away instead of printing or capturing it, and
+    doesn't forward local stdin; only prompts are still looked for.
+
     Returns a three-tuple of (``stdout``, ``stderr``, ``status``), where
     ``stdout``/``stderr`` are captured output strings and ``status`` is the
     program's return code, if applicable.
     """
+    # Init stdout, stderr capturing.
+    stdout_buf, stderr_buf = _capture_buffers(capture_limit, capture_to,
+        discard)
+    if invoke_shell:
+        stdout_buf = stderr_buf = None
+
+    with char_buffered(sys.stdin):
+        for status in _execute_steps(channel, command, pty, combine_stderr,
+            invoke_shell, stdout, stderr, timeout, stdout_buf, stderr_buf,
+            discard):
+            pass
+
+    # Update stdout/stderr with captured values if applicable
+    if not invoke_shell:
+        stdout_buf, stderr_buf = _captured(stdout_buf, stderr_buf)
+
+    _tie_off_output(bool(stdout_buf), bool(stderr_buf))
+
+    return stdout_buf, stderr_buf, status
+
+
+def _capture_buffers(capture_limit, capture_to, discard):
+    # Discarded output never reaches these, but prompt handling still expects
+    # them to exist.
+    if discard:
+        return CaptureBuffer(), CaptureBuffer()
+    if capture_limit is None:
+        capture_limit = env.capture_limit
+    return CaptureBuffer(capture_limit, capture_to), CaptureBuffer(capture_limit)
+
+
+def _captured(stdout_buf, stderr_buf):
+    stdout_buf.finish()
+    stderr_buf.finish()
+    return _CapturedString(stdout_buf), _CapturedString(stderr_buf)
+
+
+def _tie_off_output(had_stdout, had_stderr):
+    # Tie off "loose" output by printing a newline. Helps to ensure any
+    # following print()s aren't on the same line as a trailing line prefix
+    # or similar. (Only if anything other than whitespace was printed, as
+    # otherwise that adds an entire blank line instead.)
+    if output.running and (output.stdout and had_stdout) \
+        or (output.stderr and had_stderr):
+        print("")
+
+
+def _execute_steps(channel, command, pty, combine_stderr, invoke_shell,
+    stdout, stderr, timeout, stdout_buf, stderr_buf, discard=False):
+    """
+    Generator doing the work of `_execute`, a little at a time.
+
+    Output is fed into ``stdout_buf``/``stderr_buf`` (anything with the
+    `~fabric.io.CaptureBuffer` ``append``/``drop_tail`` interface, or ``None``
+    when using ``invoke_shell``.) Yields ``None`` each time some I/O has been
+    handled (and once as soon as the command has been started), so callers
+    may consume the captured output as it arrives, and finally yields the
+    program's return code.
+
+    Callers put the local terminal into `char_buffered` mode themselves, only
+    while advancing the generator, so it isn't left that way between steps.
+    """
     # stdout/stderr redirection
     stdout = stdout or sys.stdout
     stderr = stderr or sys.stderr
@@ -731,29 +843,29 @@ def _execute(channel, command, pty=True, combine_stderr=None,
     # What to do with CTRl-C?
     remote_interrupt = env.remote_interrupt
 
-    with char_buffered(sys.stdin):
-        # Combine stdout and stderr to get around oddball mixing issues
-        if combine_stderr is None:
-            combine_stderr = env.combine_stderr
-        channel.set_combine_stderr(combine_stderr)
-
-        # Assume pty use, and allow overriding of this either via kwarg or env
-        # var.  (invoke_shell always wants a pty no matter what.)
-        using_pty = True
-        if not invoke_shell and (not pty or not env.always_use_pty):
-            using_pty = False
-        # Request pty with size params (default to 80x24, obtain real
-        # parameters if on POSIX platform)
-        if using_pty:
-            rows, cols = _pty_size()
-            channel.get_pty(width=cols, height=rows)
-
-        # Use SSH agent forwarding from 'ssh' if enabled by user
-        config_agent = ssh_config().get('forwardagent', 'no').lower() == 'yes'
-        forward = None
-        if env.forward_agent or config_agent:
-            forward = ssh.agent.AgentRequestHandler(channel)
+    # Combine stdout and stderr to get around oddball mixing issues
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+    channel.set_combine_stderr(combine_stderr)
+
+    # Assume pty use, and allow overriding of this either via kwarg or env
+    # var.  (invoke_shell always wants a pty no matter what.)
+    using_pty = True
+    if not invoke_shell and (not pty or not env.always_use_pty):
+        using_pty = False
+    # Request pty with size params (default to 80x24, obtain real
+    # parameters if on POSIX platform)
+    if using_pty:
+        rows, cols = _pty_size()
+        channel.get_pty(width=cols, height=rows)
+
+    # Use SSH agent forwarding from 'ssh' if enabled by user
+    config_agent = ssh_config().get('forwardagent', 'no').lower() == 'yes'
+    forward = None
+    if env.forward_agent or config_agent:
+        forward = ssh.agent.AgentRequestHandler(channel)
 
+    try:
         # Kick off remote command
         if invoke_shell:
             channel.invoke_shell()
@@ -762,70 +874,168 @@ def _execute(channel, command, pty=True, combine_stderr=None,
         else:
             channel.exec_command(command=command)
 
-        # Init stdout, stderr capturing. Must use lists instead of strings as
-        # strings are immutable and we're using these as pass-by-reference
-        stdout_buf, stderr_buf = [], []
-        if invoke_shell:
-            stdout_buf = stderr_buf = None
-
-        workers = (
-            ThreadHandler('out', output_loop, channel, "recv",
-                capture=stdout_buf, stream=stdout, timeout=timeout),
-            ThreadHandler('err', output_loop, channel, "recv_stderr",
-                capture=stderr_buf, stream=stderr, timeout=timeout),
-            ThreadHandler('in', input_loop, channel, using_pty)
-        )
+        # Service stdout, stderr and stdin from this thread, sleeping in
+        # select() until there's something to do.
+        looper = Drain if discard else OutputLooper
+        mux = Multiplexer()
+        mux.add(channel,
+            looper(channel, "recv", stdout, stdout_buf, timeout),
+            looper(channel, "recv_stderr", stderr, stderr_buf, timeout),
+            timeout=timeout, input=not discard, using_pty=using_pty)
 
         if remote_interrupt is None:
             remote_interrupt = invoke_shell
         if remote_interrupt and not using_pty:
             remote_interrupt = False
 
-        while True:
-            if channel.exit_status_ready():
-                break
-            else:
-                # Check for thread exceptions here so we can raise ASAP
-                # (without chance of getting blocked by, or hidden by an
-                # exception within, recv_exit_status())
-                for worker in workers:
-                    worker.raise_if_needed()
+        # Let callers know the command has started
+        yield None
+
+        while mux.channels:
             try:
-                time.sleep(ssh.io_sleep)
+                mux.step()
             except KeyboardInterrupt:
                 if not remote_interrupt:
                     raise
                 channel.send('\x03')
+            yield None
 
-        # Obtain exit code of remote program now that we're done.
+        # Obtain exit code of remote program now that we're done. (The
+        # multiplexer only stops at EOF, so this shouldn't have to wait
+        # long.)
         status = channel.recv_exit_status()
-
-        # Wait for threads to exit so we aren't left with stale threads
-        for worker in workers:
-            worker.thread.join()
-            worker.raise_if_needed()
-
+    finally:
         # Close channel
         channel.close()
         # Close any agent forward proxies
         if forward is not None:
             forward.close()
 
-        # Update stdout/stderr with captured values if applicable
-        if not invoke_shell:
-            stdout_buf = ''.join(stdout_buf).strip()
-            stderr_buf = ''.join(stderr_buf).strip()
+    yield status
+
+
+def _session_shell():
+    """
+    Return the command used to start a persistent shell: ``env.shell``, minus
+    any trailing ``-c``.
+    """
+    shell = env.shell.strip()
+    if shell.endswith(' -c'):
+        shell = shell[:-3].rstrip()
+    return shell
+
+
+def _frame(command, marker, combine_stderr, stop_unless=None):
+    """
+    Return shell code running ``command`` in a subshell, then printing
+    ``marker`` and its exit status on stdout, and ``marker`` on stderr.
+
+    If ``stop_unless`` is a list of exit statuses, any other status also makes
+    the shell exit.
+    """
+    redirect = ' 2>&1' if combine_stderr else ''
+    text = "(\n%s\n)%s; __fabric_status=$?; " \
+        "printf '%%s %%d\\n' '%s' \"$__fabric_status\"; " \
+        "printf '%%s\\n' '%s' >&2" % (command, redirect, marker, marker)
+    if stop_unless is not None:
+        text += '; case "$__fabric_status" in %s) ;; *) exit ' \
+            '"$__fabric_status";; esac' % "|".join(map(str, stop_unless))
+    return text + "\n"
+
 
-        # Tie off "loose" output by printing a newline. Helps to ensure any
-        # following print()s aren't on the same line as a trailing line prefix
-        # or similar. However, don't add an extra newline if we've already
-        # ended up with one, as that adds a entire blank line instead.
-        if output.running \
-            and (output.stdout and stdout_buf and not stdout_buf.endswith("\n")) \
-            or (output.stderr and stderr_buf and not stderr_buf.endswith("\n")):
-            print("")
+class _Session(object):
+    """
+    Persistent remote shell, running the commands sent to it one at a time.
 
-        return stdout_buf, stderr_buf, status
+    Each command is run in a subshell (so e.g. ``cd`` or ``export`` don't leak
+    into later commands) and followed by a marker line, unique to that
+    command, carrying its exit status; the marker is repeated on stderr so
+    that we know when both streams are done.
+    """
+    def __init__(self):
+        self.channel = default_channel()
+        self.client = connections[env.host_string]
+        self.channel.exec_command(_session_shell())
+        self.token = '__fabric_%s' % os.urandom(8).encode('hex')
+        self.count = 0
+        # Swallow anything the shell's startup files print.
+        _execute_in_session(self, 'true', discard=True)
+
+    def usable(self, key):
+        return (not (self.channel.closed or self.channel.eof_received)
+            and key in connections and connections[key] is self.client)
+
+    def frame(self, command, combine_stderr):
+        """
+        Return the text to send to have ``command`` run, and its marker.
+        """
+        self.count += 1
+        marker = '%s_%d__' % (self.token, self.count)
+        return _frame(command, marker, combine_stderr), marker
+
+    def close(self):
+        self.channel.close()
+
+
+def _session():
+    """
+    Return the persistent shell for the current host, starting it if needed.
+    """
+    key = normalize_to_string(env.host_string)
+    session = sessions.get(key)
+    if session is None or not session.usable(key):
+        session = sessions[key] = _Session()
+    return session
+
+
+def _execute_in_session(session, command, combine_stderr=None, stdout=None,
+    stderr=None, timeout=None, capture_limit=None, capture_to=None,
+    discard=False):
+    """
+    Like `_execute`, but run ``command`` in the persistent shell ``session``.
+
+    Commands run this way never get a pty, nor local stdin.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    timeout = env.command_timeout if (timeout is None) else timeout
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+
+    stdout_buf, stderr_buf = _capture_buffers(capture_limit, capture_to,
+        discard)
+    channel = session.channel
+    text, marker = session.frame(command, combine_stderr)
+    looper = Drain if discard else OutputLooper
+    out = FrameReader(
+        looper(channel, "recv", stdout, stdout_buf, timeout), marker)
+    err = FrameReader(
+        looper(channel, "recv_stderr", stderr, stderr_buf, timeout), marker)
+
+    # The channel's stdin is the shell's own input, so local stdin is never
+    # forwarded: whatever was typed would be run as more commands.
+    try:
+        channel.sendall(text)
+        mux = Multiplexer()
+        mux.add(channel, out, err, timeout=timeout, input=False,
+            using_pty=False)
+        mux.run()
+    except:
+        # Whatever was running is in an unknown state; start afresh next
+        # time.
+        session.close()
+        raise
+
+    if out.complete:
+        status = int(out.value)
+    else:
+        # The shell itself went away.
+        session.close()
+        status = channel.recv_exit_status()
+
+    stdout_buf, stderr_buf = _captured(stdout_buf, stderr_buf)
+    _tie_off_output(bool(stdout_buf), bool(stderr_buf))
+    return stdout_buf, stderr_buf, status
 
 
 @needs_host
@@ -867,83 +1077,290 @@ def _noop():
     yield
 
 
-def _run_command(command, shell=True, pty=True, combine_stderr=True,
-    sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
-    stderr=None, group=None, timeout=None, shell_escape=None):
-    """
-    Underpinnings of `run` and `sudo`. See their docstrings for more info.
-    """
+def _command_manager(quiet, warn_only):
     manager = _noop
     if warn_only:
         manager = warn_only_manager
     # Quiet's behavior is a superset of warn_only's, so it wins.
     if quiet:
         manager = quiet_manager
-    with manager():
-        # Set up new var so original argument can be displayed verbatim later.
-        given_command = command
-
-        # Check if shell_escape has been overridden in env
-        if shell_escape is None:
-            shell_escape = env.get('shell_escape', True)
-
-        # Handle context manager modifications, and shell wrapping
-        wrapped_command = _shell_wrap(
-            _prefix_commands(_prefix_env_vars(command), 'remote'),
-            shell_escape,
-            shell,
-            _sudo_prefix(user, group) if sudo else None
-        )
-        # Execute info line
-        which = 'sudo' if sudo else 'run'
-        if output.debug:
-            print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
-        elif output.running:
-            print("[%s] %s: %s" % (env.host_string, which, given_command))
+    return manager
 
-        # Actual execution, stdin/stdout/stderr handling, and termination
-        result_stdout, result_stderr, status = _execute(
-            channel=default_channel(), command=wrapped_command, pty=pty,
-            combine_stderr=combine_stderr, invoke_shell=False, stdout=stdout,
-            stderr=stderr, timeout=timeout)
 
-        # Assemble output string
-        out = _AttributeString(result_stdout)
-        err = _AttributeString(result_stderr)
+def _prepare_command(command, shell, sudo, user, group, shell_escape,
+    in_shell=None, announce=True):
+    """
+    Wrap ``command`` for execution and (if ``announce``) print the "running"
+    line.
 
-        # Error handling
-        out.failed = False
-        out.command = given_command
-        out.real_command = wrapped_command
-        if status not in env.ok_ret_codes:
-            out.failed = True
-            msg = "%s() received nonzero return code %s while executing" % (
-                which, status
+    ``in_shell`` says whether the command will be run by a shell of ours
+    anyway, and defaults to :ref:`env.persistent_shell <persistent-shell>`.
+
+    Returns the name of the calling operation and the wrapped command.
+    """
+    # Check if shell_escape has been overridden in env
+    if shell_escape is None:
+        shell_escape = env.get('shell_escape', True)
+
+    # Commands which our own shell will run don't need wrapping in another
+    # one; only sudo does.
+    if in_shell is None:
+        in_shell = env.persistent_shell
+    if in_shell and not sudo:
+        shell = False
+
+    # Handle context manager modifications, and shell wrapping
+    wrapped_command = _shell_wrap(
+        _prefix_commands(_prefix_env_vars(command), 'remote'),
+        shell_escape,
+        shell,
+        _sudo_prefix(user, group) if sudo else None
+    )
+    which = 'sudo' if sudo else 'run'
+    if announce:
+        _announce(which, command, wrapped_command)
+    return which, wrapped_command
+
+
+def _announce(which, command, wrapped_command):
+    # Execute info line
+    if output.debug:
+        print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
+    elif output.running:
+        print("[%s] %s: %s" % (env.host_string, which, command))
+
+
+def _check_status(result, status, which, stdout, stderr):
+    """
+    Attach ``status`` and friends to ``result``, raising errors if necessary.
+
+    ``stdout`` and ``stderr`` are the captured output, if any, for inclusion
+    in error messages.
+    """
+    result.failed = False
+    if status not in env.ok_ret_codes:
+        result.failed = True
+        msg = "%s() received nonzero return code %s while executing" % (
+            which, status
+        )
+        if env.warn_only:
+            msg += " '%s'!" % result.command
+        else:
+            msg += "!\n\nRequested: %s\nExecuted: %s" % (
+                result.command, result.real_command
             )
-            if env.warn_only:
-                msg += " '%s'!" % given_command
-            else:
-                msg += "!\n\nRequested: %s\nExecuted: %s" % (
-                    given_command, wrapped_command
-                )
-            error(message=msg, stdout=out, stderr=err)
+        error(message=msg, stdout=stdout, stderr=stderr)
+
+    # Attach return code to output string so users who have set things to
+    # warn only, can inspect the error code.
+    result.return_code = status
 
-        # Attach return code to output string so users who have set things to
-        # warn only, can inspect the error code.
-        out.return_code = status
+    # Convenience mirror of .failed
+    result.succeeded = not result.failed
 
-        # Convenience mirror of .failed
-        out.succeeded = not out.failed
+    # Attach stderr for anyone interested in that.
+    result.stderr = stderr
 
-        # Attach stderr for anyone interested in that.
-        out.stderr = err
+
+def _run_command(command, shell=True, pty=True, combine_stderr=True,
+    sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
+    stderr=None, group=None, timeout=None, shell_escape=None,
+    capture_limit=None, capture_to=None, discard=False):
+    """
+    Underpinnings of `run` and `sudo`. See their docstrings for more info.
+    """
+    with _command_manager(quiet, warn_only)():
+        which, wrapped_command = _prepare_command(command, shell, sudo, user,
+            group, shell_escape)
+
+        # Actual execution, stdin/stdout/stderr handling, and termination
+        if env.persistent_shell:
+            result_stdout, result_stderr, status = _execute_in_session(
+                _session(), wrapped_command, combine_stderr=combine_stderr,
+                stdout=stdout, stderr=stderr, timeout=timeout,
+                capture_limit=capture_limit, capture_to=capture_to,
+                discard=discard)
+        else:
+            result_stdout, result_stderr, status = _execute(
+                channel=default_channel(), command=wrapped_command, pty=pty,
+                combine_stderr=combine_stderr, invoke_shell=False,
+                stdout=stdout, stderr=stderr, timeout=timeout,
+                capture_limit=capture_limit, capture_to=capture_to,
+                discard=discard)
+
+        # Output string, ready for further attributes
+        out = result_stdout
+        out.command = command
+        out.real_command = wrapped_command
+
+        # Error handling
+        _check_status(out, status, which, out, result_stderr)
 
         return out
 
 
+class _CommandIterator(object):
+    """
+    Iterator over the lines of a remote command's stdout, as they arrive.
+
+    Underpinnings of `run_iter` and `sudo_iter`; see their docstrings. The
+    command is started right away, and its output is read from the channel
+    only as lines are asked for.
+    """
+    def __init__(self, command, shell=True, pty=True, combine_stderr=True,
+        sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
+        stderr=None, group=None, timeout=None, shell_escape=None):
+        self.command = command
+        self.return_code = self.failed = self.succeeded = self.stderr = None
+        self._manager = _command_manager(quiet, warn_only)
+        self._host_string = env.host_string
+        self._lines = LineBuffer()
+        self._stderr = CaptureBuffer()
+        with self._manager():
+            self._which, self.real_command = _prepare_command(command, shell,
+                sudo, user, group, shell_escape)
+            self._steps = _execute_steps(default_channel(), self.real_command,
+                pty, combine_stderr, False, stdout, stderr, timeout,
+                self._lines, self._stderr)
+            self._steps.next()
+        self._pending = []
+        self._had_stdout = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._pending:
+            if self._steps is None:
+                raise StopIteration
+            self._step()
+        return self._pending.pop()
+
+    def _step(self):
+        # Restore the settings the command was started with while it's being
+        # serviced, without imposing them on the caller in between lines.
+        with settings(self._manager(), host_string=self._host_string):
+            with char_buffered(sys.stdin):
+                status = self._steps.next()
+            lines = self._lines.pop_lines(final=status is not None)
+            # Skip leading blank lines, as run() strips them from its output.
+            while lines and not self._had_stdout and not lines[0].strip():
+                lines.pop(0)
+            self._had_stdout = self._had_stdout or bool(lines)
+            lines.reverse()
+            self._pending = lines
+            if status is None:
+                return
+            self._steps = None
+            self._stderr.finish()
+            stderr = _CapturedString(self._stderr)
+            _tie_off_output(self._had_stdout, bool(stderr))
+            _check_status(self, status, self._which, None, stderr)
+
+    def close(self):
+        """
+        Stop reading output and close the channel, if still running.
+        """
+        self._pending = []
+        if self._steps is not None:
+            self._steps.close()
+            self._steps = None
+
+
+def _run_many(commands, stop_on_error=True, shell=True, combine_stderr=None,
+    sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
+    stderr=None, group=None, timeout=None, shell_escape=None):
+    """
+    Underpinnings of `run_many` and `sudo_many`. See their docstrings for more
+    info.
+    """
+    results = _AttributeList()
+    with _command_manager(quiet, warn_only)():
+        prepared = [
+            _prepare_command(command, shell, sudo, user, group, shell_escape,
+                in_shell=True, announce=False)
+            for command in commands
+        ]
+        if not prepared:
+            results.failed, results.succeeded = False, True
+            return results
+
+        # One script running every command, framed as in a persistent shell
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        token = '__fabric_%s' % os.urandom(8).encode('hex')
+        markers = ['%s_%d__' % (token, i) for i in range(len(prepared))]
+        stop_unless = env.ok_ret_codes if stop_on_error else None
+        script = "".join([
+            _frame(wrapped, marker, combine_stderr, stop_unless)
+            for (which, wrapped), marker in zip(prepared, markers)
+        ])
+        # As in _shell_wrap, env.use_shell only goes so far as shell=True.
+        if shell and env.use_shell:
+            script = "%s %s" % (env.shell, _single_quote(script))
+
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+        timeout = env.command_timeout if (timeout is None) else timeout
+        buffers = [(CaptureBuffer(), CaptureBuffer()) for x in prepared]
+
+        def started(index):
+            # Tidy up after the previous command, then announce this one.
+            if index:
+                _tie_off_output(*map(bool, buffers[index - 1]))
+            which, wrapped = prepared[index]
+            _announce(which, commands[index], wrapped)
+
+        channel = default_channel()
+        out = FrameSequence([
+            FrameReader(OutputLooper(channel, "recv", stdout, buf, timeout),
+                marker)
+            for (buf, x), marker in zip(buffers, markers)
+        ], started)
+        err = FrameSequence([
+            FrameReader(
+                OutputLooper(channel, "recv_stderr", stderr, buf, timeout),
+                marker)
+            for (x, buf), marker in zip(buffers, markers)
+        ])
+        with char_buffered(sys.stdin):
+            try:
+                channel.exec_command(command=script)
+                mux = Multiplexer()
+                mux.add(channel, out, err, timeout=timeout, input=True,
+                    using_pty=False)
+                mux.run()
+                status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        _tie_off_output(*map(bool, buffers[min(out.index, len(buffers) - 1)]))
+
+        for index, command in enumerate(commands):
+            reader = out.readers[index]
+            if reader.complete:
+                code = int(reader.value)
+            elif index == out.index and not (stop_on_error and results
+                and results[-1].return_code not in env.ok_ret_codes):
+                # The shell itself went away partway through this command.
+                code = status
+            else:
+                break
+            which, wrapped = prepared[index]
+            result, result_stderr = _captured(*buffers[index])
+            result.command = command
+            result.real_command = wrapped
+            results.append(result)
+            _check_status(result, code, which, result, result_stderr)
+
+        results.failed = any([result.failed for result in results])
+        results.succeeded = not results.failed
+        return results
+
+
 @needs_host
 def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
-    warn_only=False, stdout=None, stderr=None, timeout=None, shell_escape=None):
+    warn_only=False, stdout=None, stderr=None, timeout=None, shell_escape=None,
+    capture_limit=None, capture_to=None, discard=False):
     """
     Run a shell command on a remote host.
 
@@ -1003,12 +1420,30 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
     If you want to disable Fabric's automatic attempts at escaping quotes,
     dollar signs etc., specify ``shell_escape=False``.
 
+    To bound the memory used to capture very large output, specify
+    ``capture_limit=N`` (or set :ref:`env.capture_limit <capture-limit>`):
+    only the first and last ``N`` bytes are then kept in memory, and the
+    complete output is written to a local temporary file, or to the path given
+    as ``capture_to``. In that case the return value only holds that excerpt
+    and its ``truncated`` attribute is ``True``; call its ``read()`` method for
+    the complete output or iterate over ``iterlines()`` to process it line by
+    line without loading it all. ``capture_to`` may also be given on its own,
+    to save a copy of the complete output locally.
+
+    If only the return code matters, specify ``discard=True``: output is then
+    neither printed nor captured (the return value is an empty string), and is
+    read and thrown away in large blocks, which makes e.g. quick ``test -f``
+    style probes noticeably cheaper. Local input is not forwarded to the
+    remote program in this mode, though password prompts are still handled.
+
     Examples::
 
         run("ls /var/www/")
         run("ls /home/myuser", shell=False)
         output = run('ls /var/www/site1')
         run("take_a_long_time", timeout=5)
+        for line in run("cat huge.log", capture_limit=65536).iterlines():
+            pass
 
     .. versionadded:: 1.0
         The ``succeeded`` and ``stderr`` return value attributes, the
@@ -1033,16 +1468,25 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
 
     .. versionadded:: 1.7
         The ``shell_escape`` argument.
+
+    .. versionadded:: 1.7
+        The ``capture_limit`` and ``capture_to`` arguments, and the return
+        value's ``truncated`` attribute and ``read``/``iterlines`` methods.
+
+    .. versionadded:: 1.7
+        The ``discard`` argument.
     """
     return _run_command(command, shell, pty, combine_stderr, quiet=quiet,
         warn_only=warn_only, stdout=stdout, stderr=stderr, timeout=timeout,
-        shell_escape=shell_escape)
+        shell_escape=shell_escape, capture_limit=capture_limit,
+        capture_to=capture_to, discard=discard)
 
 
 @needs_host
 def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
     quiet=False, warn_only=False, stdout=None, stderr=None, group=None,
-    timeout=None, shell_escape=None):
+    timeout=None, shell_escape=None, capture_limit=None, capture_to=None,
+    discard=False):
     """
     Run a shell command on a remote host, with superuser privileges.
 
@@ -1083,13 +1527,136 @@ def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
         The return value attributes ``.command`` and ``.real_command``.
 
     .. versionadded:: 1.7
-        The ``shell_escape`` argument.
+        The ``shell_escape``, ``capture_limit``, ``capture_to`` and ``discard``
+        arguments.
     """
     return _run_command(
         command, shell, pty, combine_stderr, sudo=True,
         user=user if user else env.sudo_user,
         group=group, quiet=quiet, warn_only=warn_only, stdout=stdout,
         stderr=stderr, timeout=timeout, shell_escape=shell_escape,
+        capture_limit=capture_limit, capture_to=capture_to, discard=discard,
+    )
+
+
+@needs_host
+def run_iter(command, shell=True, pty=True, combine_stderr=None, quiet=False,
+    warn_only=False, stdout=None, stderr=None, timeout=None,
+    shell_escape=None):
+    """
+    Run a shell command on a remote host, iterating over its output.
+
+    `run_iter` behaves like `~fabric.operations.run` and takes the same
+    arguments (bar ``capture_limit``/``capture_to``), but instead of waiting
+    for the remote program to exit it returns an iterator yielding each line
+    of its standard output, without line endings, as soon as that line
+    arrives. (As `~fabric.operations.run` strips its output, any leading blank
+    lines are skipped.) Output is read from the network only as fast as lines are
+    consumed, and nothing already yielded is kept, so arbitrarily large or
+    never-ending output may be processed in constant memory::
+
+        for line in run_iter("tail -f /var/log/syslog"):
+            if "error" in line:
+                break
+
+    Once exhausted, the iterator exhibits the ``return_code``, ``failed``,
+    ``succeeded``, ``stderr``, ``command`` and ``real_command`` attributes of
+    `~fabric.operations.run`'s return value, and nonzero return codes are
+    handled as usual (i.e. they abort unless ``warn_only`` is in effect.)
+    Call its ``close()`` method to stop early and close the channel.
+
+    .. versionadded:: 1.7
+    """
+    return _CommandIterator(command, shell, pty, combine_stderr, quiet=quiet,
+        warn_only=warn_only, stdout=stdout, stderr=stderr, timeout=timeout,
+        shell_escape=shell_escape)
+
+
+@needs_host
+def sudo_iter(command, shell=True, pty=True, combine_stderr=None, user=None,
+    quiet=False, warn_only=False, stdout=None, stderr=None, group=None,
+    timeout=None, shell_escape=None):
+    """
+    Run a shell command on a remote host, with superuser privileges, iterating
+    over its output.
+
+    `sudo_iter` is to `~fabric.operations.sudo` as
+    `~fabric.operations.run_iter` is to `~fabric.operations.run`.
+
+    .. versionadded:: 1.7
+    """
+    return _CommandIterator(
+        command, shell, pty, combine_stderr, sudo=True,
+        user=user if user else env.sudo_user,
+        group=group, quiet=quiet, warn_only=warn_only, stdout=stdout,
+        stderr=stderr, timeout=timeout, shell_escape=shell_escape,
+    )
+
+
+@needs_host
+def run_many(commands, stop_on_error=True, shell=True, combine_stderr=None,
+    quiet=False, warn_only=False, stdout=None, stderr=None, timeout=None,
+    shell_escape=None):
+    """
+    Run a list of shell commands on a remote host, in one go.
+
+    Rather than executing each of ``commands`` separately (which costs at
+    least one network round trip apiece), `run_many` sends them all to the
+    remote host at once, as a single script run by one shell, while still
+    keeping track of each command's output and exit status. Output is
+    displayed as usual while the commands run.
+
+    Returns a list holding, for each command which was run, what
+    `~fabric.operations.run` would have returned for it: its stdout, with the
+    ``failed``, ``succeeded``, ``return_code``, ``stderr``, ``command`` and
+    ``real_command`` attributes. The list itself has ``failed`` and
+    ``succeeded`` attributes summing up the whole batch.
+
+    By default the remote end stops at the first command whose return code
+    isn't in :ref:`env.ok_ret_codes <ok-ret-codes>`, so that later commands
+    are not run (and are missing from the returned list); specify
+    ``stop_on_error=False`` to always run them all. Either way, failures are
+    handled as usual once the batch has finished, i.e. the first one aborts
+    unless ``warn_only`` is in effect.
+
+    The other arguments are as for `~fabric.operations.run`, except that
+    ``timeout`` applies to the batch as a whole, and that the commands never
+    get a pseudo-terminal. For example::
+
+        results = run_many([
+            "mkdir -p /srv/app",
+            "chown deploy /srv/app",
+            "ls -l /srv/app",
+        ])
+        print results[-1]
+
+    .. versionadded:: 1.7
+    """
+    return _run_many(commands, stop_on_error, shell, combine_stderr,
+        quiet=quiet, warn_only=warn_only, stdout=stdout, stderr=stderr,
+        timeout=timeout, shell_escape=shell_escape)
+
+
+@needs_host
+def sudo_many(commands, stop_on_error=True, shell=True, combine_stderr=None,
+    user=None, quiet=False, warn_only=False, stdout=None, stderr=None,
+    group=None, timeout=None, shell_escape=None):
+    """
+    Run a list of shell commands on a remote host, in one go, with superuser
+    privileges.
+
+    `sudo_many` is to `~fabric.operations.sudo` as
+    `~fabric.operations.run_many` is to `~fabric.operations.run`: each
+    command is individually wrapped in a call to ``sudo``, and password
+    prompts are handled as usual.
+
+    .. versionadded:: 1.7
+    """
+    return _run_many(
+        commands, stop_on_error, shell, combine_stderr, sudo=True,
+        user=user if user else env.sudo_user,
+        group=group, quiet=quiet, warn_only=warn_only, stdout=stdout,
+        stderr=stderr, timeout=timeout, shell_escape=shell_escape,
     )
 
 
@@ -1189,9 +1756,9 @@ def reboot(wait=120):
     """
     Reboot the remote system.
 
-    Will temporarily tweak Fabric's reconnection settings (:ref:`timeout` and
-    :ref:`connection-attempts`) to ensure that reconnection does not give up
-    for at least ``wait`` seconds.
+    Will temporarily tweak Fabric's reconnection settings (:ref:`timeout`,
+    :ref:`connection-attempts` and :ref:`connection-deadline`) to ensure that
+    reconnection does not give up for at least ``wait`` seconds.
 
     .. note::
         As of Fabric 1.4, the ability to reconnect partway through a session no
@@ -1209,18 +1776,22 @@ def reboot(wait=120):
         Changed the ``wait`` kwarg to be optional, and refactored to leverage
         the new reconnection functionality; it may not actually have to wait
         for ``wait`` seconds before reconnecting.
+    .. versionchanged:: 1.7
+        Gives up after ``wait`` seconds rather than a number of attempts, and
+        so reconnects as soon as the host is back up.
     """
     # Shorter timeout for a more granular cycle than the default.
     timeout = 5
-    # Use 'wait' as max total wait time
-    attempts = int(round(float(wait) / float(timeout)))
+    # Use 'wait' as max total wait time, however many attempts that takes
+    # (refused connections fail, and get retried, much quicker than timeouts.)
     # Don't bleed settings, since this is supposed to be self-contained.
     # User adaptations will probably want to drop the "with settings()" and
     # just have globally set timeout/attempts values.
     with settings(
         hide('running'),
         timeout=timeout,
-        connection_attempts=attempts
+        connection_attempts=sys.maxint,
+        connection_deadline=wait
     ):
         sudo('reboot')
         # Try to make sure we don't slip in before pre-reboot lockdown
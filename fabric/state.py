@@ -3,12 +3,14 @@ Internal shared-state variables such as config settings and host lists.
 """
 
 import os
+import socket
 import sys
 from optparse import make_option
 
 from fabric.network import HostConnectionCache, ssh
 from fabric.version import get_version
-from fabric.utils import _AliasDict, _AttributeDict
+from fabric.utils import (_AliasDict, _AttributeDict, _ThreadLocalAliasDict,
+    _ThreadLocalDict)
 
 
 #
@@ -132,7 +134,7 @@ env_options = [
     make_option('-g', '--gateway',
         default=None,
         metavar='HOST',
-        help="gateway host to connect through"
+        help="gateway host (or comma-separated hosts) to connect through"
     ),
 
     make_option('--hide',
@@ -200,11 +202,27 @@ env_options = [
         help="default to parallel execution method"
     ),
 
+    make_option('--parallel-backend',
+        dest='parallel_backend',
+        type='choice',
+        choices=['process', 'thread', 'pool'],
+        metavar='BACKEND',
+        default='process',
+        help="run parallel tasks in a 'process' (default) or 'thread' per "
+            "host, or in a 'pool' of persistent worker processes"
+    ),
+
     make_option('--port',
         default=default_port,
         help="SSH connection port"
     ),
 
+    make_option('--prewarm',
+        action='store_true',
+        default=False,
+        help="connect to all hosts concurrently before running each task"
+    ),
+
     make_option('-r', '--reject-unknown-hosts',
         action='store_true',
         default=False,
@@ -221,6 +239,28 @@ env_options = [
         help="comma-separated list of roles to operate on"
     ),
 
+    make_option('--rolling-batch',
+        dest='rolling_batch',
+        metavar='N[%]',
+        default=None,
+        help="run parallel tasks on N hosts (or N% of them) at a time"
+    ),
+
+    make_option('--rolling-max-fail',
+        dest='rolling_max_fail',
+        metavar='N[%]',
+        default=None,
+        help="stop a rolling run once more than N hosts (or N%) have failed"
+    ),
+
+    make_option('--rolling-pause',
+        dest='rolling_pause',
+        type='float',
+        metavar='SECONDS',
+        default=0,
+        help="seconds to wait between rolling batches"
+    ),
+
     make_option('-s', '--shell',
         default='/bin/bash -l -c',
         help="specify a new shell, defaults to '/bin/bash -l -c'"
@@ -296,28 +336,40 @@ env_options = [
 # Most default values are specified in `env_options` above, in the interests of
 # preserving DRY: anything in here is generally not settable via the command
 # line.
-env = _AttributeDict({
+env = _ThreadLocalDict({
     'again_prompt': 'Sorry, try again.',
     'all_hosts': [],
+    'capture_limit': None,
     'combine_stderr': True,
     'command': None,
     'command_prefixes': [],
+    'connection_backoff': 1,
+    'connection_cache_size': None,
+    'connection_deadline': None,
+    'connection_idle_timeout': None,
+    'connection_retry_policy': None,
     'cwd': '',  # Must be empty string, not None, for concatenation purposes
     'dedupe_hosts': True,
+    'dns_cache_ttl': 60,
     'default_port': default_port,
     'eagerly_disconnect': False,
     'echo_stdin': True,
     'exclude_hosts': [],
     'gateway': None,
+    'gateway_channel_limit': None,
+    'gateway_pool_size': 1,
     'host': None,
     'host_string': None,
     'lcwd': '',  # Must be empty string, not None, for concatenation purposes
     'local_user': _get_system_username(),
+    'native_proxy_jump': True,
     'output_prefix': True,
     'passwords': {},
     'path': '',
     'path_behavior': 'append',
+    'persistent_shell': False,
     'port': default_port,
+    'prompts': {},
     'real_fabfile': None,
     'remote_interrupt': None,
     'roles': [],
@@ -367,6 +419,9 @@ commands = {}
 
 connections = HostConnectionCache()
 
+# Persistent shells (see fabric.context_managers.session), by host string
+sessions = {}
+
 
 def _open_session():
     return connections[env.host_string].get_transport().open_session()
@@ -378,13 +433,15 @@ def default_channel():
     """
     try:
         chan = _open_session()
-    except ssh.SSHException, err:
-        if str(err) == 'SSH session not active':
-            connections[env.host_string].close()
-            del connections[env.host_string]
-            chan = _open_session()
-        else:
+    except (ssh.SSHException, EOFError, socket.error), err:
+        # The transport died since we last checked on it: reconnect, once.
+        if isinstance(err, ssh.SSHException) \
+            and str(err) != 'SSH session not active':
             raise
+        client = connections.pop(env.host_string, None)
+        if client:
+            client.close()
+        chan = _open_session()
     chan.settimeout(0.1)
     chan.input_enabled = True
     return chan
@@ -402,7 +459,7 @@ def default_channel():
 # user, and new users, are most likely to expect.
 #
 # See docs/usage.rst for details on what these levels mean.
-output = _AliasDict({
+output = _ThreadLocalAliasDict({
     'status': True,
     'aborts': True,
     'warnings': True,
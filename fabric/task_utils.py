@@ -47,6 +47,8 @@ def merge(hosts, roles, exclude, roledefs):
     # Coerce strings to one-item lists
     if isinstance(hosts, basestring):
         hosts = [hosts]
+    if isinstance(exclude, basestring):
+        exclude = [exclude]
 
     # Look up roles, turn into flat list of hosts
     role_hosts = []
@@ -66,8 +68,12 @@ def merge(hosts, roles, exclude, roledefs):
     all_hosts = cleaned_hosts
     if state.env.dedupe_hosts:
         deduped_hosts = []
+        # Sets, so that long host lists don't take quadratic time
+        seen = set()
+        exclude = set(exclude)
         for host in cleaned_hosts:
-            if host not in deduped_hosts and host not in exclude:
+            if host not in seen and host not in exclude:
+                seen.add(host)
                 deduped_hosts.append(host)
         all_hosts = deduped_hosts
     return all_hosts
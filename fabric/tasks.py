@@ -1,13 +1,22 @@
 from __future__ import with_statement
 
+import atexit
 from functools import wraps
+import os
+import cPickle as pickle
 import sys
+import time
+import traceback
+import Queue
+
+from Crypto import Random
 
 from fabric import state
 from fabric.utils import abort, warn, error
-from fabric.network import to_dict, normalize_to_string, disconnect_all
+from fabric.network import (to_dict, normalize_to_string, disconnect_all,
+    resolve_hosts)
 from fabric.context_managers import settings
-from fabric.job_queue import JobQueue
+from fabric.job_queue import JobQueue, ProcessPool, ThreadJob
 from fabric.task_utils import crawl, merge, parse_kwargs
 from fabric.exceptions import NetworkError
 
@@ -90,6 +99,50 @@ class Task(object):
             print("Parallel tasks now using pool size of %d" % pool_size)
         return pool_size
 
+    def get_rolling(self, hosts):
+        # Per-task settings (from ``@rolling``) win over the global ones.
+        batch = getattr(self, 'rolling_batch', None)
+        if batch is None:
+            batch = state.env.rolling_batch
+            max_fail = state.env.rolling_max_fail
+            pause = state.env.rolling_pause
+        else:
+            max_fail = getattr(self, 'rolling_max_fail', None)
+            pause = getattr(self, 'rolling_pause', None)
+        if not batch:
+            return None
+        batch = max(1, _rolling_amount(batch, len(hosts), "batch size"))
+        max_fail = _rolling_amount(max_fail or 0, len(hosts),
+            "failure allowance")
+        pause = float(pause or 0)
+        if state.output.debug:
+            print("Rolling through hosts %d at a time, allowing %d failures" % (
+                batch, max_fail
+            ))
+        return batch, max_fail, pause
+
+
+def _rolling_amount(value, total, what):
+    """
+    Turn a rolling batch size or failure allowance into a number of hosts.
+
+    ``value`` is either a count (``3``, ``"3"``) or a percentage of ``total``
+    (``"10%"``), rounded down. Aborts, naming it ``what``, if it's neither.
+    """
+    text = str(value).strip()
+    try:
+        if text.endswith('%'):
+            amount = float(text[:-1])
+            count = int(total * amount / 100)
+        else:
+            amount = count = int(text)
+    except (ValueError, OverflowError):
+        amount = -1
+    if amount < 0:
+        abort("Invalid rolling %s %r: expected a number of hosts, or a "
+            "percentage of them such as '10%%'" % (what, value))
+    return count
+
 
 class WrappedCallableTask(Task):
     """
@@ -134,10 +187,14 @@ def requires_parallel(task):
 
     * It's been explicitly marked with ``@parallel``, or:
     * It's *not* been explicitly marked with ``@serial`` *and* the global
-      parallel option (``env.parallel``) is set to ``True``.
+      parallel option (``env.parallel``) is set to ``True``, or a global
+      rolling batch size (``env.rolling_batch``) is set.
+
+    (``@rolling`` implies ``@parallel``.)
     """
+    globally = state.env.parallel or state.env.rolling_batch
     return (
-        (state.env.parallel and not getattr(task, 'serial', False))
+        (globally and not getattr(task, 'serial', False))
         or getattr(task, 'parallel', False)
     )
 
@@ -149,6 +206,69 @@ def _parallel_tasks(commands_to_run):
     ))
 
 
+# Persistent workers for env.parallel_backend = 'pool', shared by all tasks
+_pool = None
+
+
+def _worker_pool():
+    global _pool
+    # A pool inherited from our parent process is no use to us.
+    if _pool is None or _pool.pid != os.getpid():
+        _pool = ProcessPool(_run_pooled, _init_pool_worker)
+        atexit.register(_pool.close)
+    return _pool
+
+
+def _init_pool_worker():
+    # Connections inherited from the parent process remain the parent's.
+    for key in state.connections.keys():
+        state.connections.pop(key)
+    state.sessions.clear()
+    Random.atfork()
+
+
+def _run_pooled(command, name, args, kwargs, env, output):
+    """
+    Run task ``command`` in a pool worker, as `_execute`'s processes would.
+    """
+    task = crawl(command, state.commands)
+    if not _is_task(task):
+        task = WrappedCallableTask(task)
+    state.env.clear()
+    state.env.update(env)
+    state.output.update(output)
+    try:
+        return 0, [task.run(*args, **kwargs)]
+    except SystemExit, e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0, []
+        sys.stderr.write("%s\n" % e.code)
+        return 1, []
+    except BaseException, e:
+        sys.stderr.write("!!! Parallel execution exception under host %r:\n" % name)
+        traceback.print_exc()
+        return 1, [e]
+
+
+def _pool_payload(task, command, name, args, kwargs, env, output):
+    """
+    Return a pickled job for `_run_pooled`, or None if it can't run there.
+
+    Pool workers only know the tasks which existed when they were forked, so
+    tasks are looked up by name; anything else (or anything which won't
+    pickle) has to make do with a process of its own.
+    """
+    found = crawl(command, state.commands) if command else None
+    if found is None or (found is not task
+        and found is not getattr(task, 'wrapped', None)):
+        return None
+    try:
+        return pickle.dumps((command, name, args, kwargs, env, output),
+            pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+
+
 def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
     """
     Primary single-host work body of execute()
@@ -165,21 +285,46 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
     # Handle parallel execution
     if queue is not None: # Since queue is only set for parallel
         name = local_env['host_string']
+        threaded = state.env.parallel_backend == 'thread'
+        if state.env.parallel_backend in ('thread', 'pool'):
+            # Threads share our env and output, and pool workers have long
+            # since forked, so each gets complete copies of its own to change,
+            # as a process would. Connections are left shared.
+            local_env = dict(state.env.items(), **local_env)
+            local_output = dict(state.output.items())
+        if state.env.parallel_backend == 'pool':
+            payload = _pool_payload(task, my_env['command'], name, args,
+                kwargs, local_env, local_output)
+            if payload is not None:
+                jobs.append(_worker_pool().job(name, payload))
+                return
+            if state.output.debug:
+                print("Task %r can't run in the worker pool, forking instead"
+                    % my_env['command'])
         # Wrap in another callable that:
         # * expands the env it's given to ensure parallel, linewise, etc are
         #   all set correctly and explicitly. Such changes are naturally
         #   insulted from the parent process.
-        # * nukes the connection cache to prevent shared-access problems
+        # * nukes the connection cache to prevent shared-access problems, or
+        #   when run in a thread, binds that thread's own copies of env/output
         # * knows how to send the tasks' return value back over a Queue
         # * captures exceptions raised by the task
         def inner(args, kwargs, queue, name, env):
-            state.env.update(env)
+            if threaded:
+                state.env._bind(env)
+                state.output._bind(local_output)
+            else:
+                state.env.update(env)
             def submit(result):
                 queue.put({'name': name, 'result': result})
             try:
-                key = normalize_to_string(state.env.host_string)
-                state.connections.pop(key, "")
-                submit(task.run(*args, **kwargs))
+                if not threaded:
+                    key = normalize_to_string(state.env.host_string)
+                    state.connections.pop(key, "")
+                # Other threads may be filling up the (shared) connection
+                # cache, so make sure ours stays open.
+                with state.connections.in_use(state.env.host_string):
+                    submit(task.run(*args, **kwargs))
             except BaseException, e: # We really do want to capture everything
                 # SystemExit implies use of abort(), which prints its own
                 # traceback, host info etc -- so we don't want to double up
@@ -193,6 +338,10 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
                 # driven SystemExits -- will bubble up and terminate the
                 # child process.
                 raise
+            finally:
+                if threaded:
+                    state.env._unbind()
+                    state.output._unbind()
 
         # Stuff into Process wrapper
         kwarg_dict = {
@@ -202,7 +351,10 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
             'name': name,
             'env': local_env,
         }
-        p = multiprocessing.Process(target=inner, kwargs=kwarg_dict)
+        if threaded:
+            p = ThreadJob(target=inner, kwargs=kwarg_dict)
+        else:
+            p = multiprocessing.Process(target=inner, kwargs=kwarg_dict)
         # Name/id is host string
         p.name = name
         # Add to queue
@@ -210,7 +362,8 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
     # Handle serial execution
     else:
         with settings(**local_env):
-            return task.run(*args, **kwargs)
+            with state.connections.in_use(state.env.host_string):
+                return task.run(*args, **kwargs)
 
 def _is_task(task):
     return isinstance(task, Task)
@@ -260,8 +413,31 @@ def execute(task, *args, **kwargs):
         Added the return value mapping; previously this function had no defined
         return value.
     """
+    return dict(execute_iter(task, *args, **kwargs))
+
+
+def execute_iter(task, *args, **kwargs):
+    """
+    Like `execute`, but yield each host's result as soon as it is available.
+
+    Takes the same arguments as `execute`, and yields ``(host, result)`` tuples
+    whose contents match the items of `execute`'s return value -- including
+    error objects for failed hosts -- one per host, as each finishes. This lets
+    one e.g. start on dependent work or tally up results without waiting for
+    the slowest host of a large parallel run::
+
+        for host, result in execute_iter(deploy, hosts=all_hosts):
+            if isinstance(result, Exception):
+                break
+
+    Nothing happens until the first result is asked for. Any abort (e.g. due
+    to failed parallel hosts) happens as it would with `execute`, once the
+    results of all hosts have been yielded; hosts still running when one stops
+    iterating early are left to finish, but queued ones are never started.
+
+    .. versionadded:: 1.7
+    """
     my_env = {'clean_revert': True}
-    results = {}
     # Obtain task
     is_callable = callable(task)
     if not (is_callable or _is_task(task)):
@@ -283,7 +459,12 @@ def execute(task, *args, **kwargs):
     my_env['all_hosts'] = task.get_hosts(hosts, roles, exclude_hosts, state.env)
 
     parallel = requires_parallel(task)
-    if parallel:
+    threaded = parallel and state.env.parallel_backend == 'thread'
+    if parallel and state.env.parallel_backend not in (
+        'process', 'thread', 'pool'):
+        abort("Unknown parallel backend %r; expected 'process', 'thread' or "
+            "'pool'." % state.env.parallel_backend)
+    if parallel and not threaded:
         # Import multiprocessing if needed, erroring out usefully
         # if it can't.
         try:
@@ -301,57 +482,118 @@ def execute(task, *args, **kwargs):
 
     # Get pool size for this task
     pool_size = task.get_pool_size(my_env['all_hosts'], state.env.pool_size)
+    if parallel and state.env.parallel_backend == 'pool':
+        _worker_pool().grow(pool_size)
     # Set up job queue in case parallel is needed
-    queue = multiprocessing.Queue() if parallel else None
-    jobs = JobQueue(pool_size, queue)
-    if state.output.debug:
-        jobs._debug = True
+    if threaded:
+        queue = Queue.Queue()
+    elif parallel:
+        queue = multiprocessing.Queue()
+    else:
+        queue = None
 
     # Call on host list
     if my_env['all_hosts']:
-        # Attempt to cycle on hosts, skipping if needed
-        for host in my_env['all_hosts']:
-            try:
-                results[host] = _execute(
-                    task, host, my_env, args, new_kwargs, jobs, queue,
-                    multiprocessing
-                )
-            except NetworkError, e:
-                results[host] = e
-                # Backwards compat test re: whether to use an exception or
-                # abort
-                if not state.env.use_exceptions_for['network']:
-                    func = warn if state.env.skip_bad_hosts else abort
-                    error(e.message, func=func, exception=e.wrapped)
-                else:
-                    raise
-
-            # If requested, clear out connections here and not just at the end.
-            if state.env.eagerly_disconnect:
-                disconnect_all()
-
-        # If running in parallel, block until job queue is emptied
-        if jobs:
-            err = "One or more hosts failed while executing task '%s'" % (
-                my_env['command']
-            )
+        # Look up every host's addresses at once, rather than one at a time as
+        # each gets connected to. (Gateways do their own lookups.)
+        if state.env.dns_cache_ttl and not state.env.gateway:
+            resolve_hosts(my_env['all_hosts'])
+        # Connect to every host up front if requested, reporting the ones that
+        # failed before anything gets run. (Connections don't survive being
+        # handed to subprocesses, so not for the process parallel backend.)
+        bad_hosts = {}
+        if state.env.prewarm and (threaded or not parallel) \
+            and not state.env.eagerly_disconnect:
+            bad_hosts = state.connections.prewarm(my_env['all_hosts'])
+            for host in my_env['all_hosts']:
+                e = bad_hosts.get(normalize_to_string(host))
+                if e is None:
+                    continue
+                if state.env.use_exceptions_for['network']:
+                    raise e
+                func = warn if state.env.skip_bad_hosts else abort
+                error(e.message, func=func, exception=e.wrapped)
+                yield host, e
+        # Rolling runs go through the job queue a batch of hosts at a time,
+        # each batch finishing before the next one starts.
+        rolling = parallel and task.get_rolling(my_env['all_hosts'])
+        if rolling:
+            size, max_fail, pause = rolling
+            all_hosts = my_env['all_hosts']
+            batches = [
+                all_hosts[i:i + size] for i in range(0, len(all_hosts), size)
+            ]
+        else:
+            batches = [my_env['all_hosts']]
+        err = "One or more hosts failed while executing task '%s'" % (
+            my_env['command']
+        )
+        failed = 0
+        for number, batch in enumerate(batches):
+            if number and pause:
+                time.sleep(pause)
+            jobs = JobQueue(pool_size, queue)
+            if state.output.debug:
+                jobs._debug = True
+            # Attempt to cycle on hosts, skipping if needed
+            for host in batch:
+                if normalize_to_string(host) in bad_hosts:
+                    continue
+                try:
+                    result = _execute(
+                        task, host, my_env, args, new_kwargs, jobs, queue,
+                        multiprocessing
+                    )
+                except NetworkError, e:
+                    result = e
+                    # Backwards compat test re: whether to use an exception or
+                    # abort
+                    if not state.env.use_exceptions_for['network']:
+                        func = warn if state.env.skip_bad_hosts else abort
+                        error(e.message, func=func, exception=e.wrapped)
+                    else:
+                        raise
+                # (Parallel runs' results come from the job queue, below.)
+                if not parallel:
+                    yield host, result
+
+                # If requested, clear out connections here and not just at the
+                # end.
+                if state.env.eagerly_disconnect:
+                    disconnect_all()
+
+            # If running in parallel, block until job queue is emptied
+            if not jobs:
+                continue
             jobs.close()
-            # Abort if any children did not exit cleanly (fail-fast).
-            # This prevents Fabric from continuing on to any other tasks.
-            # Otherwise, pull in results from the child run.
-            ran_jobs = jobs.run()
-            for name, d in ran_jobs.iteritems():
+            # Pass on results from the child runs as they finish, then abort if
+            # any children did not exit cleanly (fail-fast). This prevents
+            # Fabric from continuing on to any other tasks. Rolling runs only
+            # do so once more hosts failed than they allow for.
+            failures = []
+            for name, d in jobs.run_iter():
+                yield name, d['results']
                 if d['exit_code'] != 0:
-                    if isinstance(d['results'], BaseException):
-                        error(err, exception=d['results'])
-                    else:
-                        error(err)
-                results[name] = d['results']
+                    failures.append(d)
+            failed += len(failures)
+            func = None
+            if rolling and failed <= max_fail:
+                func = warn
+            for d in failures:
+                if isinstance(d['results'], BaseException):
+                    error(err, func=func, exception=d['results'])
+                else:
+                    error(err, func=func)
+            if rolling and failed > max_fail and number + 1 < len(batches):
+                skipped = sum(map(len, batches[number + 1:]))
+                error("%d hosts failed, more than the %d allowed; not running "
+                    "task '%s' on the remaining %d" % (
+                        failed, max_fail, my_env['command'], skipped
+                    ))
+                break
 
     # Or just run once for local-only
     else:
         with settings(**my_env):
-            results['<local-only>'] = task.run(*args, **new_kwargs)
-    # Return what we can from the inner task executions
-
-    return results
+            result = task.run(*args, **new_kwargs)
+        yield '<local-only>', result
@@ -1,25 +1,177 @@
+import os
+import Queue
 import threading
 import sys
 
+from fabric.utils import _thread_bindings, _set_thread_bindings
+
+
+class WorkerPool(object):
+    """
+    Process-wide pool of daemon threads on which I/O loops are run.
+
+    Threads are started lazily as work arrives, and then reused. Work never
+    waits for a thread, lest long-lived work (e.g. tunnels) hold up the rest:
+    when every thread is busy another is started regardless, but only ``size``
+    are kept around, any beyond that exiting once done. `stats` reports how
+    busy the pool is, including how often it went beyond ``size``
+    (``saturated``), which suggests ``size`` should be raised.
+
+    Threads don't survive ``fork()``, so a pool used in a new process starts
+    over from scratch.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        self.workers = 0
+        self.idle = 0
+        self.submitted = 0
+        self.completed = 0
+        self.saturated = 0
+        self.peak_busy = 0
+
+    def submit(self, handler):
+        """
+        Schedule ``handler`` (a `ThreadHandler`) to be run.
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._reset()
+            self.submitted += 1
+            if self.idle:
+                self.idle -= 1
+            else:
+                if self.workers >= self.size:
+                    self.saturated += 1
+                self.workers += 1
+                thread = threading.Thread(None, self._work,
+                    "fabric-io-%d" % self.workers)
+                thread.setDaemon(True)
+                thread.start()
+            self.peak_busy = max(self.peak_busy, self.workers - self.idle)
+            self._queue.put(handler)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        thread = threading.currentThread()
+        name = thread.getName()
+        while True:
+            handler = self._queue.get()
+            thread.setName(handler.name)
+            handler.run()
+            thread.setName(name)
+            self._lock.acquire()
+            try:
+                self.completed += 1
+                surplus = self.workers > self.size
+                if surplus:
+                    self.workers -= 1
+                else:
+                    self.idle += 1
+            finally:
+                self._lock.release()
+            # Only now, so that whoever is waiting on the handler finds this
+            # thread free for their next piece of work.
+            handler.finished.set()
+            if surplus:
+                return
+
+    def stats(self):
+        """
+        Return a dict of counters describing the pool's use so far.
+        """
+        self._lock.acquire()
+        try:
+            return {
+                'size': self.size,
+                'workers': self.workers,
+                'busy': self.workers - self.idle,
+                'queued': self._queue.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'saturated': self.saturated,
+                'peak_busy': self.peak_busy,
+            }
+        finally:
+            self._lock.release()
+
+
+io_pool = WorkerPool()
+
 
 class ThreadHandler(object):
+    """
+    Run ``callable(*args, **kwargs)`` in the background, on `io_pool`.
+
+    Any exception it raises is kept, to be re-raised by `raise_if_needed`.
+    The callable sees the same ``env`` and ``output`` as the thread which
+    created the handler did.
+    """
     def __init__(self, name, callable, *args, **kwargs):
+        self.name = name
+        self.callable = callable
+        self.args = args
+        self.kwargs = kwargs
         # Set up exception handling
         self.exception = None
+        self.finished = threading.Event()
+        self.bindings = _thread_bindings()
+        io_pool.submit(self)
 
-        def wrapper(*args, **kwargs):
-            try:
-                callable(*args, **kwargs)
-            except BaseException:
-                self.exception = sys.exc_info()
-        # Kick off thread
-        thread = threading.Thread(None, wrapper, name, args, kwargs)
-        thread.setDaemon(True)
-        thread.start()
-        # Make thread available to instantiator
-        self.thread = thread
+    def run(self):
+        _set_thread_bindings(self.bindings)
+        try:
+            self.callable(*self.args, **self.kwargs)
+        except BaseException:
+            self.exception = sys.exc_info()
+        # Pool threads are reused; don't leave them bound to our values.
+        _set_thread_bindings({})
+
+    def join(self, timeout=None):
+        """
+        Wait for the callable to return, or for ``timeout`` seconds.
+        """
+        self.finished.wait(timeout)
+
+    def is_alive(self):
+        return not self.finished.isSet()
 
     def raise_if_needed(self):
         if self.exception:
             e = self.exception
             raise e[0], e[1], e[2]
+
+
+def run_concurrently(name, callable, items, size):
+    """
+    Call ``callable(item)`` for each of ``items``, up to ``size`` at a time.
+
+    Returns once all calls have; the first exception raised by any of them is
+    then re-raised.
+    """
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def work():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            callable(item)
+
+    workers = [
+        ThreadHandler(name, work) for i in range(min(size, pending.qsize()))
+    ]
+    for worker in workers:
+        worker.join()
+    for worker in workers:
+        worker.raise_if_needed()
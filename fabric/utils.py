@@ -5,6 +5,7 @@ or performing indenting on multiline output.
 import os
 import sys
 import textwrap
+import threading
 from traceback import format_exc
 
 
@@ -284,6 +285,86 @@ class _AliasDict(_AttributeDict):
         return ret
 
 
+# Per-thread values of every _ThreadLocalDict, keyed by the dict's id().
+_thread_state = threading.local()
+
+
+def _thread_bindings():
+    """
+    Return a copy of the calling thread's `_ThreadLocalDict` bindings.
+
+    Handing the result to `_set_thread_bindings` in another thread makes that
+    thread see the same values as this one.
+    """
+    return dict(getattr(_thread_state, 'bindings', {}))
+
+
+def _set_thread_bindings(bindings):
+    _thread_state.bindings = bindings
+
+
+class _ThreadLocalDict(_AttributeDict):
+    """
+    `_AttributeDict` subclass whose contents may be swapped out per thread.
+
+    Once a thread calls ``_bind(values)``, every lookup or change it makes
+    through the dict goes to the plain dict ``values`` instead, until it calls
+    ``_unbind()``. Other threads are unaffected and keep sharing the dict's own
+    contents. This is how e.g. ``env`` may differ between threads running
+    tasks side by side, while remaining a single object to import.
+    """
+    def _bound_values(self):
+        return getattr(_thread_state, 'bindings', {}).get(id(self))
+
+    def _bind(self, values):
+        bindings = _thread_bindings()
+        bindings[id(self)] = values
+        _set_thread_bindings(bindings)
+
+    def _unbind(self):
+        bindings = _thread_bindings()
+        bindings.pop(id(self), None)
+        _set_thread_bindings(bindings)
+
+
+def _per_thread(name):
+    unbound = getattr(dict, name)
+    def method(self, *args, **kwargs):
+        values = self._bound_values()
+        if values is None:
+            return unbound(self, *args, **kwargs)
+        return getattr(values, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+for name in ('__contains__', '__delitem__', '__eq__', '__getitem__',
+    '__iter__', '__len__', '__ne__', '__repr__', '__setitem__', 'clear',
+    'copy', 'get', 'has_key', 'items', 'iteritems', 'iterkeys', 'itervalues',
+    'keys', 'pop', 'popitem', 'setdefault', 'update', 'values'):
+    setattr(_ThreadLocalDict, name, _per_thread(name))
+del name
+
+
+class _ThreadLocalAliasDict(_AliasDict, _ThreadLocalDict):
+    """
+    `_AliasDict` whose contents may be swapped out per thread.
+
+    See `_ThreadLocalDict`.
+    """
+    pass
+
+
+def _in_parallel_thread():
+    """
+    Return True if running a task in (a thread started by) a parallel thread.
+
+    Those are the threads of the ``thread`` parallel backend, which bind their
+    own ``env`` (see `_ThreadLocalDict`) and share our terminal.
+    """
+    import fabric.state
+    return fabric.state.env._bound_values() is not None
+
+
 def _pty_size():
     """
     Obtain (rows, cols) tuple for sizing a pty on the remote end.
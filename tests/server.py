@@ -14,13 +14,24 @@ from StringIO import StringIO
 from functools import wraps
 from Python26SocketServer import BaseRequestHandler, ThreadingMixIn, TCPServer
 
-from fabric.operations import _sudo_prefix
+from fabric.operations import _sudo_prefix, _session_shell
 from fabric.api import env, hide
 from fabric.thread_handling import ThreadHandler
 from fabric.network import disconnect_all, ssh
 
 from fake_filesystem import FakeFilesystem, FakeFile
 
+# What a command sent to a persistent shell looks like
+SESSION_FRAME = re.compile(
+    r"\(\n(.*?)\n\)( 2>&1)?; __fabric_status=\$\?; "
+    r"printf '%s %d\\n' '(\w+)' \"\$__fabric_status\"; "
+    r"printf '%s\\n' '\w+' >&2"
+    r"(?:; case \"\$__fabric_status\" in ([\d|]+)\) ;; \*\) exit "
+    r"\"\$__fabric_status\";; esac)?\n",
+    re.S
+)
+
+
 #
 # Debugging
 #
@@ -356,7 +367,18 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
                         if not self.channel:
                             continue
                     self.ssh_server.event.wait(10)
-                    if self.ssh_server.command:
+                    if self.ssh_server.command == _session_shell():
+                        self.serve_session()
+                        self.command = self.ssh_server.command = None
+                        self.waiting_for_command = False
+                        self.channel.close()
+                    elif SESSION_FRAME.match(self.ssh_server.command or ""):
+                        self.serve_batch(self.ssh_server.command)
+                        self.command = self.ssh_server.command = None
+                        self.waiting_for_command = False
+                        time.sleep(0.5)
+                        self.channel.close()
+                    elif self.ssh_server.command:
                         self.command = self.ssh_server.command
                         # Set self.sudo_prompt, update self.command
                         self.split_sudo_prompt()
@@ -398,6 +420,56 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
             self.ssh_server = server
             self.transport = transport
 
+        def serve_session(self):
+            """
+            Act as a persistent shell, running each framed command we're sent.
+            """
+            received = ""
+            while not self.server.all_done.isSet():
+                data = self.channel.recv(65535)
+                if not data:
+                    break
+                received += data
+                match = SESSION_FRAME.match(received)
+                if not match:
+                    continue
+                received = received[match.end():]
+                self.run_frame(match)
+
+        def serve_batch(self, script):
+            """
+            Run each framed command in ``script``, as a shell would.
+            """
+            for match in SESSION_FRAME.finditer(script):
+                status = self.run_frame(match)
+                stop_unless = match.group(4)
+                if stop_unless and str(status) not in stop_unless.split("|"):
+                    break
+            self.channel.send_exit_status(status)
+
+        def run_frame(self, match):
+            """
+            Respond to one framed command, returning its exit status.
+            """
+            self.command, combined, marker = match.groups()[:3]
+            self.split_sudo_prompt()
+            stdout, stderr, status = "", "", 1
+            if self.command == 'true':
+                status = 0
+            elif self.command not in responses:
+                stderr = "Sorry, I don't recognize that command.\n"
+            elif self.sudo_prompt and not self.sudo_password():
+                stdout = "sudo: 3 incorrect password attempts\n"
+            else:
+                stdout, stderr, status = self.response()
+                stdout = "".join(filter(None, stdout))
+                stderr = "".join(filter(None, stderr))
+            if combined:
+                stdout, stderr = stdout + stderr, ""
+            self.channel.sendall(stdout + "%s %s\n" % (marker, status))
+            self.channel.sendall_stderr(stderr + "%s\n" % marker)
+            return status
+
         def split_sudo_prompt(self):
             prefix = re.escape(_sudo_prefix(None, None).rstrip()) + ' +'
             result = re.findall(r'^(%s)?(.*)$' % prefix, self.command)[0]
@@ -485,7 +557,7 @@ def server(
                 _server.shutdown()
                 # Why this is not called in shutdown() is beyond me.
                 _server.server_close()
-                worker.thread.join()
+                worker.join()
                 # Handle subthread exceptions
                 e = worker.exception
                 if e:
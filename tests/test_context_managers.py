@@ -3,12 +3,14 @@ from __future__ import with_statement
 import os
 import sys
 
+from fudge import patched_context
 from nose.tools import eq_, ok_
 
-from fabric.state import env, output
+from fabric.io import Multiplexer
+from fabric.state import env, output, sessions
 from fabric.context_managers import (cd, settings, lcd, hide, shell_env, quiet,
-    warn_only, prefix, path)
-from fabric.operations import run, local
+    warn_only, prefix, path, session, char_buffered)
+from fabric.operations import run, sudo, local
 
 from utils import mock_streams, FabricTest
 from server import server
@@ -168,6 +170,27 @@ def test_shell_env():
 
     eq_(env.shell_env, {})
 
+#
+# char_buffered()
+#
+
+class FakeTerminal(object):
+    def isatty(self):
+        return True
+
+
+def test_char_buffered_leaves_terminal_alone_in_parallel_threads():
+    """
+    char_buffered() shouldn't touch the terminal from parallel task threads
+    """
+    env._bind(dict(env.items()))
+    try:
+        with char_buffered(FakeTerminal()):
+            pass
+    finally:
+        env._unbind()
+
+
 class TestQuietAndWarnOnly(FabricTest):
     @server()
     @mock_streams('both')
@@ -238,3 +261,50 @@ class TestPathManager(FabricTest):
         """
         with path('foo'):
             eq_(self.via_local(), self.real + ":foo")
+
+
+#
+# session()
+#
+
+class TestSession(FabricTest):
+    @server(responses={
+        'ls /simple': 'some output',
+        'cd /tmp && ls /simple': 'some output in tmp',
+        'wat': ['', 'bad', 1],
+        'both_streams': ['stdout', 'stderr'],
+    })
+    def test_commands_share_one_shell(self):
+        with hide('everything'):
+            with session():
+                eq_(run("ls /simple"), "some output")
+                shell = sessions.values()[0]
+                with cd('/tmp'):
+                    eq_(run("ls /simple"), "some output in tmp")
+                eq_(sudo("ls /simple"), "some output")
+                result = run("wat", warn_only=True)
+                eq_(result.return_code, 1)
+                eq_(result, "bad")
+                result = run("both_streams", combine_stderr=False)
+                eq_((result, result.stderr), ("stdout", "stderr"))
+                eq_(sessions.values(), [shell])
+                eq_(shell.count, 6)
+        eq_(sessions, {})
+        ok_(shell.channel.closed)
+
+    @server(responses={'ls /simple': 'some output'})
+    def test_commands_get_no_local_stdin(self):
+        """
+        Session commands shouldn't forward stdin, which the shell reads
+        """
+        inputs = []
+        add = Multiplexer.add
+        def record(self, *args, **kwargs):
+            inputs.append(kwargs.get('input'))
+            return add(self, *args, **kwargs)
+        with hide('everything'):
+            with session():
+                run("ls /simple")
+                with patched_context(Multiplexer, 'add', record):
+                    run("ls /simple")
+        eq_(inputs, [False])
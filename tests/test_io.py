@@ -0,0 +1,260 @@
+from __future__ import with_statement
+
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+from fabric.context_managers import hide, settings
+from fabric.io import (CaptureBuffer, Drain, FrameReader, LineBuffer,
+    OutputLooper, Multiplexer, PromptMatcher)
+from fabric.state import connections, env
+
+from utils import FabricTest
+from server import server, RESPONSES, USER, HOST
+
+
+class FakeChannel(object):
+    input_enabled = True
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, text):
+        self.sent.append(text)
+
+    def recv(self, size):
+        return ''
+
+    recv_stderr = recv
+
+
+def _looper(attr='recv'):
+    stream = StringIO()
+    looper = OutputLooper(FakeChannel(), attr, stream, CaptureBuffer(), None)
+    return looper, stream
+
+
+class TestCaptureBuffer(object):
+    def setup(self):
+        self.buf = CaptureBuffer()
+        for text in ("foo", "bar\n", "", "biz"):
+            self.buf.append(text)
+
+    def test_str_and_len(self):
+        eq_(str(self.buf), "foobar\nbiz")
+        eq_(len(self.buf), 10)
+
+    def test_small_appends_are_coalesced(self):
+        eq_(len(self.buf.chunks), 1)
+
+    def test_large_appends_start_new_chunks(self):
+        self.buf.append("x" * CaptureBuffer.chunk_size)
+        self.buf.append("y")
+        eq_(len(self.buf.chunks), 2)
+
+    def test_tail_spans_chunks(self):
+        self.buf.chunks = ["foo", "bar\n", "biz"]
+        eq_(self.buf.tail(5), "r\nbiz")
+        eq_(self.buf.tail(50), "foobar\nbiz")
+
+    def test_endswith(self):
+        ok_(self.buf.endswith("r\nbiz"))
+        ok_(not self.buf.endswith("foo"))
+        ok_(not self.buf.endswith("x" * 50))
+
+    def test_drop_tail_spans_chunks(self):
+        self.buf.chunks = ["foo", "bar\n", "biz"]
+        self.buf.drop_tail(5)
+        eq_(str(self.buf), "fooba")
+        eq_(len(self.buf), 5)
+
+
+class TestSpillingCaptureBuffer(object):
+    def setup(self):
+        self.buf = CaptureBuffer(limit=4)
+        for text in ("foo\n", "bar", "\r", "\nbiz\n"):
+            self.buf.append(text)
+
+    def test_spills_past_limit(self):
+        ok_(self.buf.spilled)
+        eq_(len(self.buf), 13)
+        ok_(self.buf.kept < len(self.buf))
+
+    def test_excerpt_is_head_and_tail(self):
+        eq_(self.buf.excerpt(), "foo\nbiz\n")
+
+    def test_read_returns_everything(self):
+        eq_(self.buf.read(), "foo\nbar\r\nbiz\n")
+        eq_(str(self.buf), "foo\nbar\r\nbiz\n")
+
+    def test_iterlines_across_reads(self):
+        self.buf.read_size = 3
+        eq_(list(self.buf.iterlines()), ["foo", "bar", "biz"])
+
+    def test_tail_and_drop_tail_reach_into_spilled_text(self):
+        eq_(self.buf.tail(9), "bar\r\nbiz\n")
+        self.buf.drop_tail(9)
+        eq_(self.buf.read(), "foo\n")
+        eq_(self.buf.excerpt(), "foo\n")
+
+    def test_unspilled_excerpt_is_everything(self):
+        buf = CaptureBuffer(limit=100)
+        buf.append("foo\nbar")
+        ok_(not buf.spilled)
+        eq_(buf.excerpt(), "foo\nbar")
+        eq_(buf.file, None)
+
+
+class TestLineBuffer(object):
+    def test_pops_only_complete_lines(self):
+        buf = LineBuffer()
+        buf.append("foo\r\nba")
+        eq_(buf.pop_lines(), ["foo"])
+        eq_(buf.pop_lines(), [])
+        buf.append("r\nbiz")
+        eq_(buf.pop_lines(), ["bar"])
+        eq_(buf.pop_lines(final=True), ["biz"])
+        eq_(buf.text, "")
+
+    def test_drop_tail(self):
+        buf = LineBuffer()
+        buf.append("foo\nprompt:")
+        buf.drop_tail(7)
+        eq_(buf.pop_lines(final=True), ["foo"])
+
+
+class TestPromptMatcher(object):
+    def test_matches_at_end_of_line_or_data(self):
+        matcher = PromptMatcher(["pass:"])
+        eq_(matcher.feed("pass:\nxpass:"), [(5, "pass:"), (12, "pass:")])
+
+    def test_ignores_prompts_in_mid_line(self):
+        eq_(PromptMatcher(["pass:"]).feed("pass: ok\n"), [])
+
+    def test_prompts_ending_in_newline_match_anywhere(self):
+        eq_(PromptMatcher(["again\n"]).feed("again\nmore"), [(6, "again\n")])
+
+    def test_prompt_split_across_chunks(self):
+        matcher = PromptMatcher(["password:", "again\n"])
+        eq_(matcher.feed("my pass"), [])
+        eq_(matcher.feed("word:"), [(5, "password:")])
+        eq_(matcher.feed("aga"), [])
+        eq_(matcher.feed("in\n"), [(3, "again\n")])
+
+    def test_prompt_is_reported_only_once(self):
+        matcher = PromptMatcher(["pass:"])
+        eq_(matcher.feed("pass:"), [(5, "pass:")])
+        eq_(matcher.feed("\n"), [])
+
+    def test_no_prompts(self):
+        eq_(PromptMatcher(["", None]).feed("anything"), [])
+
+
+class TestOutputLooper(FabricTest):
+    def test_feed_captures_and_prints_with_prefix(self):
+        looper, stream = _looper()
+        looper.feed("foo\nba")
+        looper.feed("r")
+        looper.finish()
+        eq_(str(looper.capture), "foo\nbar")
+        prefix = "[%s] out: " % env.host_string
+        eq_(stream.getvalue(), "%sfoo\n%sbar" % (prefix, prefix))
+
+    def test_finish_flushes_partial_line_when_linewise(self):
+        with settings(linewise=True, output_prefix=False):
+            looper, stream = _looper()
+            looper.feed("no newline")
+            eq_(stream.getvalue(), "")
+            looper.finish()
+        eq_(stream.getvalue(), "no newline")
+
+    def test_try_again_line_is_removed_from_capture(self):
+        looper, stream = _looper()
+        looper.feed("before\n%s\nafter" % env.again_prompt)
+        eq_(str(looper.capture), "before\nafter")
+        ok_(looper.reprompt)
+
+    def test_registered_prompts_are_answered(self):
+        with settings(prompts={'Continue? ': 'yes'}):
+            looper, stream = _looper()
+            looper.feed("Really?\nContin")
+            looper.feed("ue? ")
+        eq_(looper.chan.sent, ['yes\n'])
+        eq_(str(looper.capture), "Really?\nContinue? ")
+
+
+class TestDrain(FabricTest):
+    def test_discards_output_but_answers_prompts(self):
+        stream = StringIO()
+        with settings(prompts={'Continue? ': 'yes'}):
+            drain = Drain(FakeChannel(), 'recv', stream, CaptureBuffer(), None)
+        drain.feed("lots of output\nContinue? ")
+        drain.finish()
+        eq_(drain.chan.sent, ['yes\n'])
+        eq_(str(drain.capture), "")
+        eq_(stream.getvalue(), "")
+
+
+class TestFrameReader(FabricTest):
+    def setup(self):
+        super(TestFrameReader, self).setup()
+        self.looper, self.stream = _looper()
+        self.reader = FrameReader(self.looper, '__end_1__')
+
+    def test_stops_at_marker_split_across_reads(self):
+        with hide('everything'):
+            for text in ("foo\nbar__e", "nd_1", "__ 3", "\nleftover"):
+                self.reader.feed(text)
+        ok_(self.reader.complete)
+        eq_(self.reader.value, "3")
+        eq_(str(self.looper.capture), "foo\nbar")
+
+    def test_holds_back_only_possible_markers(self):
+        with hide('everything'):
+            self.reader.feed("foo__")
+            eq_(str(self.looper.capture), "foo")
+            self.reader.feed("x")
+        eq_(str(self.looper.capture), "foo__x")
+        ok_(not self.reader.complete)
+
+    def test_finish_flushes_held_text(self):
+        with hide('everything'):
+            self.reader.feed("foo__end")
+            self.reader.finish()
+        eq_(str(self.looper.capture), "foo__end")
+
+
+class TestMultiplexer(FabricTest):
+    @server(port=2200)
+    @server(port=2201)
+    def test_services_many_channels_at_once(self):
+        cmd = "ls /simple"
+        mux = Multiplexer()
+        captures = []
+        with hide('everything'):
+            for port in (2200, 2201):
+                host_string = '%s@%s:%s' % (USER, HOST, port)
+                chan = connections[host_string].get_transport().open_session()
+                chan.exec_command(cmd)
+                capture = CaptureBuffer()
+                captures.append(capture)
+                mux.add(chan,
+                    OutputLooper(chan, 'recv', StringIO(), capture, None),
+                    OutputLooper(chan, 'recv_stderr', StringIO(),
+                        CaptureBuffer(), None))
+            mux.run()
+        eq_(mux.channels, [])
+        for capture in captures:
+            eq_(str(capture), RESPONSES[cmd])
+
+    def test_leaves_stdin_alone_in_parallel_threads(self):
+        """
+        Parallel task threads shouldn't forward local stdin
+        """
+        mux = Multiplexer()
+        env._bind(dict(env.items()))
+        try:
+            mux.add(FakeChannel(), None, None, input=True)
+        finally:
+            env._unbind()
+        eq_(mux.input, None)
@@ -0,0 +1,101 @@
+import cPickle as pickle
+import os
+import Queue
+import socket
+import stat
+import time
+
+from nose.tools import eq_, ok_
+
+from fabric.job_queue import JobQueue, ProcessPool, ThreadJob, _HashRing
+from fabric.utils import abort
+from utils import mock_streams
+
+
+class TestHashRing(object):
+    def names(self):
+        return ['host%d' % i for i in range(200)]
+
+    def ring(self, size):
+        ring = _HashRing()
+        for member in range(size):
+            ring.add(member)
+        return ring
+
+    def test_empty_ring_has_no_members(self):
+        eq_(_HashRing().get('host'), None)
+
+    def test_names_always_map_to_the_same_member(self):
+        ring, other = self.ring(4), self.ring(4)
+        for name in self.names():
+            eq_(ring.get(name), other.get(name))
+
+    def test_names_spread_over_members(self):
+        ring = self.ring(4)
+        eq_(set(ring.get(name) for name in self.names()), set(range(4)))
+
+    def test_growing_moves_only_names_taken_over(self):
+        before, after = self.ring(4), self.ring(5)
+        moved = [
+            name for name in self.names()
+            if before.get(name) != after.get(name)
+        ]
+        # Only to the new member, and only a fraction of names
+        ok_(all(after.get(name) == 4 for name in moved))
+        ok_(len(moved) < len(self.names()) / 2)
+
+
+def _is_socket(fd):
+    return 0, [stat.S_ISSOCK(os.fstat(fd).st_mode)]
+
+
+class TestProcessPool(object):
+    def test_workers_do_not_keep_inherited_sockets(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        pool = ProcessPool(_is_socket)
+        try:
+            job = pool.job('job', pickle.dumps((listener.fileno(),)))
+            job.start()
+            job.join()
+        finally:
+            pool.close()
+            listener.close()
+        eq_((job.exitcode, job.results), (0, [False]))
+
+
+class TestJobQueue(object):
+    def run_jobs(self, targets, size):
+        queue = Queue.Queue()
+        jobs = JobQueue(size, queue)
+        for name, target in targets:
+            def inner(target=target, name=name):
+                queue.put({'name': name, 'result': target()})
+            job = ThreadJob(target=inner, kwargs={})
+            job.name = name
+            jobs.append(job)
+        jobs.close()
+        return jobs, jobs.run()
+
+    @mock_streams('stderr')
+    def test_results_and_exit_codes(self):
+        def fail():
+            abort("nope")
+        jobs, results = self.run_jobs([('ok', lambda: 'yay'), ('bad', fail)],
+            2)
+        eq_(results['ok'], {'exit_code': 0, 'results': 'yay'})
+        eq_(results['bad']['exit_code'], 1)
+
+    def test_bubble_size_is_honored(self):
+        targets = [('job%d' % i, lambda: time.sleep(0.01)) for i in range(6)]
+        jobs, results = self.run_jobs(targets, 2)
+        stats = jobs.stats()
+        eq_(stats['completed'], 6)
+        eq_(stats['peak_running'], 2)
+        eq_((stats['queued'], stats['running']), (0, 0))
+
+    def test_wakes_up_on_completion_only(self):
+        jobs, results = self.run_jobs([('slow', lambda: time.sleep(0.2))], 1)
+        eq_(jobs.stats()['wakeups'], 1)
+        ok_(jobs.stats()['runtime'][0] >= 0.2)
@@ -1,8 +1,10 @@
 from __future__ import with_statement
 
+import base64
 from datetime import datetime
 import copy
 import getpass
+import socket
 import sys
 
 from nose.tools import with_setup, ok_, raises
@@ -11,9 +13,12 @@ from fudge import (Fake, clear_calls, clear_expectations, patch_object, verify,
 
 from fabric.context_managers import settings, hide, show
 from fabric.network import (HostConnectionCache, join_host_strings, normalize,
-    denormalize, key_filenames, ssh)
+    denormalize, key_filenames, normalize_to_string, normalize_many, ssh,
+    _HostKeyStore, _KeyStore, _GatewayPool, _native_jump, RetryPolicy,
+    _interleave, _open_socket, resolve_hosts)
 from fabric.io import output_loop
 import fabric.network  # So I can call patch_object correctly. Sigh.
+import fabric.thread_handling
 from fabric.state import env, output, _get_system_username
 from fabric.operations import run, sudo, prompt
 from fabric.exceptions import NetworkError
@@ -22,7 +27,19 @@ from fabric import utils # for patching
 
 from utils import *
 from server import (server, PORT, RESPONSES, PASSWORDS, CLIENT_PRIVKEY, USER,
-    CLIENT_PRIVKEY_PASSPHRASE)
+    CLIENT_PRIVKEY_PASSPHRASE, SERVER_PRIVKEY)
+
+
+def live_client(on_close=None):
+    """
+    Fake SSHClient whose transport is up.
+    """
+    transport = Fake('transport').provides('is_active').returns(True)
+    client = Fake('client').provides('get_transport').returns(transport)
+    close = client.provides('close')
+    if on_close:
+        close.calls(on_close)
+    return client
 
 
 #
@@ -124,6 +141,26 @@ class TestNetwork(FabricTest):
             yield eq_, normalize(input), empties
             del eq_.description
 
+    def test_normalization_follows_env_changes(self):
+        """
+        Memoized normalize() results should not outlive the env they came from
+        """
+        with settings(user='first'):
+            eq_(normalize('somehost')[0], 'first')
+        with settings(user='second'):
+            eq_(normalize('somehost')[0], 'second')
+
+    def test_normalize_many(self):
+        """
+        normalize_many() should match normalize() for each host string
+        """
+        hosts = ['localhost', 'user@otherhost:222', '', '[::1]:2200']
+        eq_(normalize_many(hosts), map(normalize, hosts))
+        eq_(
+            normalize_many(hosts, omit_port=True),
+            [normalize(h, omit_port=True) for h in hosts]
+        )
+
     def test_host_string_denormalization(self):
         username = _get_system_username()
         for description, string1, string2 in (
@@ -151,7 +188,8 @@ class TestNetwork(FabricTest):
         # Clear Fudge call stack
         # Patch connect() with Fake obj set to expect num_calls calls
         patched_connect = patch_object('fabric.network', 'connect',
-            Fake('connect', expect_call=True).times_called(num_calls)
+            Fake('connect', expect_call=True).times_called(num_calls).returns(
+                live_client())
         )
         try:
             # Make new cache object
@@ -183,7 +221,7 @@ class TestNetwork(FabricTest):
         HostConnectionCache should delete correctly w/ non-full keys
         """
         hcc = HostConnectionCache()
-        fake = Fake('connect', callable=True)
+        fake = Fake('connect', callable=True).returns(live_client())
         with patched_context('fabric.network', 'connect', fake):
             for host_string in ('hostname', 'user@hostname',
                 'user@hostname:222'):
@@ -196,6 +234,108 @@ class TestNetwork(FabricTest):
                 # Test
                 ok_(host_string not in hcc)
 
+    def test_connection_cache_evicts_least_recently_used(self):
+        """
+        HostConnectionCache should close the LRU connection when full
+        """
+        hcc = HostConnectionCache()
+        closed = []
+        def connect(user, host, port, *args, **kwargs):
+            return live_client(lambda: closed.append(host))
+        with patched_context('fabric.network', 'connect', connect):
+            with settings(connection_cache_size=2):
+                hcc['a']
+                hcc['b']
+                hcc['a']
+                hcc['c']
+        ok_('a' in hcc and 'c' in hcc)
+        ok_('b' not in hcc)
+        eq_(closed, ['b'])
+        stats = hcc.stats()
+        eq_(stats['misses'], 3)
+        eq_(stats['hits'], 1)
+        eq_(stats['evictions'], 1)
+
+    def test_connection_cache_reaps_idle_connections(self):
+        """
+        HostConnectionCache.reap() should close connections left idle
+        """
+        hcc = HostConnectionCache()
+        fake = Fake('connect', callable=True).returns(live_client())
+        with patched_context('fabric.network', 'connect', fake):
+            hcc['a']
+            hcc['b']
+        hcc._used[normalize_to_string('a')] -= 120
+        with settings(connection_idle_timeout=60):
+            hcc.reap()
+        ok_('a' not in hcc)
+        ok_('b' in hcc)
+        eq_(hcc.stats()['expirations'], 1)
+
+
+    def test_connection_cache_reaper_has_a_thread_of_its_own(self):
+        """
+        HostConnectionCache's reaper shouldn't tie up an I/O pool thread
+        """
+        hcc = HostConnectionCache()
+        submitted = fabric.thread_handling.io_pool.stats()['submitted']
+        with settings(connection_idle_timeout=60):
+            hcc._start_reaper()
+        ok_(hcc._reaper.is_alive())
+        eq_(fabric.thread_handling.io_pool.stats()['submitted'], submitted)
+
+    def test_connection_cache_keeps_connections_in_use(self):
+        """
+        HostConnectionCache should never close connections marked in use
+        """
+        hcc = HostConnectionCache()
+        fake = Fake('connect', callable=True).returns(live_client())
+        with patched_context('fabric.network', 'connect', fake):
+            with settings(host_string=None, connection_cache_size=1):
+                with hcc.in_use('a'):
+                    hcc['a']
+                    hcc['b']
+                    hcc['c']
+                    hcc._used[normalize_to_string('a')] -= 120
+                    with settings(connection_idle_timeout=60):
+                        hcc.reap()
+                    ok_('a' in hcc and 'c' in hcc)
+                    ok_('b' not in hcc)
+                hcc['d']
+        ok_('a' not in hcc)
+
+    def test_connection_cache_keeps_only_one_of_racing_connections(self):
+        """
+        HostConnectionCache should close all but the first connection to a host
+        """
+        hcc = HostConnectionCache()
+        clients = []
+        closed = []
+        def connect(user, host, port, *args, **kwargs):
+            client = live_client(lambda: closed.append(host))
+            clients.append(client)
+            if len(clients) == 1:
+                # Another thread connects to the same host meanwhile.
+                hcc['a']
+            return client
+        with patched_context('fabric.network', 'connect', connect):
+            ok_(hcc['a'] is clients[1])
+        eq_(closed, ['a'])
+        ok_(hcc['a'] is clients[1])
+
+    def test_connection_cache_replaces_dead_connections(self):
+        """
+        HostConnectionCache should reconnect when a transport has died
+        """
+        hcc = HostConnectionCache()
+        dead = Fake('client').provides('close').provides(
+            'get_transport').returns(None)
+        fake = Fake('connect', callable=True).returns(dead).next_call(
+            ).returns(live_client())
+        with patched_context('fabric.network', 'connect', fake):
+            ok_(hcc['a'] is dead)
+            ok_(hcc['a'] is not dead)
+        eq_(hcc.stats()['reconnects'], 1)
 
     #
     # Connection loop flow
@@ -635,6 +775,300 @@ class TestSSHConfig(FabricTest):
             ok_(run("ls /simple").succeeded)
 
 
+class TestPrewarm(FabricTest):
+    def env_setup(self):
+        super(TestPrewarm, self).env_setup()
+        env.use_ssh_config = True
+        env.ssh_config_path = support("prewarm_ssh_config")
+
+    def test_uses_each_hosts_own_ssh_config(self):
+        """
+        prewarm() should go by each host's ssh_config, not the current host's
+        """
+        seen = {}
+        def connect(user, host, port, sock=None, host_string=None,
+            prompt=True):
+            seen[host] = (sock, key_filenames(host_string))
+            return Fake('client')
+        with settings(host_string=None, native_proxy_jump=False):
+            with patched_context(fabric.network, 'connect', connect):
+                with patched_context(ssh, 'ProxyCommand', lambda cmd: cmd):
+                    eq_(HostConnectionCache().prewarm(['proxied', 'direct']),
+                        {})
+        ok_(seen['proxied'][0])
+        eq_(seen['proxied'][1], ['proxied.pub'])
+        eq_(seen['direct'], (None, ['direct.pub']))
+
+
+class TestResolveHosts(FabricTest):
+    def test_skips_proxied_hosts(self):
+        """
+        resolve_hosts() should leave hosts behind a proxy to the proxy
+        """
+        resolved = []
+        with settings(use_ssh_config=True,
+            ssh_config_path=support("prewarm_ssh_config")):
+            with patched_context(fabric.network._Resolver, 'resolve_many',
+                lambda self, hosts: resolved.extend(hosts)):
+                resolve_hosts(['proxied', 'direct'])
+        eq_(resolved, ['direct'])
+
+
+class TestGatewayPool(FabricTest):
+    def setup(self):
+        super(TestGatewayPool, self).setup()
+        self.connected = []
+        def connect(user, host, port, sock=None, host_string=None,
+                prompt=True):
+            self.connected.append((host, sock))
+            client = Fake('client')
+            transport = Fake('transport').provides('is_active').returns(True)
+            transport.provides('open_channel').calls(
+                lambda *args: Fake('channel').has_attr(closed=False))
+            return client.provides('get_transport').returns(transport)
+        self.patched = patched_context('fabric.network', 'connect', connect)
+        self.patched.__enter__()
+
+    def teardown(self):
+        self.patched.__exit__(None, None, None)
+        super(TestGatewayPool, self).teardown()
+
+    def test_spreads_channels_over_pool(self):
+        """
+        Gateway channels should go over the least loaded connection
+        """
+        pool = _GatewayPool('gw')
+        with settings(gateway_pool_size=2):
+            for i in range(5):
+                pool.open_channel('target%d' % i, 22)
+        eq_(len(self.connected), 2)
+        eq_(sorted(pool.stats()), [2, 3])
+
+    @raises(NetworkError)
+    def test_channel_limit(self):
+        """
+        A full gateway pool should refuse further channels
+        """
+        pool = _GatewayPool('gw')
+        with settings(gateway_channel_limit=1):
+            pool.open_channel('target1', 22)
+            pool.open_channel('target2', 22)
+
+    def test_chained_gateways(self):
+        """
+        Each gateway should be connected to through the one before it
+        """
+        cache = HostConnectionCache()
+        with settings(gateway='outer,inner'):
+            cache.gateway().open_channel('target', 22)
+        eq_([host for host, sock in self.connected], ['outer', 'inner'])
+        ok_(self.connected[0][1] is None)
+        ok_(self.connected[1][1] is not None)
+
+    def test_gateways_behind_proxies_of_their_own(self):
+        """
+        Gateways should be reached through their own ssh_config proxies
+        """
+        cache = HostConnectionCache()
+        with settings(use_ssh_config=True,
+            ssh_config_path=support("chained_ssh_config"),
+            host_string='inner'):
+            with patched_context(ssh, 'ProxyCommand', lambda cmd: cmd):
+                cache['inner']
+        eq_([host for host, sock in self.connected],
+            ['outer', 'middle', 'inner'])
+        eq_(self.connected[0][1], 'corkscrew proxy 80 outer 22')
+        ok_(self.connected[1][1] is not None)
+        ok_(self.connected[2][1] is not None)
+
+
+class TestRetryPolicy(FabricTest):
+    def test_gives_up_after_connection_attempts(self):
+        with settings(connection_attempts=2):
+            ok_(RetryPolicy().delay(1, 0, socket.timeout()) is not None)
+            eq_(RetryPolicy().delay(2, 0, socket.timeout()), None)
+
+    def test_retries_timeouts_immediately(self):
+        with settings(connection_attempts=5):
+            eq_(RetryPolicy().delay(1, 0, socket.timeout()), 0)
+
+    def test_backs_off_with_jitter_up_to_timeout(self):
+        with settings(connection_attempts=20, connection_backoff=1, timeout=10):
+            for tries, limit in ((1, 1), (2, 2), (3, 4), (10, 10)):
+                wait = RetryPolicy().delay(tries, 0, socket.error(111, 'nope'))
+                ok_(0 <= wait <= limit)
+
+    def test_gives_up_at_deadline(self):
+        with settings(connection_attempts=20, connection_deadline=30):
+            ok_(RetryPolicy().delay(1, 29.5, socket.error()) <= 0.5)
+            eq_(RetryPolicy().delay(1, 30, socket.error()), None)
+
+
+class TestOpenSocket(FabricTest):
+    def setup(self):
+        super(TestOpenSocket, self).setup()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def teardown(self):
+        self.listener.close()
+        super(TestOpenSocket, self).teardown()
+
+    def address(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', port))
+
+    def test_interleaves_address_families(self):
+        addresses = [(10, 'a'), (10, 'b'), (2, 'c'), (2, 'd'), (2, 'e')]
+        eq_(
+            [a[1] for a in _interleave(addresses)],
+            ['a', 'c', 'b', 'd', 'e']
+        )
+
+    def test_falls_back_to_next_address(self):
+        """
+        _open_socket() should move on from an address refusing connections
+        """
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = closed.getsockname()[1]
+        closed.close()
+        addresses = [self.address(refused), self.address(self.port)]
+        with patched_context(fabric.network._Resolver, 'resolve',
+            lambda self, host, port: addresses):
+            sock = _open_socket('somehost', self.port, 5)
+        eq_(sock.getpeername()[1], self.port)
+        sock.close()
+
+    def test_no_timeout(self):
+        """
+        _open_socket() should wait as long as it takes given a timeout of None
+        """
+        sock = _open_socket('127.0.0.1', self.port, None)
+        eq_(sock.getpeername()[1], self.port)
+        eq_(sock.gettimeout(), None)
+        sock.close()
+
+    @raises(socket.error)
+    def test_raises_last_error(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = closed.getsockname()[1]
+        closed.close()
+        _open_socket('127.0.0.1', refused, 5)
+
+
+class TestNativeJump(object):
+    def test_recognized_proxy_settings(self):
+        for description, conf, expected in (
+            ("ProxyJump",
+                {'proxyjump': 'jump1,me@jump2:2222'},
+                (['jump1', 'me@jump2:2222'], 'target', '22')),
+            ("ssh -W",
+                {'proxycommand': 'ssh -q -W %h:%p jump'},
+                (['jump'], 'target', '22')),
+            ("ssh -W with jump user and port",
+                {'proxycommand': 'ssh -l me -p 2222 -W %h:%p jump'},
+                (['me@jump:2222'], 'target', '22')),
+            ("ssh + nc",
+                {'proxycommand': 'ssh jump nc %h %p'},
+                (['jump'], 'target', '22')),
+        ):
+            eq_.description = "_native_jump() handles %s" % description
+            yield eq_, _native_jump(conf, 'user', 'target', '22'), expected
+            del eq_.description
+
+    def test_other_proxy_settings_fall_back(self):
+        for description, conf in (
+            ("no proxy", {}),
+            ("ProxyJump none", {'proxyjump': 'none'}),
+            ("non-ssh command", {'proxycommand': 'corkscrew proxy 80 %h %p'}),
+            ("unknown ssh option", {'proxycommand': 'ssh -o Foo=1 -W %h:%p j'}),
+            ("remote command", {'proxycommand': 'ssh jump socat - TCP:%h:%p'}),
+        ):
+            eq_.description = "_native_jump() ignores %s" % description
+            yield eq_, _native_jump(conf, 'user', 'target', '22'), None
+            del eq_.description
+
+
+class TestHostKeyStore(FabricTest):
+    def setup(self):
+        super(TestHostKeyStore, self).setup()
+        self.key = ssh.RSAKey(filename=SERVER_PRIVKEY)
+        self.known_hosts = self.path('known_hosts')
+        hashed = ssh.HostKeys.hash_host('hashed.example.com')
+        self.write_known_hosts('plain.example.com', hashed)
+
+    def write_known_hosts(self, *hostnames):
+        line = "%%s ssh-rsa %s\n" % self.key.get_base64()
+        self.mkfile('known_hosts', ''.join(line % h for h in hostnames))
+
+    def test_finds_plain_and_hashed_entries(self):
+        """
+        Parsed known_hosts should find plain and hashed hostnames alike
+        """
+        keys = _HostKeyStore().get([self.known_hosts])
+        for hostname in ('plain.example.com', 'hashed.example.com'):
+            eq_(keys.get(hostname, {}).get('ssh-rsa'), self.key)
+        eq_(keys.get('other.example.com'), None)
+
+    def test_skips_malformed_entries(self):
+        """
+        Parsed known_hosts should skip lines with unusable keys
+        """
+        blob = ssh.Message()
+        blob.add_string('ssh-dss')
+        self.mkfile('known_hosts', "plain.example.com ssh-rsa %s\n"
+            "bad.example.com ssh-rsa %s\n"
+            "other.example.com ssh-rsa %s\n" % (self.key.get_base64(),
+                base64.b64encode(str(blob)), self.key.get_base64()))
+        keys = _HostKeyStore().get([self.known_hosts])
+        for hostname in ('plain.example.com', 'other.example.com'):
+            eq_(keys.get(hostname, {}).get('ssh-rsa'), self.key)
+        eq_(keys.get('bad.example.com'), None)
+
+    def test_is_shared_until_file_changes(self):
+        """
+        known_hosts should only be parsed again once it changes
+        """
+        store = _HostKeyStore()
+        keys = store.get([self.known_hosts])
+        ok_(store.get([self.known_hosts]) is keys)
+        self.write_known_hosts('plain.example.com', 'new.example.com')
+        keys = store.get([self.known_hosts])
+        eq_(keys.get('new.example.com', {}).get('ssh-rsa'), self.key)
+
+
+class TestKeyStore(FabricTest):
+    def test_needs_passphrase_for_encrypted_keys(self):
+        """
+        Encrypted keys can't be loaded without their passphrase
+        """
+        eq_(_KeyStore().get(CLIENT_PRIVKEY), None)
+
+    def test_loads_each_key_once(self):
+        """
+        A key file should only be read again once it changes
+        """
+        store = _KeyStore()
+        key = store.get(CLIENT_PRIVKEY, CLIENT_PRIVKEY_PASSPHRASE)
+        ok_(isinstance(key, ssh.PKey))
+        ok_(store.get(CLIENT_PRIVKEY) is key)
+
+    def test_split_hands_over_first_loadable_key(self):
+        """
+        split() should return the first loadable key plus the other files
+        """
+        store = _KeyStore()
+        pkey, rest = store.split(
+            ['/nonexistent', CLIENT_PRIVKEY, SERVER_PRIVKEY],
+            CLIENT_PRIVKEY_PASSPHRASE
+        )
+        ok_(pkey is store.get(CLIENT_PRIVKEY))
+        eq_(rest, ['/nonexistent', SERVER_PRIVKEY])
+
+
 class TestKeyFilenames(FabricTest):
     def test_empty_everything(self):
         """
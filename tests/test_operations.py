@@ -4,7 +4,7 @@ import os
 import shutil
 import sys
 import types
-from contextlib import nested
+from contextlib import contextmanager, nested
 from StringIO import StringIO
 
 import unittest
@@ -12,12 +12,13 @@ import random
 import types
 
 from nose.tools import raises, eq_, ok_
-from fudge import with_patched_object
+from fudge import with_patched_object, patched_context
 
 from fabric.state import env, output
 from fabric.operations import require, prompt, _sudo_prefix, _shell_wrap, \
     _shell_escape
-from fabric.api import get, put, hide, show, cd, lcd, local, run, sudo, quiet
+from fabric.api import (get, put, hide, show, cd, lcd, local, run, sudo, quiet,
+    run_iter, sudo_iter, run_many, sudo_many)
 from fabric.sftp import SFTP
 from fabric.exceptions import CommandTimeout
 
@@ -418,6 +419,113 @@ class TestRun(FabricTest):
         with hide('everything'):
             sudo("slow", timeout=2)
 
+    @server()
+    def test_run_iter_yields_lines(self):
+        with hide('everything'):
+            result = run_iter("ls /")
+            eq_(result.return_code, None)
+            eq_(list(result), RESPONSES["ls /"].splitlines())
+        eq_(result.return_code, 0)
+        ok_(result.succeeded)
+        eq_(result.command, "ls /")
+
+    @server(responses={'wat': ["one\ntwo", "", 1]})
+    def test_sudo_iter_honors_warn_only(self):
+        with hide('everything'):
+            result = sudo_iter("wat", warn_only=True)
+            eq_(list(result), ["one", "two"])
+        ok_(result.failed)
+        eq_(result.return_code, 1)
+
+    @server()
+    def test_run_iter_may_be_closed_early(self):
+        with hide('everything'):
+            result = run_iter("ls /")
+            eq_(result.next(), "AUTHORS")
+            result.close()
+        eq_(list(result), [])
+        eq_(result.return_code, None)
+
+    @server()
+    def test_run_iter_releases_terminal_between_lines(self):
+        held = []
+        @contextmanager
+        def char_buffered(pipe):
+            held.append(True)
+            yield
+            held.pop()
+        with patched_context('fabric.operations', 'char_buffered',
+            char_buffered):
+            with hide('everything'):
+                result = run_iter("ls /")
+                eq_(result.next(), "AUTHORS")
+                eq_(held, [])
+                result.close()
+        eq_(held, [])
+
+    @server(responses={
+        'ls /simple': 'some output',
+        'wat': ['', 'bad', 1],
+        'both_streams': ['stdout', 'stderr'],
+    })
+    def test_run_many_returns_per_command_results(self):
+        with hide('everything'):
+            results = run_many(["ls /simple", "wat", "both_streams"],
+                stop_on_error=False, combine_stderr=False, warn_only=True)
+        eq_(results, ["some output", "", "stdout"])
+        eq_([r.return_code for r in results], [0, 1, 0])
+        eq_([r.stderr for r in results], ["", "bad", "stderr"])
+        eq_(results[2].command, "both_streams")
+        ok_(results.failed)
+
+    @server(responses={'ls /simple': 'some output'})
+    def test_run_many_honors_shell_false(self):
+        with settings(hide('everything'), use_shell=True):
+            results = run_many(["ls /simple"], shell=False)
+        eq_(results, ["some output"])
+
+    @server(responses={'ls /simple': 'some output', 'wat': ['', '', 1]})
+    def test_sudo_many_stops_on_error(self):
+        with hide('everything'):
+            results = sudo_many(["ls /simple", "wat", "ls /simple"],
+                warn_only=True)
+        eq_(results, ["some output", ""])
+        ok_(results[1].failed)
+
+    @server(responses={'ls /simple': 'some output', 'wat': ['', '', 1]})
+    @raises(SystemExit)
+    def test_run_many_aborts_on_failure(self):
+        with hide('everything'):
+            run_many(["wat", "ls /simple"])
+
+    @server(responses={'wat': ["some output", "", 1]})
+    def test_discard_returns_status_only(self):
+        stream = StringIO()
+        with hide('running', 'warnings'):
+            result = run("wat", warn_only=True, discard=True, stdout=stream)
+        eq_(result, "")
+        eq_(result.return_code, 1)
+        eq_(stream.getvalue(), "")
+
+    @server()
+    def test_capture_limit_keeps_excerpt_and_spills_the_rest(self):
+        full = RESPONSES["ls /"]
+        with hide('everything'):
+            result = run("ls /", capture_limit=10)
+        ok_(result.truncated)
+        eq_(str(result), full[:10] + full[-10:].strip())
+        eq_(result.read(), full.strip())
+        eq_(list(result.iterlines()), full.splitlines())
+
+    @server()
+    def test_capture_to_path_saves_complete_output(self):
+        target = self.path('captured')
+        with hide('everything'):
+            result = run("ls /", capture_to=target)
+        ok_(not result.truncated)
+        eq_(str(result), RESPONSES["ls /"].strip())
+        eq_contents(target, RESPONSES["ls /"])
+
 
 #
 # get() and put()
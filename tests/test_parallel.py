@@ -1,6 +1,9 @@
 from __future__ import with_statement
 
-from fabric.api import run, parallel, env, hide, execute, settings
+import os
+
+from fabric.api import run, parallel, env, hide, execute, settings, output
+from fabric import state, tasks
 
 from utils import FabricTest, eq_, aborts, mock_streams
 from server import server, RESPONSES, USER, HOST, PORT
@@ -91,3 +94,75 @@ class TestParallel(FabricTest):
             result = execute(mytask, hosts=[host1, host2])
         eq_(result[host1], True)
         eq_(result[host2], True)
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_thread_backend(self):
+        """
+        The thread backend should give each host its own env and output
+        """
+        host1 = '127.0.0.1:2200'
+        host2 = '127.0.0.1:2201'
+
+        @parallel
+        def mytask():
+            output.debug = True
+            env.mine = env.host_string
+            run("ls /")
+            return env.mine, env.linewise
+
+        with hide('everything'):
+            with settings(parallel_backend='thread'):
+                result = execute(mytask, hosts=[host1, host2])
+        eq_(result[host1], (host1, True))
+        eq_(result[host2], (host2, True))
+        assert 'mine' not in env
+        assert not env.linewise
+        assert not output.debug
+
+    @server(port=2200)
+    @server(port=2201)
+    @aborts
+    @mock_streams('stderr') # To hide the traceback for now
+    def test_thread_backend_failures_abort(self):
+        with hide('everything'):
+            host1 = '127.0.0.1:2200'
+            host2 = '127.0.0.1:2201'
+
+            @parallel
+            def mytask():
+                run("ls /")
+                if env.host_string == host2:
+                    raise OhNoesException
+
+            with settings(parallel_backend='thread'):
+                execute(mytask, hosts=[host1, host2])
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_pool_backend_reuses_workers_across_tasks(self):
+        """
+        The pool backend should run each host on the same worker every time
+        """
+        host1 = '127.0.0.1:2200'
+        host2 = '127.0.0.1:2201'
+
+        @parallel
+        def mytask():
+            run("ls /")
+            return os.getpid(), env.host_string
+
+        # Pool workers look tasks up by name
+        state.commands['mytask'] = mytask
+        try:
+            with hide('everything'):
+                with settings(parallel_backend='pool'):
+                    first = execute('mytask', hosts=[host1, host2])
+                    second = execute('mytask', hosts=[host1, host2])
+        finally:
+            del state.commands['mytask']
+            tasks._pool.close()
+            tasks._pool = None
+        eq_(first, second)
+        eq_(first[host1][1], host1)
+        assert first[host1][0] != os.getpid()
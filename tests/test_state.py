@@ -1,6 +1,10 @@
-from nose.tools import eq_
+from __future__ import with_statement
 
-from fabric.state import _AliasDict
+from fudge import Fake, patched_context
+from nose.tools import eq_, ok_
+
+from fabric.context_managers import settings
+from fabric.state import _AliasDict, connections, default_channel
 
 
 def test_dict_aliasing():
@@ -50,3 +54,21 @@ def test_dict_alias_expansion():
         aliases={'foo': ['bar', 'nested'], 'nested': ['biz']}
     )
     eq_(ad.expand_aliases(['foo']), ['bar', 'biz'])
+
+
+def test_default_channel_reconnects_without_extra_handshake():
+    """
+    default_channel() drops a dead connection without first reopening it
+    """
+    sessions = [EOFError()]
+    def open_session():
+        if sessions:
+            raise sessions.pop()
+        return Fake('channel', expect_call=False).is_a_stub()
+    def connect(*args, **kwargs):
+        raise AssertionError("Should not reconnect to close")
+    with settings(host_string='user@dead:22'):
+        with patched_context('fabric.state', '_open_session', open_session):
+            with patched_context('fabric.network', 'connect', connect):
+                default_channel()
+        ok_('user@dead:22' not in connections)
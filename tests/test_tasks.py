@@ -6,10 +6,12 @@ import unittest
 from nose.tools import eq_, raises, ok_
 import random
 import sys
+import time
 
 import fabric
-from fabric.tasks import WrappedCallableTask, execute, Task
-from fabric.api import run, env, settings, hosts, roles, hide, parallel
+from fabric.tasks import WrappedCallableTask, execute, execute_iter, Task
+from fabric.api import (run, env, settings, hosts, roles, hide, parallel,
+    rolling)
 from fabric.network import from_dict
 from fabric.exceptions import NetworkError
 
@@ -381,6 +383,34 @@ class TestExecute(FabricTest):
             retval = execute(task, hosts=[host_string])
         assert isinstance(retval[host_string], NetworkError)
 
+    @server(port=2200)
+    @server(port=2201)
+    def test_prewarm_connects_to_all_hosts_before_running(self):
+        """
+        env.prewarm should connect to every host before the task runs
+        """
+        hosts = ['127.0.0.1:2200', '127.0.0.1:2201']
+        connected = []
+        def task():
+            connected.append([h in fabric.state.connections for h in hosts])
+        with settings(hide('everything'), prewarm=True):
+            execute(task, hosts=hosts)
+        eq_(connected, [[True, True], [True, True]])
+
+    @server(port=2200)
+    def test_prewarm_skips_bad_hosts_up_front(self):
+        """
+        Hosts that fail to prewarm should not be run on when skipping them
+        """
+        ran = []
+        def task():
+            ran.append(env.host_string)
+        host_string = 'localhost:1234'
+        with settings(hide('everything'), prewarm=True, skip_bad_hosts=True):
+            retval = execute(task, hosts=[host_string, '127.0.0.1:2200'])
+        assert isinstance(retval[host_string], NetworkError)
+        eq_(ran, ['127.0.0.1:2200'])
+
     @server(port=2200)
     @server(port=2201)
     def test_parallel_return_values(self):
@@ -396,6 +426,96 @@ class TestExecute(FabricTest):
             retval = execute(task)
         eq_(retval, {'127.0.0.1:2200': '2200', '127.0.0.1:2201': '2201'})
 
+    def test_execute_iter_yields_serial_results_in_order(self):
+        """
+        execute_iter() should yield each host's result as it is run
+        """
+        hosts = ['127.0.0.1:2200', '127.0.0.1:2201']
+        ran = []
+        def task():
+            ran.append(env.host_string)
+            return env.host_string
+        results = execute_iter(task, hosts=hosts)
+        eq_(ran, [])
+        with hide('everything'):
+            eq_(results.next(), (hosts[0], hosts[0]))
+            eq_(ran, hosts[:1])
+            eq_(list(results), [(hosts[1], hosts[1])])
+
+    def test_execute_iter_yields_parallel_results_as_hosts_finish(self):
+        """
+        execute_iter() should not wait for slow hosts to yield fast ones
+        """
+        @parallel
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            if env.host_string.endswith('2200'):
+                time.sleep(0.5)
+            return env.host_string
+        with hide('everything'):
+            eq_([host for host, result in execute_iter(task)],
+                ['127.0.0.1:2201', '127.0.0.1:2200'])
+
+    def test_rolling_runs_one_batch_at_a_time(self):
+        """
+        @rolling should finish each batch before starting the next
+        """
+        @rolling(batch=1)
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            if env.host_string.endswith('2200'):
+                time.sleep(0.5)
+            return env.host_string
+        with hide('everything'):
+            eq_([host for host, result in execute_iter(task)],
+                ['127.0.0.1:2200', '127.0.0.1:2201'])
+
+    @mock_streams('stderr')
+    def test_rolling_tolerates_up_to_max_fail(self):
+        """
+        @rolling should only warn about failures within max_fail
+        """
+        @rolling(batch="50%", max_fail=1)
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            if env.host_string.endswith('2200'):
+                raise ValueError
+            return env.host_string
+        with hide('everything'):
+            retval = execute(task)
+        assert isinstance(retval['127.0.0.1:2200'], ValueError)
+        eq_(retval['127.0.0.1:2201'], '127.0.0.1:2201')
+
+    @mock_streams('stderr')
+    def test_rolling_skips_remaining_batches_past_max_fail(self):
+        """
+        @rolling should not start new batches once max_fail is exceeded
+        """
+        @rolling(batch=1, max_fail=1)
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201', '127.0.0.1:2202')
+        def task():
+            raise ValueError
+        with settings(hide('everything'), warn_only=True):
+            retval = execute(task)
+        eq_(sorted(retval), ['127.0.0.1:2200', '127.0.0.1:2201'])
+
+    @aborts
+    def test_rolling_aborts_on_invalid_batch_size(self):
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            pass
+        with settings(hide('everything'), rolling_batch="-5%"):
+            execute(task)
+
+    @aborts
+    @mock_streams('stderr')
+    def test_rolling_aborts_past_max_fail(self):
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            raise ValueError
+        with settings(hide('everything'), rolling_batch=1):
+            execute(task)
+
     @with_fakes
     def test_should_work_with_Task_subclasses(self):
         """
@@ -0,0 +1,77 @@
+import threading
+
+from nose.tools import eq_, ok_, raises
+
+from fabric.thread_handling import ThreadHandler, WorkerPool, run_concurrently
+import fabric.thread_handling
+from fabric.utils import _ThreadLocalDict
+
+
+class TestThreadHandler(object):
+    def setup(self):
+        self.previous = fabric.thread_handling.io_pool
+        self.pool = fabric.thread_handling.io_pool = WorkerPool(size=2)
+
+    def teardown(self):
+        fabric.thread_handling.io_pool = self.previous
+
+    @raises(ValueError)
+    def test_exceptions_are_reraised(self):
+        def fail():
+            raise ValueError("nope")
+        th = ThreadHandler('fail', fail)
+        th.join()
+        ok_(not th.is_alive())
+        th.raise_if_needed()
+
+    def test_threads_are_reused(self):
+        names = []
+        for i in range(5):
+            th = ThreadHandler('task',
+                lambda: names.append(threading.currentThread().getName()))
+            th.join()
+        eq_(names, ['task'] * 5)
+        stats = self.pool.stats()
+        eq_(stats['workers'], 1)
+        eq_(stats['submitted'], 5)
+        eq_(stats['saturated'], 0)
+
+    def test_pool_grows_past_size_when_saturated(self):
+        release = threading.Event()
+        handlers = [ThreadHandler('block', release.wait) for i in range(3)]
+        stats = self.pool.stats()
+        eq_(stats['workers'], 3)
+        eq_(stats['busy'], 3)
+        eq_(stats['saturated'], 1)
+        release.set()
+        for th in handlers:
+            th.join()
+        stats = self.pool.stats()
+        eq_(stats['peak_busy'], 3)
+        # The extra thread doesn't stick around
+        eq_(stats['workers'], 2)
+
+    def test_run_concurrently(self):
+        seen = []
+        run_concurrently('task', seen.append, range(10), 3)
+        eq_(sorted(seen), range(10))
+        ok_(self.pool.stats()['workers'] <= 2)
+
+    @raises(ValueError)
+    def test_run_concurrently_reraises(self):
+        def check(i):
+            if i == 3:
+                raise ValueError(i)
+        run_concurrently('task', check, range(5), 2)
+
+    def test_handlers_see_their_creators_bindings(self):
+        values = _ThreadLocalDict({'who': 'everyone'})
+        seen = []
+        values._bind({'who': 'creator'})
+        try:
+            ThreadHandler('task', lambda: seen.append(values.who)).join()
+        finally:
+            values._unbind()
+        # The pool thread doesn't keep the binding for later work
+        ThreadHandler('task', lambda: seen.append(values.who)).join()
+        eq_(seen, ['creator', 'everyone'])
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import sys
+import threading
 from unittest import TestCase
 
 from fudge import Fake, patched_context, with_fakes
@@ -9,6 +10,7 @@ from nose.tools import eq_
 
 from fabric.state import output, env
 from fabric.utils import warn, indent, abort, puts, fastprint, error, RingBuffer
+from fabric.utils import _ThreadLocalDict, _ThreadLocalAliasDict
 from fabric import utils  # For patching
 from fabric.context_managers import settings, hide
 from utils import mock_streams, aborts, FabricTest, assert_contains
@@ -207,3 +209,45 @@ class TestRingBuffer(TestCase):
         self.b.extend("abcde")
         self.b.extend("fgh")
         eq_(self.b, ['d', 'e', 'f', 'g', 'h'])
+
+
+class TestThreadLocalDict(TestCase):
+    def setUp(self):
+        self.d = _ThreadLocalDict({'foo': 'bar'})
+
+    def in_thread(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+    def test_unbound_threads_share_contents(self):
+        def change():
+            self.d.foo = 'baz'
+        self.in_thread(change)
+        eq_(self.d, {'foo': 'baz'})
+
+    def test_bound_threads_see_only_their_values(self):
+        seen = []
+        def change():
+            self.d._bind({'foo': 'mine'})
+            self.d.biz = 'baz'
+            seen.append((self.d.foo, sorted(self.d.keys()), 'biz' in self.d))
+        self.in_thread(change)
+        eq_(seen, [('mine', ['biz', 'foo'], True)])
+        eq_(self.d, {'foo': 'bar'})
+
+    def test_unbind_restores_shared_contents(self):
+        self.d._bind({})
+        self.d._unbind()
+        eq_(self.d.foo, 'bar')
+
+    def test_aliases_apply_to_bound_values(self):
+        d = _ThreadLocalAliasDict({'a': True, 'b': True},
+            aliases={'both': ['a', 'b']})
+        d._bind(dict(d.items()))
+        try:
+            d['both'] = False
+            eq_(d, {'a': False, 'b': False})
+        finally:
+            d._unbind()
+        eq_(d, {'a': True, 'b': True})
@@ -42,6 +42,8 @@ class FabricTest(object):
         # Allow hooks from subclasses here for setting env vars (so they get
         # purged correctly in teardown())
         self.env_setup()
+        # Forget private keys decrypted by earlier tests
+        fabric.network._keys = fabric.network._KeyStore()
         # Temporary local file dir
         self.tmpdir = tempfile.mkdtemp()
 